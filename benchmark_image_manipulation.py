@@ -0,0 +1,347 @@
+"""
+Benchmark the image_manipulation module.
+
+By default runs every operation code, plus decode and encode, on synthetic images from a quarter
+of a megapixel up to tens of megapixels and on the bundled oregon_river images, and prints the
+megapixels a second and peak memory of each. The results can be saved as a baseline and later runs
+compared against it, exiting with 1 when anything got slower or used more memory by more than a
+threshold.
+
+    python benchmark_image_manipulation.py --save-baseline baseline.json
+    python benchmark_image_manipulation.py --baseline baseline.json --threshold 0.2
+
+With --legacy it instead times every ImageO manipulation against the per-pixel loops of the
+reference engine, on the same decoded image, and checks that both give the same array back.
+
+    python benchmark_image_manipulation.py --legacy images/oregon_river.jpg
+
+Joshua Shequin
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+from PIL import Image
+from image_manipulation import OPERATIONS, ImageO, StageStats
+
+# the megapixels of the synthetic images used by default.
+SIZES = [0.25, 1, 4, 16, 36]
+
+# the options to benchmark the operations that need some with.
+OPTIONS = {"rs": {"scale": 0.5}}
+
+# the bundled images used as well as the synthetic ones.
+BUNDLED = ["images/oregon_river.jpg", "images/oregon_river_resized.jpg"]
+
+# megabytes a peak may grow by without counting as a regression whatever the threshold, as the
+# peaks of stages that hardly allocate anything move around by more than their own size.
+PEAK_SLACK_MB = 1.0
+
+
+def compare_legacy(image_path, operations, legacy_rows):
+    """
+    Time every operation on the reference engine and the fast one and print a table of the results.
+
+    Parameter
+    ---------
+    image_path : string
+        the image to benchmark on.
+    operations : list of string
+        the operation codes to time.
+    legacy_rows : int
+        only time the reference engine on this many rows and scale the time up, 0 for all rows.
+    """
+    source = np.array(Image.open(image_path))
+    image = ImageO(image_path)
+    rows = len(source)
+    print(f"{image_path} {len(source[0])}x{rows}")
+    print(f"{'op':4} {'loop (s)':>12} {'numpy (s)':>12} {'speedup':>10} {'same':>6}")
+    for code in operations:
+        method, strip_function = OPERATIONS[code]
+        options = OPTIONS.get(code, {})
+
+        # operations on the whole image at once, such as block_image, can not be sampled.
+        sample = rows if legacy_rows <= 0 or strip_function is None else min(legacy_rows, rows)
+        reference = ImageO.from_array(source[:sample].copy()).set_engine("reference")
+        start = time.perf_counter()
+        expected = getattr(reference, method)("", returnable=True, **options)
+        loop_time = (time.perf_counter() - start) * rows / sample
+
+        image.infile = source.copy()
+        start = time.perf_counter()
+        result = getattr(image, method)("", returnable=True, **options)
+        fast_time = time.perf_counter() - start
+
+        same = bool(np.array_equal(result[:len(expected)], expected))
+        print(f"{code:4} {loop_time:>12.3f} {fast_time:>12.5f} {loop_time / fast_time:>9.0f}x"
+              f" {str(same):>6}")
+
+
+def synthetic_image(megapixels, directory):
+    """
+    Make and save a photo like test image, smooth gradients with some noise, as a JPEG.
+
+    Parameter
+    ---------
+    megapixels : float
+        the size of the image, it is made 3:2 like most camera photos.
+    directory : string
+        the directory to save the image in.
+    Return
+    ------
+    string
+        the path of the saved image.
+    """
+    rows = max(2, int(round((megapixels * 1e6 / 1.5) ** 0.5)))
+    columns = max(2, int(round(rows * 1.5)))
+    generator = np.random.default_rng(0)
+    row_ramp = np.linspace(0, 240, rows)[:, np.newaxis]
+    column_ramp = np.linspace(0, 240, columns)[np.newaxis, :]
+    pixels = np.empty((rows, columns, 3), dtype=np.uint8)
+    pixels[..., 0] = row_ramp
+    pixels[..., 1] = column_ramp
+    pixels[..., 2] = (row_ramp + column_ramp) / 2
+    pixels += generator.integers(0, 16, size=pixels.shape, dtype=np.uint8)
+    path = os.path.join(directory, f"synthetic_{megapixels}mp.jpg")
+    Image.fromarray(pixels).save(path, quality=90)
+    return path
+
+
+def measure(function, setup, repeat):
+    """
+    Time a function, taking the best of a number of runs, then measure its peak memory.
+
+    Parameter
+    ---------
+    function : function
+        called with what setup returns.
+    setup : function
+        called before every run, not timed.
+    repeat : int
+        the number of timed runs.
+    Return
+    ------
+    tuple
+        the best time in seconds and the peak bytes allocated during one more run.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        argument = setup()
+        start = time.perf_counter()
+        function(argument)
+        best = min(best, time.perf_counter() - start)
+    stats = StageStats(track_memory=True)
+    argument = setup()
+    with stats.stage("run"):
+        function(argument)
+    return best, stats.stages["run"]["peak_bytes"]
+
+
+def benchmark_image(path, operations, repeat, directory, threads=1):
+    """
+    Benchmark decode, encode and every operation on one image.
+
+    Parameter
+    ---------
+    path : string
+        the image to benchmark on.
+    operations : list of string
+        the operation codes to benchmark.
+    repeat : int
+        the number of timed runs of each, the best one is kept.
+    directory : string
+        a directory to write encoded images to.
+    threads : int
+        the number of threads the operations split the image over.
+    Return
+    ------
+    dict
+        "decode", "encode" and every code: dict of "seconds", "mp_per_s" and "peak_mb".
+    """
+    source = ImageO.open(path).infile
+    megapixels = source.shape[0] * source.shape[1] / 1e6
+    output_file = os.path.join(directory, "encoded.jpg")
+    cases = {"decode": (lambda input_file: ImageO.open(input_file).infile, lambda: path),
+             "encode": (lambda image: image.save(output_file),
+                        lambda: ImageO.from_array(source))}
+    for code in operations:
+        cases[code] = (lambda image, code=code: image.pipeline([(code, OPTIONS.get(code, {}))]),
+                       lambda: ImageO.from_array(source.copy()).set_threads(threads))
+    results = {}
+    for name, (function, setup) in cases.items():
+        seconds, peak_bytes = measure(function, setup, repeat)
+        results[name] = {"seconds": seconds, "mp_per_s": megapixels / seconds,
+                         "peak_mb": peak_bytes / 1024 / 1024}
+    return results
+
+
+def run_suite(sizes, images, operations, repeat, threads=1):
+    """
+    Benchmark every operation on synthetic images of the given sizes and on the given images.
+
+    Parameter
+    ---------
+    sizes : list of float
+        the megapixels of the synthetic images.
+    images : list of string
+        other images to benchmark on.
+    operations : list of string
+        the operation codes to benchmark.
+    repeat : int
+        the number of timed runs of each, the best one is kept.
+    threads : int
+        the number of threads the operations split the image over.
+    Return
+    ------
+    dict
+        image name: the results of benchmark_image for it.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        paths = {f"synthetic {size}MP": synthetic_image(size, directory)
+                 for size in sizes}
+        paths.update({path: path for path in images})
+        for name, path in paths.items():
+            results[name] = benchmark_image(path, operations, repeat, directory, threads)
+            print_results(name, results[name])
+    return results
+
+
+def print_results(name, results, baseline=None):
+    """
+    Print a table of the results for one image.
+
+    Parameter
+    ---------
+    name : string
+        the name of the image.
+    results : dict
+        the results of benchmark_image.
+    baseline : dict
+        the baseline results for the same image, to show the change against.
+    """
+    print(name)
+    print(f"  {'stage':8} {'seconds':>10} {'MP/s':>10} {'peak MB':>10} {'change':>9}"
+          f" {'peak':>9}")
+    for stage, numbers in results.items():
+        change = peak_change = ""
+        if baseline and stage in baseline:
+            change = f"{numbers['mp_per_s'] / baseline[stage]['mp_per_s'] - 1:+.1%}"
+            if baseline[stage].get("peak_mb"):
+                peak_change = f"{numbers['peak_mb'] / baseline[stage]['peak_mb'] - 1:+.1%}"
+        print(f"  {stage:8} {numbers['seconds']:>10.4f} {numbers['mp_per_s']:>10.1f}"
+              f" {numbers['peak_mb']:>10.1f} {change:>9} {peak_change:>9}")
+
+
+def find_regressions(results, baseline, threshold, memory_threshold=None):
+    """
+    Find every stage slower or using more memory than in the baseline by more than a threshold.
+
+    Parameter
+    ---------
+    results : dict
+        the results of run_suite.
+    baseline : dict
+        earlier results of run_suite to compare against.
+    threshold : float
+        how much slower is allowed, 0.1 for ten percent fewer megapixels a second.
+    memory_threshold : float
+        how much more peak memory is allowed, 0.1 for ten percent more, threshold when None. A
+        peak that grew by no more than PEAK_SLACK_MB is never a regression.
+    Return
+    ------
+    list of string
+        a message for every regression.
+    """
+    if memory_threshold is None:
+        memory_threshold = threshold
+    regressions = []
+    for name, stages in results.items():
+        for stage, numbers in stages.items():
+            before = baseline.get(name, {}).get(stage)
+            if before is None:
+                continue
+            change = numbers["mp_per_s"] / before["mp_per_s"] - 1
+            if change < -threshold:
+                regressions.append(f"{name} {stage}: {numbers['mp_per_s']:.1f} MP/s was"
+                                   f" {before['mp_per_s']:.1f} MP/s ({change:+.1%})")
+            # baselines saved before peak memory was measured have no peak_mb to compare.
+            if before.get("peak_mb") is None:
+                continue
+            growth = numbers["peak_mb"] - before["peak_mb"]
+            if growth > max(PEAK_SLACK_MB, memory_threshold * before["peak_mb"]):
+                regressions.append(f"{name} {stage}: peak {numbers['peak_mb']:.1f} MB was"
+                                   f" {before['peak_mb']:.1f} MB ({growth:+.1f} MB)")
+    return regressions
+
+
+def main(argv=None):
+    """
+    Run the benchmark command line.
+
+    Parameter
+    ---------
+    argv : list of string
+        the arguments to use, the ones the program was called with by default.
+    Return
+    ------
+    int
+        the exit status, 1 when there was a regression against the baseline.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the image manipulations.")
+    parser.add_argument("Image", nargs="*",
+                        help="Images to benchmark on, the bundled oregon_river ones by default.")
+    parser.add_argument("--ops", nargs="+", default=list(OPERATIONS), choices=list(OPERATIONS),
+                        help="The operation codes to benchmark, all of them by default.")
+    parser.add_argument("--sizes", type=float, nargs="*", default=SIZES, metavar="MP",
+                        help="Megapixels of the synthetic images, none to leave them out.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Timed runs of each stage, the best one is kept.")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Split the image over this many threads in the operations, compare"
+                             " with a baseline from one thread to see the speed up.")
+    parser.add_argument("--save-baseline", type=str, metavar="FILE",
+                        help="Save the results as JSON to compare later runs against.")
+    parser.add_argument("--baseline", type=str, metavar="FILE",
+                        help="Compare against saved results and exit with 1 on a regression.")
+    parser.add_argument("--threshold", type=float, default=0.15,
+                        help="How much slower than the baseline counts as a regression,"
+                             " 0.15 for fifteen percent fewer megapixels a second.")
+    parser.add_argument("--memory-threshold", type=float, metavar="THRESHOLD",
+                        help="How much more peak memory than the baseline counts as a"
+                             " regression, 0.15 for fifteen percent more, --threshold by"
+                             " default.")
+    parser.add_argument("--legacy", action="store_true",
+                        help="Time the operations against the per-pixel loops of the reference"
+                             " engine instead.")
+    parser.add_argument("--legacy-rows", type=int, default=0,
+                        help="Only time the per-pixel loops on this many rows, 0 for all rows.")
+    args = parser.parse_args(argv)
+
+    if args.legacy:
+        for path in args.Image or BUNDLED[:1]:
+            compare_legacy(path, args.ops, args.legacy_rows)
+        return 0
+
+    results = run_suite(args.sizes, args.Image or BUNDLED, args.ops, args.repeat, args.threads)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        print(f"compared to {args.baseline}")
+        for name, stages in results.items():
+            print_results(name, stages, baseline.get(name))
+        regressions = find_regressions(results, baseline, args.threshold, args.memory_threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
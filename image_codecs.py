@@ -0,0 +1,739 @@
+"""
+Read and save the images of the image_manipulation module.
+
+Works out the mode pixels are worked on in and the format and encoder settings an image is saved
+with, and reads and saves PNG, TIFF and raw formats such as PPM and BMP a band of rows at a time,
+so process_tiled never has the whole of a large image in memory.
+
+Joshua Shequin
+"""
+import functools
+import os
+import struct
+import zlib
+import numpy as np
+from PIL import Image
+
+
+def native_mode(image):
+    """
+    Find the mode the pixels of an image are worked on in.
+
+    Parameter
+    ---------
+    image : PIL Image
+        the image as read.
+    Return
+    ------
+    string
+        "L", "LA", "RGB", "RGBA" or "I;16" for 16 bit gray.
+    """
+    if image.mode in ("L", "LA", "RGB", "RGBA", "I;16"):
+        return image.mode
+    if image.mode.startswith("I"):
+        return "I;16"
+    if image.mode == "1":
+        return "L"
+    if image.mode == "La":
+        return "LA"
+    if image.mode == "P":
+        return "RGBA" if "transparency" in image.info else "RGB"
+    return "RGBA" if "A" in image.getbands() or "a" in image.getbands() else "RGB"
+
+
+def native_image(image):
+    """
+    Convert an image to the mode its pixels are worked on in, if it is not in it already.
+
+    Palette and bilevel images become color or gray ones, 16 and 32 bit gray become 16 bit gray,
+    and anything else becomes RGB or RGBA.
+
+    Parameter
+    ---------
+    image : PIL Image
+        the image as read.
+    Return
+    ------
+    PIL Image
+        the image in a mode from native_mode.
+    """
+    mode = native_mode(image)
+    return image if image.mode == mode else image.convert(mode)
+
+
+def to_image(pixels):
+    """
+    Turn a pixel array in to an image to save.
+
+    Parameter
+    ---------
+    pixels : numpy array
+        a (rows, columns) gray array, a (rows, columns, 2) gray and alpha array, or a (rows,
+        columns, channels) color array with alpha as a fourth channel. 8 or 16 bit values, PIL
+        can only hold 16 bit gray, so any other 16 bit array is saved as 8 bits.
+    Return
+    ------
+    PIL Image
+        an "L", "LA", "RGB", "RGBA" or "I;16" image.
+    """
+    return Image.fromarray(np.ascontiguousarray(saved_pixels(pixels)))
+
+
+def saved_pixels(pixels):
+    """
+    Turn a pixel array in to the values it is saved as, see to_image.
+
+    Parameter
+    ---------
+    pixels : numpy array
+        the pixel array.
+    Return
+    ------
+    numpy array
+        8 bit values with at most 4 channels, or 16 bit gray ones. The array itself when it is
+        already saved as it is.
+    """
+    if pixels.dtype == np.uint16 and pixels.ndim == 3:
+        pixels = (pixels >> 8).astype(np.uint8)
+    if pixels.ndim == 3 and pixels.shape[2] > 4:
+        pixels = pixels[..., :3]
+    return pixels
+
+
+# encoder settings for each format, for when speed or size matters more than the defaults.
+ENCODE_PRESETS = {
+    "fast": {"JPEG": {"quality": 85, "subsampling": "4:2:0", "optimize": False,
+                      "progressive": False},
+             "PNG": {"compress_level": 1},
+             "WEBP": {"quality": 80, "method": 0}},
+    "small": {"JPEG": {"quality": 75, "subsampling": "4:2:0", "optimize": True,
+                       "progressive": True},
+              "PNG": {"optimize": True},
+              "WEBP": {"quality": 75, "method": 6}},
+}
+
+
+def encode_format(output_file, image_format=None):
+    """
+    Work out the format an image will be saved in.
+
+    Parameter
+    ---------
+    output_file : string or file object
+        the file name to save to, or a file object.
+    image_format : string
+        the format asked for, if any.
+    Return
+    ------
+    string
+        the format name as PIL knows it such as "JPEG", PNG for a file object without a format,
+        or None when it can not be told from the file extension.
+    """
+    if image_format is None:
+        if not isinstance(output_file, (str, os.PathLike)):
+            return "PNG"
+        image_format = Image.registered_extensions().get(os.path.splitext(output_file)[1].lower())
+        if image_format is None:
+            return None
+    image_format = image_format.upper()
+    return "JPEG" if image_format == "JPG" else image_format
+
+
+def encode_options(output_file, encoding=None):
+    """
+    Work out the format and encoder settings an image will be saved with.
+
+    Parameter
+    ---------
+    output_file : string or file object
+        the file name to save to, or a file object.
+    encoding : dict
+        the encoder settings, see save_image.
+    Return
+    ------
+    tuple
+        the format name from encode_format and a dict of the settings to pass to its encoder,
+        those of the preset with the ones given on top.
+    """
+    encoding = dict(encoding or {})
+    image_format = encode_format(output_file, encoding.pop("format", None))
+    preset = encoding.pop("preset", None)
+    if preset is not None and preset not in ENCODE_PRESETS:
+        raise ValueError(f"unknown encode preset {preset!r}, use one of"
+                         f" {', '.join(ENCODE_PRESETS)}")
+    options = dict(ENCODE_PRESETS[preset].get(image_format, {})) if preset is not None else {}
+    options.update(encoding)
+    return image_format, options
+
+
+def save_image(image, output_file, encoding=None):
+    """
+    Save an image with encoder settings.
+
+    Parameter
+    ---------
+    image : PIL Image
+        the image to save.
+    output_file : string or file object
+        the file name to save to, or a file object opened for writing in binary.
+    encoding : dict
+        "format" such as "JPEG" or "PNG", by default from the file extension or PNG for a file
+        object, "preset" one of the ENCODE_PRESETS, and any other settings the encoder of the
+        format takes such as "quality", "subsampling", "optimize" or "progressive". Settings
+        given win over the preset.
+    """
+    image_format, options = encode_options(output_file, encoding)
+    if image_format == "JPEG" and image.mode in ("LA", "RGBA"):
+        # JPEG has no alpha, it is dropped rather than failing the save.
+        image = image.convert(image.mode[:-1])
+    image.save(output_file, format=image_format, **options)
+
+
+# modes process_tiled reads a band of rows at a time in, with the raw mode PNG keeps their rows in.
+PNG_BAND_MODES = {"L": "L", "LA": "LA", "RGB": "RGB", "RGBA": "RGBA", "I;16": "I;16B"}
+
+# bytes each pixel takes in the raw modes process_tiled reads a band of rows at a time in.
+RAW_PIXEL_BYTES = {"L": 1, "LA": 2, "RGB": 3, "BGR": 3, "RGBA": 4, "BGRA": 4, "RGBX": 4,
+                   "BGRX": 4, "I;16": 2, "I;16B": 2}
+
+# TIFF compressions process_tiled can read a strip at a time, all but packbits it can also write
+# a strip at a time: the PIL name to the number in the file, with None for no compression.
+TIFF_BAND_COMPRESSIONS = {None: 1, "raw": 1, "tiff_adobe_deflate": 8, "tiff_deflate": 32946,
+                          "packbits": 32773}
+
+# rough number of bytes in a TIFF strip written a band at a time, the same as PIL writes.
+TIFF_STRIP_BYTES = 64 * 1024
+
+# PNG color type for the number of channels.
+PNG_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+# rough number of bytes of rows filtered at a time when a PNG is saved a band at a time.
+PNG_STRIP_BYTES = 256 * 1024
+
+
+def _next_idat(source, position):
+    """
+    Read the next image data chunk of a PNG.
+
+    Parameter
+    ---------
+    source : file object
+        the PNG file opened for reading in binary.
+    position : int
+        the file offset of the chunk to start looking at, None after the last one.
+    Return
+    ------
+    tuple
+        the compressed data in the chunk, empty when there is none left, and the file offset of
+        the chunk after it, None after the last one.
+    """
+    while position is not None:
+        source.seek(position)
+        length, kind = struct.unpack(">I4s", source.read(8))
+        position += 12 + length
+        if kind == b"IEND":
+            return b"", None
+        if kind == b"IDAT":
+            return source.read(length), position
+    return b"", None
+
+
+def _png_band_reader(input_file, image):
+    """
+    Read a PNG that is not interlaced a band of rows at a time from the top down.
+
+    Only as much of the compressed data is inflated as the band needs. PIL unfilters the band
+    with the last row of the band before it put in front, unfiltered.
+
+    Parameter
+    ---------
+    input_file : string
+        the PNG file.
+    image : PIL Image
+        the image opened from it, in a mode from PNG_BAND_MODES.
+    Return
+    ------
+    function
+        see band_reader.
+    """
+    mode, columns = image.mode, image.size[0]
+    depth = 2 if mode == "I;16" else 1
+    row_bytes = columns * len(image.getbands()) * depth
+    decompressor = zlib.decompressobj()
+    # the inflated rows not read yet, each after a byte for the filter it is stored with.
+    rest = bytearray()
+    # the compressed data not inflated yet, the file offset of the next chunk and the last row
+    # read, unfiltered.
+    data, position, previous = b"", 8, bytes(row_bytes)
+
+    def read(start, stop):
+        nonlocal data, position, previous
+        need = (stop - start) * (row_bytes + 1)
+        with open(input_file, "rb") as source:
+            while len(rest) < need:
+                if not data:
+                    data, position = _next_idat(source, position)
+                piece = decompressor.decompress(data, need - len(rest))
+                data = decompressor.unconsumed_tail
+                if not piece and not data and position is None:
+                    raise ValueError(f"{input_file} ends before its last row")
+                rest.extend(piece)
+        filtered = b"\0" + previous + bytes(rest[:need])
+        del rest[:need]
+        band = Image.frombytes(mode, (columns, stop - start + 1), zlib.compress(filtered, 0),
+                               "zip", PNG_BAND_MODES[mode])
+        pixels = np.array(band)[1:]
+        previous = pixels[-1].astype(f">u{depth}").tobytes()
+        return pixels
+    return read
+
+
+def _raw_band_reader(input_file, image):
+    """
+    Read an image kept as raw rows, such as PPM or BMP, a band at a time.
+
+    Parameter
+    ---------
+    input_file : string
+        the file.
+    image : PIL Image
+        the image opened from it.
+    Return
+    ------
+    function or None
+        see band_reader.
+    """
+    if len(image.tile) != 1 or image.mode not in RAW_PIXEL_BYTES:
+        return None
+    codec, extents, offset, args = image.tile[0]
+    columns, rows = image.size
+    if codec != "raw" or tuple(extents) != (0, 0, columns, rows):
+        return None
+    # the raw mode may be given on its own or with the bytes between rows and the row order.
+    args = (args,) if isinstance(args, str) else tuple(args)
+    rawmode, stride, step = args + (0, 1)[len(args) - 1:]
+    if rawmode not in RAW_PIXEL_BYTES:
+        return None
+    stride = stride or columns * RAW_PIXEL_BYTES[rawmode]
+
+    def read(start, stop):
+        # a file kept bottom up, such as most BMP, has the last row first.
+        first = start if step > 0 else rows - stop
+        with open(input_file, "rb") as source:
+            source.seek(offset + first * stride)
+            data = source.read((stop - start) * stride)
+        band = Image.frombytes(image.mode, (columns, stop - start), data, "raw", rawmode, stride,
+                               step)
+        return np.array(native_image(band))
+    return read
+
+
+def _tiff_strip(data, compression, row_bytes, rows):
+    """
+    Uncompress a TIFF strip.
+
+    Parameter
+    ---------
+    data : bytes
+        the strip as kept in the file.
+    compression : int
+        the compression number from TIFF_BAND_COMPRESSIONS.
+    row_bytes : int
+        the number of bytes in a row.
+    rows : int
+        the number of rows in the strip.
+    Return
+    ------
+    bytes
+        the rows of the strip.
+    """
+    if compression in (8, 32946):
+        return zlib.decompress(data)
+    if compression == 32773:
+        return Image.frombytes("L", (row_bytes, rows), data, "packbits", "L").tobytes()
+    return data
+
+
+def _tiff_in_strips(image):
+    """
+    Check if a TIFF is kept in a way _tiff_band_reader can read.
+
+    Parameter
+    ---------
+    image : PIL Image
+        the TIFF image, not loaded.
+    Return
+    ------
+    bool
+        True for 8 bit or 16 bit gray or color kept in strips, with the channels of a pixel
+        together and a compression from TIFF_BAND_COMPRESSIONS.
+    """
+    tags = image.tag_v2
+    bits = 16 if image.mode.startswith("I;16") else 8
+    # the tags are the strip offsets, planar configuration, compression, predictor, photometric
+    # interpretation, samples per pixel and bits per sample.
+    return all((image.mode in RAW_PIXEL_BYTES, 273 in tags, tags.get(284, 1) == 1,
+                tags.get(259, 1) in TIFF_BAND_COMPRESSIONS.values(),
+                tags.get(317, 1) in (1, 2), tags.get(262) in (1, 2),
+                tags.get(277, 1) == len(image.getbands()),
+                all(value == bits for value in np.atleast_1d(tags.get(258, 1)))))
+
+
+def _tiff_band_reader(input_file, image):
+    """
+    Read a TIFF kept in strips a band at a time.
+
+    Parameter
+    ---------
+    input_file : string
+        the file.
+    image : PIL Image
+        the image opened from it.
+    Return
+    ------
+    function or None
+        see band_reader.
+    """
+    if not _tiff_in_strips(image):
+        return None
+    tags = image.tag_v2
+    columns, rows = image.size
+    samples = len(image.getbands())
+    strip_rows = min(tags.get(278, rows), rows)
+    if image.mode.startswith("I;16"):
+        dtype = np.dtype(">u2" if image.mode == "I;16B" else "<u2")
+    else:
+        dtype = np.dtype(np.uint8)
+
+    def read(start, stop):
+        first, last = start // strip_rows, (stop - 1) // strip_rows
+        strips = []
+        with open(input_file, "rb") as source:
+            for strip in range(first, last + 1):
+                height = min(strip_rows, rows - strip * strip_rows)
+                source.seek(tags[273][strip])
+                data = _tiff_strip(source.read(tags[279][strip]), tags.get(259, 1),
+                                   columns * samples * dtype.itemsize, height)
+                pixels = np.frombuffer(data, dtype, height * columns * samples)
+                pixels = pixels.reshape(height, columns, samples)
+                if tags.get(317, 1) == 2:
+                    # each value is kept as the change from the one to its left.
+                    pixels = np.cumsum(pixels, axis=1, dtype=dtype)
+                strips.append(pixels)
+        band = np.concatenate(strips)[start - first * strip_rows:stop - first * strip_rows]
+        band = band.astype(np.uint16 if dtype.itemsize == 2 else np.uint8)
+        return band[..., 0] if samples == 1 else band
+    return read
+
+
+def band_reader(input_file, image):
+    """
+    Find a way to read an image a band of rows at a time without decoding the whole of it.
+
+    Parameter
+    ---------
+    input_file : string or file object
+        the file the image is read from.
+    image : PIL Image
+        the image opened from it, not loaded.
+    Return
+    ------
+    function or None
+        called with the start and stop rows of a band gives back its pixels in the mode from
+        native_mode, the bands read from the top down one after another. None when the image
+        has to be decoded whole, such as JPEG, interlaced PNG, LZW compressed TIFF or any image
+        in a file object.
+    """
+    if not isinstance(input_file, (str, os.PathLike)):
+        return None
+    if image.format == "PNG":
+        if (image.mode not in PNG_BAND_MODES or image.info.get("interlace")
+                or getattr(image, "n_frames", 1) > 1
+                or image.tile[0][3] != PNG_BAND_MODES[image.mode]):
+            return None
+        return _png_band_reader(input_file, image)
+    if image.format == "TIFF":
+        return _tiff_band_reader(input_file, image)
+    return _raw_band_reader(input_file, image)
+
+
+def _paeth(left, above, above_left):
+    """
+    Predict bytes of a PNG row the way its paeth filter does.
+
+    Parameter
+    ---------
+    left : numpy array
+        the 8 bit values one pixel to the left of each byte, zeros at the start of a row.
+    above : numpy array
+        the values one row up.
+    above_left : numpy array
+        the values one row up and one pixel to the left.
+    Return
+    ------
+    numpy array
+        whichever of left, above and above left is nearest to left + above - above left.
+    """
+    wide_left, wide_above, wide_above_left = (left.astype(np.int16), above.astype(np.int16),
+                                              above_left.astype(np.int16))
+    to_left = np.abs(wide_above - wide_above_left)
+    to_above = np.abs(wide_left - wide_above_left)
+    to_above_left = np.abs(wide_left + wide_above - 2 * wide_above_left)
+    return np.where((to_left <= to_above) & (to_left <= to_above_left), left,
+                    np.where(to_above <= to_above_left, above, above_left))
+
+
+def _png_filter(rows, previous, pixel_bytes):
+    """
+    Filter rows of a PNG with whichever filter leaves the smallest values, as PIL does.
+
+    Parameter
+    ---------
+    rows : numpy array
+        the (rows, bytes) array of the rows to filter, 8 bit.
+    previous : numpy array
+        the 8 bit row above the first, zeros for the top of the image.
+    pixel_bytes : int
+        the number of bytes in a pixel.
+    Return
+    ------
+    bytes
+        the filtered rows, each after the byte of the filter it is stored with.
+    """
+    above = np.vstack([previous[np.newaxis], rows[:-1]])
+    left = np.zeros_like(rows)
+    left[:, pixel_bytes:] = rows[:, :-pixel_bytes]
+    above_left = np.zeros_like(rows)
+    above_left[:, pixel_bytes:] = above[:, :-pixel_bytes]
+    average = (left >> 1) + (above >> 1) + (left & above & 1)
+    # values wrap around as the PNG filters do.
+    filtered = [rows, rows - left, rows - above, rows - average,
+                rows - _paeth(left, above, above_left)]
+    # the bytes are summed as signed ones to pick the filter, as libpng and PIL do.
+    choice = np.argmin([np.minimum(values, -values).sum(axis=1, dtype=np.uint32)
+                        for values in filtered], axis=0)
+    result = np.empty((len(rows), rows.shape[1] + 1), np.uint8)
+    result[:, 0] = choice
+    result[:, 1:] = rows
+    for kind in range(1, len(filtered)):
+        result[choice == kind, 1:] = filtered[kind][choice == kind]
+    return result.tobytes()
+
+
+class _PngBands:
+    """
+    A PNG file written a band of rows at a time, filtered and compressed the way PIL does it.
+
+    Bands are given to write from the top down, then finish writes the end of the file.
+    """
+
+    def __init__(self, output, rows, pixels, level=6):
+        """
+        Initialize by writing the header.
+
+        Parameter
+        ---------
+        output : file object
+            the file to write to, opened for writing in binary.
+        rows : int
+            the height of the image.
+        pixels : numpy array
+            a band of the image, for its width, channels and depth, see to_image.
+        level : int
+            the zlib compression level.
+        """
+        pixels = saved_pixels(pixels)
+        self.depth = pixels.dtype.itemsize
+        self.channels = 1 if pixels.ndim == 2 else pixels.shape[2]
+        self.row_bytes = pixels.shape[1] * self.channels * self.depth
+        self.previous = np.zeros(self.row_bytes, np.uint8)
+        self.compressor = zlib.compressobj(level)
+        self.output = output
+        self.output.write(b"\x89PNG\r\n\x1a\n")
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", pixels.shape[1], rows, 8 * self.depth,
+                                         PNG_COLOR_TYPES[self.channels], 0, 0, 0))
+
+    def _chunk(self, kind, data):
+        """
+        Write a chunk of the file.
+
+        Parameter
+        ---------
+        kind : bytes
+            the four letter chunk type.
+        data : bytes
+            what is in the chunk.
+        """
+        self.output.write(struct.pack(">I", len(data)) + kind + data)
+        self.output.write(struct.pack(">I", zlib.crc32(kind + data)))
+
+    def write(self, pixels):
+        """
+        Write the next band of rows.
+
+        Parameter
+        ---------
+        pixels : numpy array
+            the pixels of the band.
+        """
+        pixels = saved_pixels(pixels).astype(f">u{self.depth}")
+        rows = pixels.view(np.uint8).reshape(len(pixels), self.row_bytes)
+        step = max(1, PNG_STRIP_BYTES // self.row_bytes)
+        for top in range(0, len(rows), step):
+            strip = rows[top:top + step]
+            data = self.compressor.compress(_png_filter(strip, self.previous,
+                                                        self.channels * self.depth))
+            if data:
+                self._chunk(b"IDAT", data)
+            self.previous = strip[-1]
+
+    def finish(self):
+        """Write the end of the file."""
+        self._chunk(b"IDAT", self.compressor.flush())
+        self._chunk(b"IEND", b"")
+
+
+def _tiff_directory(entries, offset):
+    """
+    Make a little endian TIFF image file directory.
+
+    Parameter
+    ---------
+    entries : list of tuple
+        the (tag, type, values) of every entry, type 3 for 16 and 4 for 32 bit values.
+    offset : int
+        where in the file the directory goes.
+    Return
+    ------
+    bytes
+        the directory with the values too long to fit in an entry after it.
+    """
+    extra_offset = offset + 2 + 12 * len(entries) + 4
+    head, extra = [struct.pack("<H", len(entries))], []
+    for tag, kind, values in sorted(entries):
+        data = struct.pack(f"<{len(values)}{'H' if kind == 3 else 'I'}", *values)
+        if len(data) <= 4:
+            head.append(struct.pack("<HHI", tag, kind, len(values)) + data.ljust(4, b"\0"))
+        else:
+            head.append(struct.pack("<HHII", tag, kind, len(values),
+                                    extra_offset + sum(len(part) for part in extra)))
+            extra.append(data)
+    return b"".join(head) + struct.pack("<I", 0) + b"".join(extra)
+
+
+class _TiffBands:
+    """
+    A TIFF file written a band of rows at a time, in strips of about TIFF_STRIP_BYTES.
+
+    Bands are given to write from the top down, then finish writes the directory of the image.
+    """
+
+    def __init__(self, output, rows, pixels, compression=1):
+        """
+        Initialize by writing the header.
+
+        Parameter
+        ---------
+        output : file object
+            the file to write to, opened for writing in binary and able to seek.
+        rows : int
+            the height of the image.
+        pixels : numpy array
+            a band of the image, for its width, channels and depth, see to_image.
+        compression : int
+            the compression number from TIFF_BAND_COMPRESSIONS, 1 for none or 8 or 32946 for
+            deflate.
+        """
+        pixels = saved_pixels(pixels)
+        columns, depth = pixels.shape[1], pixels.dtype.itemsize
+        channels = 1 if pixels.ndim == 2 else pixels.shape[2]
+        strip_rows = max(1, TIFF_STRIP_BYTES // (columns * channels * depth))
+        # the entries of the directory other than where the strips are.
+        self.entries = [(256, 4, [columns]), (257, 4, [rows]), (258, 3, [8 * depth] * channels),
+                        (259, 3, [compression]), (262, 3, [2 if channels >= 3 else 1]),
+                        (277, 3, [channels]), (278, 4, [strip_rows]), (284, 3, [1])]
+        if channels in (2, 4):
+            # the last channel is alpha that the colors are not multiplied by.
+            self.entries.append((338, 3, [2]))
+        self.dtype = f"<u{depth}"
+        self.compression = compression
+        self.strip_bytes = strip_rows * columns * channels * depth
+        # the (offset, length) of every strip written.
+        self.strips = []
+        # rows written that do not fill a strip yet.
+        self.pending = bytearray()
+        self.output = output
+        # the offset of the directory is filled in once the strips are written.
+        self.output.write(b"II*\0\0\0\0\0")
+
+    def _strip(self, data):
+        """
+        Write a strip.
+
+        Parameter
+        ---------
+        data : bytes
+            the rows of the strip.
+        """
+        if self.compression != 1:
+            data = zlib.compress(data)
+        self.strips.append((self.output.tell(), len(data)))
+        self.output.write(data)
+
+    def write(self, pixels):
+        """
+        Write the next band of rows.
+
+        Parameter
+        ---------
+        pixels : numpy array
+            the pixels of the band.
+        """
+        self.pending += saved_pixels(pixels).astype(self.dtype).tobytes()
+        while len(self.pending) >= self.strip_bytes:
+            self._strip(bytes(self.pending[:self.strip_bytes]))
+            del self.pending[:self.strip_bytes]
+
+    def finish(self):
+        """Write the last strip and the directory."""
+        if self.pending:
+            self._strip(bytes(self.pending))
+        if self.output.tell() % 2:
+            self.output.write(b"\0")
+        offset = self.output.tell()
+        offsets, counts = zip(*self.strips)
+        entries = self.entries + [(273, 4, list(offsets)), (279, 4, list(counts))]
+        self.output.write(_tiff_directory(entries, offset))
+        self.output.seek(4)
+        self.output.write(struct.pack("<I", offset))
+
+
+def band_writer(output_file, encoding=None):
+    """
+    Find a way to save an image a band of rows at a time.
+
+    Parameter
+    ---------
+    output_file : string or file object
+        the file to save to.
+    encoding : dict
+        the encoder settings, see save_image.
+    Return
+    ------
+    function or None
+        called with the file opened for writing in binary, the height of the image and its first
+        band gives back a writer with a write method to call with every band from the top down
+        and finish to call after the last. None when the image has to be saved whole, for
+        formats other than PNG and TIFF, settings such as an LZW compressed TIFF, or a file
+        object.
+    """
+    if not isinstance(output_file, (str, os.PathLike)):
+        return None
+    image_format, options = encode_options(output_file, encoding)
+    if image_format == "PNG" and set(options) <= {"compress_level", "optimize"}:
+        level = 9 if options.get("optimize") else options.get("compress_level", 6)
+        return functools.partial(_PngBands, level=level)
+    compression = TIFF_BAND_COMPRESSIONS.get(options.get("compression"))
+    if image_format == "TIFF" and set(options) <= {"compression"} and compression in (1, 8, 32946):
+        return functools.partial(_TiffBands, compression=compression)
+    return None
@@ -24,18 +24,40 @@ this module from the command line with the proper options.
 
 Joshua Shequin
 """
+# pylint: disable=too-many-lines
 import argparse
+import asyncio
+import bisect
+import collections
+import contextlib
+import functools
+import glob
+import hashlib
+import io
+import json
+import os
+import socket
+import socketserver
+import stat
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
-from PIL import Image
+from PIL import GifImagePlugin, Image, TiffImagePlugin
+from image_codecs import (ENCODE_PRESETS, band_reader, band_writer, encode_format,
+                          native_image, native_mode, save_image, to_image)
 
 
 def common_denominator(number_one, number_two, range_one, range_two):
     """
-    Recursion solution to this problem even though it is not the best way of doing it.
+    Find the largest number in a range that both numbers are divisible by.
 
-    Base case is when the modulo of both numbers and the second range value is zero,
-    or if they are the same.
+    Counts down from the second range value and stops at the first value that divides both
+    numbers, or at the first range value if none do.
 
     Parameters
     ----------
@@ -55,342 +77,4251 @@ def common_denominator(number_one, number_two, range_one, range_two):
         in the range given if no denominator was found.
 
     """
-    if number_one % range_two == 0 and number_two % range_two == 0:
-        return range_two
-    if range_one == range_two:
-        return range_one
-    return common_denominator(number_one, number_two, range_one, range_two-1)
+    for candidate in range(range_two, range_one, -1):
+        if number_one % candidate == 0 and number_two % candidate == 0:
+            return candidate
+    return range_one
 
 
-class ImageO:
+def _block_runs(length, block_length=None, number_of_blocks=None):
+    """
+    Split a length of pixels in to runs of same sized blocks.
+
+    Either the length of a block or the number of blocks is given. With a block length every block
+    is that long apart from a shorter one at the end when it does not divide evenly. With a number
+    of blocks the leftover pixels are spread one each over the first blocks.
+
+    Parameter
+    ---------
+    length : int
+        the number of pixels to split up.
+    block_length : int
+        the number of pixels in a block.
+    number_of_blocks : int
+        the number of blocks to split the pixels in to.
+    Return
+    ------
+    list of tuple
+        (start, block length, number of blocks) for every run, together covering all pixels.
+    """
+    if number_of_blocks is not None:
+        if number_of_blocks < 1:
+            raise ValueError(f"the number of blocks has to be 1 or more, not {number_of_blocks}")
+        number_of_blocks = min(number_of_blocks, length)
+        block_length, longer_blocks = divmod(length, number_of_blocks)
+        runs = [(0, block_length + 1, longer_blocks),
+                (longer_blocks * (block_length + 1), block_length,
+                 number_of_blocks - longer_blocks)]
+    elif block_length is not None:
+        if block_length < 1:
+            raise ValueError(f"the block length has to be 1 or more, not {block_length}")
+        block_length = min(block_length, length)
+        full_blocks = length // block_length
+        runs = [(0, block_length, full_blocks),
+                (full_blocks * block_length, length - full_blocks * block_length, 1)]
+    else:
+        raise ValueError("either a block length or a number of blocks is needed")
+    return [run for run in runs if run[1] > 0 and run[2] > 0]
+
+
+def _block_layout(rows, columns, block_size=None, number_of_blocks=None):
+    """
+    Work out the blocks block_image uses for an image of the given size.
+
+    Parameter
+    ---------
+    rows : int
+        the height of the image.
+    columns : int
+        the width of the image.
+    block_size : int or tuple of int
+        the (height, width) of every block, or one int for square blocks.
+    number_of_blocks : int or tuple of int
+        the number of (rows, columns) of blocks, or one int for both.
+    Return
+    ------
+    tuple
+        the runs of block rows and the runs of block columns, as returned by _block_runs.
+    """
+    for value in (block_size, number_of_blocks):
+        if value is not None and np.size(value) not in (1, 2):
+            raise ValueError("block sizes and numbers of blocks take one or two values, not "
+                             f"{np.size(value)}")
+    if block_size is not None:
+        block_height, block_width = np.broadcast_to(block_size, 2)
+        return (_block_runs(rows, block_length=int(block_height)),
+                _block_runs(columns, block_length=int(block_width)))
+    if number_of_blocks is not None:
+        block_rows, block_columns = np.broadcast_to(number_of_blocks, 2)
+        return (_block_runs(rows, number_of_blocks=int(block_rows)),
+                _block_runs(columns, number_of_blocks=int(block_columns)))
+    number_of_blocks = common_denominator(rows, columns, 2, 100)
+    # any rows or columns left over after the blocks are not in a run and so left as they are,
+    # an image narrower than the number of blocks has no blocks at all.
+    return ([(0, rows // number_of_blocks, number_of_blocks)] if rows >= number_of_blocks else [],
+            [(0, columns // number_of_blocks, number_of_blocks)]
+            if columns >= number_of_blocks else [])
+
+
+def _runs_within(runs, start, stop):
+    """
+    Cut runs of blocks down to the blocks that sit wholly between two positions.
+
+    Parameter
+    ---------
+    runs : list of tuple
+        the runs of blocks, as returned by _block_runs.
+    start : int
+        the first position to keep.
+    stop : int
+        the position after the last one to keep.
+    Return
+    ------
+    list of tuple
+        the runs of blocks inside, with their starts counted from start.
+    """
+    inside = []
+    for run_start, length, count in runs:
+        first = max(0, -(-(start - run_start) // length))
+        last = min(count, (stop - run_start) // length)
+        if last > first:
+            inside.append((run_start + first * length - start, length, last - first))
+    return inside
+
+
+def _block_starts(runs):
+    """
+    Find every position a block of some runs starts or ends at.
+
+    Parameter
+    ---------
+    runs : list of tuple
+        the runs of blocks, as returned by _block_runs.
+    Return
+    ------
+    set of int
+        the positions a band of the image can start at without cutting through a block.
+    """
+    return {run_start + block * length for run_start, length, count in runs
+            for block in range(count + 1)}
+
+
+def _color(pixels):
+    """
+    Get the color channels of a pixel array, leaving out any alpha channel.
+
+    Parameter
+    ---------
+    pixels : numpy array
+        a (rows, columns) gray array, a (rows, columns, 2) gray and alpha array, or a (rows,
+        columns, channels) array with three colors and maybe alpha.
+    Return
+    ------
+    numpy array
+        a view of just the colors, the whole array for a (rows, columns) gray array.
+    """
+    if pixels.ndim == 2:
+        return pixels
+    return pixels[..., :1] if pixels.shape[2] == 2 else pixels[..., :3]
+
+
+def _region_boxes(region, columns, rows):
+    """
+    Read the boxes of a region, cut down to the image.
+
+    Parameter
+    ---------
+    region : tuple or list of tuple
+        a (left, top, right, bottom) box, right and bottom not included as in PIL, or a list of
+        them. Numbers that are not whole are rounded down to a pixel.
+    columns : int
+        the width of the image.
+    rows : int
+        the height of the image.
+    Return
+    ------
+    list of tuple
+        the boxes that have any pixels inside the image, cut down to it.
+    """
+    def is_number(value):
+        return isinstance(value, (int, float, np.integer, np.floating))
+
+    if not isinstance(region, (tuple, list, np.ndarray)):
+        raise ValueError(f"a region has to be a box or a list of boxes, not {region!r}")
+    if len(region) == 4 and all(is_number(value) for value in region):
+        region = [region]
+    boxes = []
+    for box in region:
+        if (not isinstance(box, (tuple, list, np.ndarray)) or len(box) != 4 or
+                not all(is_number(value) for value in box)):
+            raise ValueError("a region box has to be four numbers (left, top, right, bottom), not"
+                             f" {box!r}")
+        left, top = max(0, int(box[0] // 1)), max(0, int(box[1] // 1))
+        right, bottom = min(columns, int(box[2] // 1)), min(rows, int(box[3] // 1))
+        if right > left and bottom > top:
+            boxes.append((left, top, right, bottom))
+    return boxes
+
+
+def _disjoint_boxes(boxes):
+    """
+    Split boxes that overlap in to boxes that cover the same pixels without overlapping.
+
+    Parameter
+    ---------
+    boxes : list of tuple
+        (left, top, right, bottom) boxes.
+    Return
+    ------
+    list of tuple
+        boxes where no pixel is in more than one.
+    """
+    disjoint = []
+    for box in boxes:
+        pieces = [box]
+        for other in disjoint:
+            cut = []
+            for left, top, right, bottom in pieces:
+                if (other[0] >= right or other[2] <= left or other[1] >= bottom or
+                        other[3] <= top):
+                    cut.append((left, top, right, bottom))
+                    continue
+                # the parts of the piece above, below, left and right of the other box.
+                middle_top, middle_bottom = max(top, other[1]), min(bottom, other[3])
+                cut.extend(piece for piece in (
+                    (left, top, right, middle_top),
+                    (left, middle_bottom, right, bottom),
+                    (left, middle_top, max(left, other[0]), middle_bottom),
+                    (min(right, other[2]), middle_top, right, middle_bottom))
+                    if piece[2] > piece[0] and piece[3] > piece[1])
+            pieces = cut
+        disjoint.extend(pieces)
+    return disjoint
+
+
+def _is_gray(pixels):
+    """
+    Check if a pixel array is a gray image, with or without alpha.
+
+    Parameter
+    ---------
+    pixels : numpy array
+        the pixel array.
+    Return
+    ------
+    bool
+        True for a (rows, columns) or (rows, columns, 2) array.
+    """
+    return pixels.ndim == 2 or pixels.shape[2] == 2
+
+
+def _gray_to_color(pixels):
+    """
+    Turn a gray pixel array in to a color one with the gray in all three colors, keeping alpha.
+
+    Parameter
+    ---------
+    pixels : numpy array
+        the pixel array.
+    Return
+    ------
+    numpy array
+        a new (rows, columns, 3) or (rows, columns, 4) array for a gray image, else pixels itself.
+    """
+    if pixels.ndim == 2:
+        return np.repeat(pixels[..., np.newaxis], 3, axis=2)
+    if pixels.shape[2] == 2:
+        return pixels[..., [0, 0, 0, 1]]
+    return pixels
+
+
+def _scale_runs(runs, scale):
+    """
+    Scale runs of blocks down for an image that is scale times smaller.
+
+    Parameter
+    ---------
+    runs : list of tuple
+        the runs of blocks, as returned by _block_runs, every start and length a multiple of scale.
+    scale : int
+        how many times smaller the image is.
+    Return
+    ------
+    list of tuple
+        the runs of blocks in the smaller image.
+    """
+    return [(start // scale, length // scale, count) for start, length, count in runs]
+
+
+def _clear_channels(channels, pixels):
+    """
+    Zero out the given channels of a pixel array in place.
+
+    Parameter
+    ---------
+    channels : tuple of int
+        the indexes of the channels to set to zero.
+    pixels : numpy array
+        the (rows, columns, channels) array to change.
+    """
+    for channel in channels:
+        pixels[..., channel] = 0
+
+
+def _lower_half(pixels):
+    """
+    Halve every color value of a pixel array in place, truncating like the uint8 store does.
+
+    Parameter
+    ---------
+    pixels : numpy array
+        the (rows, columns, channels) array to change.
+    """
+    color = _color(pixels)
+    np.right_shift(color, 1, out=color)
+
+
+def _upper_half(pixels):
+    """
+    Halve every color value of a pixel array in place and move it to the upper half of the range.
+
+    Parameter
+    ---------
+    pixels : numpy array
+        the (rows, columns, channels) array to change, 128 is added for 8 bits and 32768 for 16.
+    """
+    color = _color(pixels)
+    np.right_shift(color, 1, out=color)
+    # the halved value is at most half the largest value so adding half can never overflow.
+    np.add(color, (int(np.iinfo(color.dtype).max) >> 1) + 1, out=color)
+
+
+def _equal_gray_tables():
+    """
+    Build the tables that give the gray of (r * (1/3)) + (g * (1/3)) + (b * (1/3)), truncated.
+
+    That float sum is not always the floored average as a third in floating point is a little
+    under a third, so some sums that divide evenly come out one lower. Only 828 different values
+    come out of the red plus green part, so every result is in an 828 row by 256 blue table and
+    the row for every red and green pair is in a second table. Looking both up gives the exact
+    same grays with integers only.
+
+    Return
+    ------
+    tuple of numpy array
+        the start of the row in the gray table for red * 256 + green, and the gray table.
+    """
+    red, green = np.meshgrid(np.arange(256), np.arange(256), indexing="ij")
+    red_green, rows = np.unique((red * (1 / 3)) + (green * (1 / 3)), return_inverse=True)
+    grays = (red_green[:, np.newaxis] + (np.arange(256) * (1 / 3))).astype(np.uint8)
+    return (rows.reshape(-1) * 256).astype(np.uint32), grays.reshape(-1)
+
+
+_EQUAL_GRAY_ROWS, _EQUAL_GRAY = _equal_gray_tables()
+
+# 0.299, 0.587 and 0.114 in 65536ths, adding up to exactly 65536.
+LUMA_WEIGHTS = (19595, 38470, 7471)
+
+
+def _gray_values(pixels, weights="equal"):
+    """
+    Work out the gray value of every pixel using integer math only.
+
+    Parameter
+    ---------
+    pixels : numpy array
+        the (rows, columns, channels) array to read.
+    weights : string
+        "equal" for the average of the three colors, the same values the float version gives, or
+        "luma" for 0.299 red, 0.587 green and 0.114 blue rounded to the nearest value.
+    Return
+    ------
+    numpy array
+        the (rows, columns) gray values, of the same type as pixels.
+    """
+    color = pixels[..., :3]
+    if weights == "equal" and color.dtype != np.uint8:
+        # the tables are only for 8 bits, deeper values get the floored average.
+        total = color.sum(axis=2, dtype=np.uint32)
+        total //= 3
+        return total.astype(color.dtype)
+    if weights == "equal":
+        index = color[..., 0].astype(np.uint16)
+        index <<= 8
+        index |= color[..., 1]
+        index = np.take(_EQUAL_GRAY_ROWS, index)
+        index += color[..., 2]
+        return np.take(_EQUAL_GRAY, index)
+    if weights == "luma":
+        total = np.multiply(color[..., 0], LUMA_WEIGHTS[0], dtype=np.uint32)
+        total += np.multiply(color[..., 1], LUMA_WEIGHTS[1], dtype=np.uint32)
+        total += np.multiply(color[..., 2], LUMA_WEIGHTS[2], dtype=np.uint32)
+        total += 1 << 15
+        total >>= 16
+        return total.astype(color.dtype)
+    raise ValueError(f"gray weights have to be 'equal' or 'luma', not {weights!r}")
+
+
+def _gray_scale(pixels, weights="equal"):
+    """
+    Replace every color value of a pixel array in place with the gray value of its pixel.
+
+    Parameter
+    ---------
+    pixels : numpy array
+        the (rows, columns, channels) array to change.
+    weights : string
+        how to weigh the colors, as taken by _gray_values.
+    """
+    if _is_gray(pixels):
+        # already a single channel gray image.
+        return
+    pixels[..., :3] = _gray_values(pixels, weights)[..., np.newaxis]
+
+
+def _invert_color(pixels):
+    """
+    Invert every color value of a pixel array in place.
+
+    Parameter
+    ---------
+    pixels : numpy array
+        the (rows, columns, channels) array to change.
+    """
+    color = _color(pixels)
+    # for unsigned values flipping every bit is the largest value minus the value.
+    np.invert(color, out=color)
+
+
+def _average_run(band, block_height, row_sums, column_run):
+    """
+    Set every pixel of a run of same sized blocks to the floored average of its block.
+
+    Parameter
+    ---------
+    band : numpy array
+        the (rows, columns, channels) rows of one run of block rows, changed in place.
+    block_height : int
+        the height of the blocks in the band.
+    row_sums : numpy array
+        the band summed over the rows of each block, (block rows, columns, channels).
+    column_run : tuple
+        the (start, block width, number of blocks) run of block columns, from _block_runs.
+    """
+    column_start, block_width, block_columns = column_run
+    column_stop = column_start + block_width * block_columns
+    block_rows, channels = row_sums.shape[0], row_sums.shape[2]
+    block_sums = row_sums[:, column_start:column_stop].reshape(
+        block_rows, block_columns, block_width, channels).sum(axis=2)
+    # splitting the row and column axes in to (block, pixel in block) is always a view, so
+    # writing to blocks writes straight back in to the band.
+    blocks = band[:, column_start:column_stop].reshape(
+        block_rows, block_height, block_columns, block_width, channels)
+    blocks[...] = (block_sums // (block_height * block_width))[:, np.newaxis, :, np.newaxis, :]
+
+
+def _block_average(pixels, row_runs, column_runs):
+    """
+    Set every pixel of each block to the floored average of the block, only changing colors.
+
+    The blocks are given as runs from _block_runs, each run of same sized blocks is summed with
+    a single reshape so the time does not depend on how many blocks there are.
+
+    Parameter
+    ---------
+    pixels : numpy array
+        the (rows, columns, channels) array to change.
+    row_runs : list of tuple
+        the runs of block rows, as returned by _block_runs.
+    column_runs : list of tuple
+        the runs of block columns, as returned by _block_runs.
+    """
+    if not row_runs or not column_runs:
+        return
+    color = _color(pixels)
+    if color.ndim == 2:
+        color = color[..., np.newaxis]
+    largest_block = max(run[1] for run in row_runs) * max(run[1] for run in column_runs)
+    sum_type = (np.uint32 if largest_block * int(np.iinfo(color.dtype).max) < 2 ** 32
+                else np.uint64)
+    for row_start, block_height, block_rows in row_runs:
+        band = color[row_start:row_start + block_height * block_rows]
+        row_sums = band.reshape((block_rows, block_height) + color.shape[1:]).sum(
+            axis=1, dtype=sum_type)
+        for column_run in column_runs:
+            _average_run(band, block_height, row_sums, column_run)
+
+
+def _as_lut(lut):
+    """
+    Turn a lookup table in to the (3, 256) uint8 form, one table per color channel.
+
+    Parameter
+    ---------
+    lut : array like
+        a table of 256 values used for every color, or a (3, 256) table for each color.
+    Return
+    ------
+    numpy array
+        the (3, 256) uint8 table.
+    """
+    table = np.asarray(lut)
+    if table.shape not in ((256,), (3, 256)):
+        raise ValueError("a lookup table needs 256 values or 3 rows of 256 values")
+    if table.min() < 0 or table.max() > 255:
+        raise ValueError("lookup table values have to be between 0 and 255")
+    return np.array(np.broadcast_to(table, (3, 256)), dtype=np.uint8)
+
+
+def compose_luts(*luts):
+    """
+    Fold lookup tables in to one table that does the same as using them one after the other.
+
+    Parameter
+    ---------
+    luts : array like
+        the tables in the order they would be used, as taken by _as_lut.
+    Return
+    ------
+    numpy array
+        the (3, 256) uint8 table.
+    """
+    folded = np.tile(np.arange(256, dtype=np.uint8), (3, 1))
+    for lut in luts:
+        # looking up the folded result in the next table is the same as using both in a row.
+        folded = np.take_along_axis(_as_lut(lut), folded.astype(np.intp), axis=1)
+    return folded
+
+
+def gamma_lut(gamma):
+    """
+    Make a lookup table for a gamma curve, gamma above 1 brightens and below 1 darkens.
+
+    Parameter
+    ---------
+    gamma : float
+        every value v becomes 255 * (v / 255) ** (1 / gamma), rounded.
+    Return
+    ------
+    numpy array
+        the (3, 256) uint8 table.
+    """
+    curve = np.rint(255 * (np.arange(256) / 255) ** (1 / gamma))
+    return _as_lut(curve)
+
+
+def levels_lut(black, white):
+    """
+    Make a lookup table that stretches the values from black to white over the whole range.
+
+    Parameter
+    ---------
+    black : int
+        this value and anything under it becomes 0.
+    white : int
+        this value and anything over it becomes 255.
+    Return
+    ------
+    numpy array
+        the (3, 256) uint8 table.
+    """
+    if not 0 <= black < white <= 255:
+        raise ValueError("black has to be below white and both between 0 and 255")
+    curve = np.clip(np.rint((np.arange(256) - black) * 255 / (white - black)), 0, 255)
+    return _as_lut(curve)
+
+
+def _apply_lut(plan, pixels):
+    """
+    Look up every color value of a pixel array in place, as planned by _lut_function.
+
+    Parameter
+    ---------
+    plan : list of tuple
+        (channel, table or None, value) for every channel the table changes, a None table means
+        the whole channel becomes value.
+    pixels : numpy array
+        the pixel array to change, of 8 bit values. A gray image uses the table of the first
+        color.
+    """
+    if pixels.dtype != np.uint8:
+        raise ValueError(f"lookup tables only work on 8 bit images, not {pixels.dtype}")
+    if (pixels.size and pixels.flags["C_CONTIGUOUS"]
+            and (pixels.ndim == 2 or pixels.shape[2] in (3, 4))
+            and any(table is not None for _, table, _ in plan)):
+        _point(plan, pixels)
+        return
+    color = _color(pixels)
+    if color.ndim == 2:
+        color = color[..., np.newaxis]
+    for channel, table, value in plan:
+        if channel >= color.shape[2]:
+            # a gray image only has the first color.
+            continue
+        values = color[..., channel]
+        if table is None:
+            values[...] = value
+        else:
+            np.take(table, values, out=values, mode="clip")
+
+
+def _point(plan, pixels):
+    """
+    Look up every color value of a pixel array in place with the point of PIL.
+
+    PIL looks up all the channels in one pass, which is about twice as quick as a numpy look up
+    of each channel. A color array with the same table for every channel is looked up as one
+    gray image of all its values.
+
+    Parameter
+    ---------
+    plan : list of tuple
+        the plan from _lut_function.
+    pixels : numpy array
+        the C contiguous 8 bit gray, color or color and alpha array to change.
+    """
+    bands = 1 if pixels.ndim == 2 else pixels.shape[2]
+    tables = [np.arange(256, dtype=np.uint8)] * bands
+    for channel, table, value in plan:
+        if channel < min(bands, 3):
+            tables[channel] = np.full(256, value, np.uint8) if table is None else table
+    values, mode = pixels, {1: "L", 3: "RGB", 4: "RGBA"}[bands]
+    if bands == 3 and all((table == tables[0]).all() for table in tables):
+        values, tables, mode = pixels.reshape(len(pixels), -1), tables[:1], "L"
+    image = Image.frombuffer(mode, (values.shape[1], len(values)), values, "raw", mode, 0, 1)
+    values[...] = np.asarray(image.point(np.concatenate(tables).tolist()))
+
+
+def _apply_folded(lut_function, functions, pixels):
+    """
+    Run value mappings folded in to one lookup table, or one by one on values over 8 bits.
+
+    Parameter
+    ---------
+    lut_function : function
+        the folded table, from _lut_function.
+    functions : list of functions
+        the value mappings it was folded from, None for a lookup table that was passed in.
+    pixels : numpy array
+        the (rows, columns, channels) array to change.
+    """
+    if pixels.dtype == np.uint8 or None in functions:
+        lut_function(pixels)
+        return
+    for function in functions:
+        function(pixels)
+
+
+def _lut_function(lut):
+    """
+    Make an in place function that uses a lookup table in one pass over the pixels.
+
+    Channels the table leaves as they are are skipped and channels it sets to one value are
+    filled, so only the channels that really need a look up pay for one.
+
+    Parameter
+    ---------
+    lut : array like
+        the table, as taken by _as_lut.
+    Return
+    ------
+    function
+        takes a (rows, columns, channels) array and changes it in place.
+    """
+    plan = []
+    for channel, table in enumerate(_as_lut(lut)):
+        if (table == np.arange(256)).all():
+            continue
+        if (table == table[0]).all():
+            plan.append((channel, None, table[0]))
+        else:
+            plan.append((channel, table, None))
+    return functools.partial(_apply_lut, plan)
+
+
+# the per-pixel loops the module started with, kept as the reference engine that the whole array
+# code above is checked against. Each one gives exactly what its fast version does.
+
+
+def _reference_colors(pixels):
+    """
+    Get the color channels of a pixel array with a channel axis, even for a gray array.
+
+    Parameter
+    ---------
+    pixels : numpy array
+        the pixel array.
+    Return
+    ------
+    numpy array
+        a (rows, columns, colors) view of the colors.
+    """
+    color = _color(pixels)
+    return color[..., np.newaxis] if color.ndim == 2 else color
+
+
+def _reference_clear(channels, pixels):
+    """Zero out the given channels one pixel at a time, as _clear_channels does."""
+    for row in pixels:
+        for column in row:
+            for channel in channels:
+                column[channel] = 0
+
+
+def _reference_lower_half(pixels):
+    """Halve every color value one pixel at a time, as _lower_half does."""
+    for row in _reference_colors(pixels):
+        for column in row:
+            for channel, value in enumerate(column):
+                column[channel] = value/2
+
+
+def _reference_upper_half(pixels):
+    """Halve every color value and add half the range one pixel at a time, as _upper_half does."""
+    half = (int(np.iinfo(pixels.dtype).max) >> 1) + 1
+    for row in _reference_colors(pixels):
+        for column in row:
+            for channel, value in enumerate(column):
+                column[channel] = value/2 + half
+
+
+def _reference_invert_color(pixels):
+    """Invert every color value one pixel at a time, as _invert_color does."""
+    largest = int(np.iinfo(pixels.dtype).max)
+    for row in _reference_colors(pixels):
+        for column in row:
+            for channel, value in enumerate(column):
+                column[channel] = largest - int(value)
+
+
+def _reference_gray_values(pixels, weights="equal"):
+    """
+    Work out the gray value of every pixel one pixel at a time, as _gray_values does.
+
+    Parameter
+    ---------
+    pixels : numpy array
+        the (rows, columns, channels) array to read.
+    weights : string
+        "equal" or "luma", as taken by _gray_values.
+    Return
+    ------
+    numpy array
+        the (rows, columns) gray values, of the same type as pixels.
+    """
+    if weights not in ("equal", "luma"):
+        raise ValueError(f"gray weights have to be 'equal' or 'luma', not {weights!r}")
+    gray = np.empty(pixels.shape[:2], pixels.dtype)
+    for row, gray_row in zip(pixels, gray):
+        for column, pixel in enumerate(row):
+            red, green, blue = int(pixel[0]), int(pixel[1]), int(pixel[2])
+            if weights == "luma":
+                gray_row[column] = (red * LUMA_WEIGHTS[0] + green * LUMA_WEIGHTS[1] +
+                                    blue * LUMA_WEIGHTS[2] + (1 << 15)) >> 16
+            elif pixels.dtype == np.uint8:
+                # to transform a pixel to its gray-scale form we find the average of the three
+                # colors.
+                gray_row[column] = (red*(1/3)) + (green*(1/3)) + (blue*(1/3))
+            else:
+                gray_row[column] = (red + green + blue) // 3
+    return gray
+
+
+def _reference_gray_scale(pixels, weights="equal"):
+    """Replace every color value with the gray of its pixel one pixel at a time."""
+    if _is_gray(pixels):
+        return
+    gray = _reference_gray_values(pixels, weights)
+    for row, gray_row in zip(pixels, gray):
+        for column, value in zip(row, gray_row):
+            column[0] = value
+            column[1] = value
+            column[2] = value
+
+
+def _reference_blocks(runs):
+    """
+    List the blocks of runs from _block_runs one by one.
+
+    Parameter
+    ---------
+    runs : list of tuple
+        (start, block length, number of blocks) runs.
+    Return
+    ------
+    list of tuple
+        (start, stop) of every block.
+    """
+    return [(start + block * length, start + (block + 1) * length)
+            for start, length, count in runs for block in range(count)]
+
+
+def _reference_block_average(pixels, row_runs, column_runs):
+    """Average every block one pixel at a time summing as python ints, as _block_average does."""
+    color = _reference_colors(pixels)
+    for top, bottom in _reference_blocks(row_runs):
+        for left, right in _reference_blocks(column_runs):
+            for channel in range(color.shape[2]):
+                values = [int(color[row][column][channel]) for row in range(top, bottom)
+                          for column in range(left, right)]
+                average = sum(values) // len(values)
+                for row in range(top, bottom):
+                    for column in range(left, right):
+                        color[row][column][channel] = average
+
+
+def _reference_lut(table, pixels):
+    """
+    Look up every color value in a table one pixel at a time, as _apply_lut does.
+
+    Parameter
+    ---------
+    table : numpy array
+        the (3, 256) table from _as_lut.
+    pixels : numpy array
+        the pixel array to change, of 8 bit values.
+    """
+    if pixels.dtype != np.uint8:
+        raise ValueError(f"lookup tables only work on 8 bit images, not {pixels.dtype}")
+    for row in _reference_colors(pixels):
+        for column in row:
+            for channel, value in enumerate(column):
+                column[channel] = table[channel][value]
+
+
+# rough number of bytes of pixels worked on at a time when running several per-pixel operations in
+# a row, small enough that a strip stays in cache between one operation and the next.
+STRIP_BYTES = 256 * 1024
+
+# default most bytes of pixels process_tiled keeps in a tile.
+TILE_BUDGET = 64 * 1024 * 1024
+
+# default most bytes of free arrays a BufferPool keeps, about three 24 megapixel color images.
+POOL_BYTES = 256 * 1024 * 1024
+
+# number of value mapping operations in a row from which they are folded in to one lookup table.
+# a look up with the point of PIL costs about as much as ten shifts or subtracts over the same
+# strip, 0.07 against 0.007 seconds each on 24 megapixels of color, so shorter runs are quicker
+# run one by one.
+LUT_FOLD_LENGTH = 10
+
+# operation code: (ImageO method, in place function on a pixel array or None when the operation
+# needs the whole image at once rather than any strip of rows on its own).
+OPERATIONS = {
+    "cr": ("clear_red", functools.partial(_clear_channels, (0,))),
+    "cg": ("clear_green", functools.partial(_clear_channels, (1,))),
+    "cb": ("clear_blue", functools.partial(_clear_channels, (2,))),
+    "ro": ("red_only", functools.partial(_clear_channels, (1, 2))),
+    "go": ("green_only", functools.partial(_clear_channels, (0, 2))),
+    "bo": ("blue_only", functools.partial(_clear_channels, (0, 1))),
+    "lh": ("lower_half", _lower_half),
+    "uh": ("upper_half", _upper_half),
+    "gs": ("gray_scale", _gray_scale),
+    "ic": ("invert_color", _invert_color),
+    "bi": ("block_image", None),
+    "rs": ("resize", None),
+}
+
+# the PIL resampling filters resize can use, by name.
+RESAMPLING = {
+    "nearest": Image.Resampling.NEAREST,
+    "box": Image.Resampling.BOX,
+    "bilinear": Image.Resampling.BILINEAR,
+    "hamming": Image.Resampling.HAMMING,
+    "bicubic": Image.Resampling.BICUBIC,
+    "lanczos": Image.Resampling.LANCZOS,
+}
+
+# the operations that set color channels on their own, a gray image is made color for them.
+CHANNEL_OPERATIONS = ("cr", "cg", "cb", "ro", "go", "bo")
+
+# the code the operations can run with, see ImageO.set_engine.
+ENGINES = ("fast", "reference")
+
+_IDENTITY = np.arange(256, dtype=np.uint8)
+
+# the lookup table of every operation that maps each color value on its own.
+LUTS = {
+    "cr": _as_lut([np.zeros(256), _IDENTITY, _IDENTITY]),
+    "cg": _as_lut([_IDENTITY, np.zeros(256), _IDENTITY]),
+    "cb": _as_lut([_IDENTITY, _IDENTITY, np.zeros(256)]),
+    "ro": _as_lut([_IDENTITY, np.zeros(256), np.zeros(256)]),
+    "go": _as_lut([np.zeros(256), _IDENTITY, np.zeros(256)]),
+    "bo": _as_lut([np.zeros(256), np.zeros(256), _IDENTITY]),
+    "lh": _as_lut(_IDENTITY // 2),
+    "uh": _as_lut(_IDENTITY // 2 + 128),
+    "ic": _as_lut(255 - _IDENTITY),
+}
+
+
+def _parse_operation(operation):
+    """
+    Split an operation in to its code and keyword arguments, checking the code is known.
+
+    Parameter
+    ---------
+    operation : string, tuple or numpy array
+        an operation code, a (code, dict of keyword arguments for the ImageO method) pair, or a
+        lookup table which is the same as ("lut", {"lut": table}).
+    Return
+    ------
+    tuple
+        the operation code and a dict of its keyword arguments.
+    """
+    if isinstance(operation, str):
+        code, options = operation, {}
+    elif isinstance(operation, np.ndarray):
+        code, options = "lut", {"lut": operation}
+    else:
+        code, options = operation
+    if code not in OPERATIONS and code != "lut":
+        raise ValueError(f"Not a valid operation: {code!r}")
+    return code, dict(options)
+
+
+def _method_name(code):
+    """
+    Find the ImageO method of an operation code.
+
+    Parameter
+    ---------
+    code : string
+        an operation code, or "lut".
+    Return
+    ------
+    string
+        the name of the method.
+    """
+    return "apply_lut" if code == "lut" else OPERATIONS[code][0]
+
+
+def _strip_functions(steps):
+    """
+    Turn a run of per-pixel operations in to the in place functions to run on each strip.
+
+    Value mapping operations next to each other are folded in to one lookup table when there are
+    LUT_FOLD_LENGTH or more of them or one is a lookup table that was passed in, as then one look
+    up costs less than running them one by one.
+
+    Parameter
+    ---------
+    steps : list of tuple
+        (in place function, lookup table or None) for each operation, the table is set for value
+        mappings and the function is None for a lookup table that was passed in.
+    Return
+    ------
+    list of functions
+        in place functions that only look at one pixel at a time.
+    """
+    functions = []
+    index = 0
+    while index < len(steps):
+        function, lut = steps[index]
+        if lut is None:
+            functions.append(function)
+            index += 1
+            continue
+        end = index
+        while end < len(steps) and steps[end][1] is not None:
+            end += 1
+        run = steps[index:end]
+        if len(run) >= LUT_FOLD_LENGTH or any(function is None for function, _ in run):
+            functions.append(functools.partial(
+                _apply_folded, _lut_function(compose_luts(*(lut for _, lut in run))),
+                [function for function, _ in run]))
+        else:
+            functions.extend(function for function, _ in run)
+        index = end
+    return functions
+
+
+def _fuse_operations(operations, gray=False):
+    """
+    Group runs of per-pixel operations so they can be run together one strip of rows at a time.
+
+    Parameter
+    ---------
+    operations : list
+        operation codes, (code, keyword arguments) pairs or lookup tables.
+    gray : bool
+        the image starts out gray, so a channel operation has to make it color first.
+    Return
+    ------
+    list of tuple
+        ("strips", [in place functions]) for each run of per-pixel operations and
+        ("whole", code, keyword arguments) for every operation that needs the whole image.
+    """
+    groups = []
+    for operation in operations:
+        code, options = _parse_operation(operation)
+        if code == "lut" and set(options) == {"lut"}:
+            step = (None, _as_lut(options["lut"]))
+        elif code == "gs" and set(options) <= {"weights"}:
+            step = (functools.partial(_gray_scale, **options), None)
+        elif (code == "lut" or OPERATIONS[code][1] is None or options or
+              (gray and code in CHANNEL_OPERATIONS)):
+            # block_image, anything with a region, and a single channel gray_scale or a channel
+            # operation on a gray image which change the shape of the array.
+            groups.append(("whole", code, options))
+            if code in CHANNEL_OPERATIONS:
+                gray = False
+            elif code == "gs" and options.get("single_channel"):
+                gray = True
+            continue
+        else:
+            step = (OPERATIONS[code][1], LUTS.get(code))
+        if groups and groups[-1][0] == "strips":
+            groups[-1][1].append(step)
+        else:
+            groups.append(("strips", [step]))
+    return [("strips", _strip_functions(group[1])) if group[0] == "strips" else group
+            for group in groups]
+
+
+class _Plan:  # pylint: disable=too-few-public-methods
+    """
+    Operations grouped once by ImageO.plan, to run on many images with pipeline.
+
+    It only holds for images that are gray or color like the one it was made on, and for the
+    engine that image had.
+    """
+
+    def __init__(self, operations, groups, block_layouts=None):
+        """
+        Initialize the plan.
+
+        Parameter
+        ---------
+        operations : list
+            the operations, the same as pipeline takes.
+        groups : list of tuple
+            the groups from _fuse_operations, or one for each operation on the reference engine.
+        block_layouts : dict
+            the index of a block_image group: the (row runs, column runs) to average its blocks
+            with, as from _block_runs, for when the image is a band of a larger one.
+        """
+        self.operations = operations
+        self.groups = groups
+        self.block_layouts = block_layouts
+
+
+def _run_strips(pixels, functions):
+    """
+    Run in place functions over an array a strip of rows at a time.
+
+    Every function is run on a strip before moving to the next strip, so each pixel is brought
+    in to cache once for the whole run instead of once per function.
+
+    Parameter
+    ---------
+    pixels : numpy array
+        the (rows, columns, channels) array to change.
+    functions : list of functions
+        in place functions that only look at one pixel at a time.
+    """
+    row_bytes = max(1, pixels[:1].nbytes)
+    strip_rows = max(1, STRIP_BYTES // row_bytes)
+    for start in range(0, len(pixels), strip_rows):
+        strip = pixels[start:start + strip_rows]
+        for function in functions:
+            function(strip)
+
+
+@functools.lru_cache(maxsize=None)
+def _band_executor(threads):
+    """
+    Get the pool of threads bands of rows are run on, one pool for each number of threads.
+
+    Parameter
+    ---------
+    threads : int
+        the number of threads in the pool.
+    Return
+    ------
+    ThreadPoolExecutor
+        the pool, kept for the next image.
+    """
+    return ThreadPoolExecutor(max_workers=threads, thread_name_prefix="bands")
+
+
+def _run_bands(rows, threads, function, starts=None):
+    """
+    Split the rows of an image in to one band for each thread and run a function on every band.
+
+    The array operations let go of the GIL, so the bands are worked on side by side. Every band
+    covers different rows, so the result is the same as running on all the rows at once.
+
+    Parameter
+    ---------
+    rows : int
+        the height of the image.
+    threads : int
+        the number of bands and threads, everything is run on this thread when it is 1.
+    function : function
+        called as function(start, stop) with the first row of the band and the row after its
+        last.
+    starts : set of int
+        the only rows a band may start at, any row when None. A cut falling between two of them
+        is moved down to the next one.
+    """
+    if threads <= 1 or rows < 2:
+        function(0, rows)
+        return
+    band_rows = -(-rows // threads)
+    cuts = set(range(band_rows, rows, band_rows))
+    if starts is not None:
+        allowed = sorted(starts)
+        cuts = {allowed[index] for index in (bisect.bisect_left(allowed, cut) for cut in cuts)
+                if index < len(allowed)}
+    cuts = [0] + sorted(cut for cut in cuts if 0 < cut < rows) + [rows]
+    bands = list(zip(cuts[:-1], cuts[1:]))
+    # list makes any error in a band come out here.
+    list(_band_executor(threads).map(lambda band: function(*band), bands))
+
+
+def _target_size(columns, rows, size=None, scale=None):
+    """
+    Work out the size to resize an image to.
+
+    Parameter
+    ---------
+    columns : int
+        the width of the image.
+    rows : int
+        the height of the image.
+    size : tuple
+        the (width, height) to resize to, one of them None to keep the shape of the image.
+    scale : float
+        how many times the size of the image to make it, used instead of size.
+    Return
+    ------
+    tuple of int
+        the (width, height) to resize to.
+    """
+    if scale is not None:
+        return max(1, round(columns * scale)), max(1, round(rows * scale))
+    width, height = (None, None) if size is None else size
+    if width is None and height is None:
+        raise ValueError("resize needs a size or a scale")
+    if width is None:
+        width = max(1, round(columns * height / rows))
+    elif height is None:
+        height = max(1, round(rows * width / columns))
+    return int(width), int(height)
+
+
+def _draft_scale(columns, rows, width, height):
+    """
+    Find how much smaller an image can be decoded and still be resized to a size well.
+
+    Parameter
+    ---------
+    columns : int
+        the width of the image.
+    rows : int
+        the height of the image.
+    width : int
+        the width it will be resized to.
+    height : int
+        the height it will be resized to.
+    Return
+    ------
+    int
+        8, 4 or 2 when the image decoded that many times smaller is still at least twice the
+        size, so the resize has enough pixels to average, else 1.
+    """
+    return next((scale for scale in (8, 4, 2)
+                 if columns // scale >= 2 * width and rows // scale >= 2 * height), 1)
+
+
+def _image_shape(image):
+    """
+    Find the shape and type of the pixel array of an image that is in a mode from native_mode.
+
+    Parameter
+    ---------
+    image : PIL Image
+        the image.
+    Return
+    ------
+    tuple
+        the (rows, columns) or (rows, columns, channels) shape and the numpy type.
+    """
+    columns, rows = image.size
+    if image.mode == "I;16":
+        return (rows, columns), np.uint16
+    if image.mode == "L":
+        return (rows, columns), np.uint8
+    return (rows, columns, len(image.getbands())), np.uint8
+
+
+def _read_into(image, pixels):
+    """
+    Copy the pixels of a decoded image in to an array a strip of rows at a time.
+
+    Only a strip is ever copied out of PIL at once, so no array the size of the image is made on
+    the way as np.array(image) would.
+
+    Parameter
+    ---------
+    image : PIL Image
+        the loaded image, in a mode from native_mode.
+    pixels : numpy array
+        the array to write to, with the shape and type from _image_shape.
+    """
+    rows = len(pixels)
+    step = max(1, STRIP_BYTES // max(1, pixels[0].nbytes))
+    for top in range(0, rows, step):
+        bottom = min(top + step, rows)
+        pixels[top:bottom] = np.asarray(image.crop((0, top, image.size[0], bottom)))
+
+
+def _resample(pixels, change):
+    """
+    Run a PIL resize on a pixel array of any depth, channel by channel where PIL can not hold it.
+
+    Parameter
+    ---------
+    pixels : numpy array
+        the 8 or 16 bit pixel array.
+    change : function
+        takes a PIL image and gives back the resized one.
+    Return
+    ------
+    numpy array
+        the resized pixels, with the same type and channels.
+    """
+    if pixels.dtype == np.uint8 and (pixels.ndim == 2 or pixels.shape[2] <= 4):
+        return np.array(change(Image.fromarray(np.ascontiguousarray(pixels))))
+    if pixels.ndim == 3:
+        return np.dstack([_resample(pixels[..., channel], change)
+                          for channel in range(pixels.shape[2])])
+    # 32 bit gray can be resized any way, unlike 16 bit.
+    image = Image.fromarray(pixels.astype(np.int32))
+    return np.array(change(image)).astype(pixels.dtype)
+
+
+# formats process_frames can save several frames in.
+FRAME_FORMATS = ("GIF", "TIFF", "PNG", "WEBP")
+
+
+def _tile_rows(rows, row_bytes, memory_budget, boundaries=None):
+    """
+    Split the rows of an image in to tiles that fit in a memory budget.
+
+    Parameter
+    ---------
+    rows : int
+        the height of the image.
+    row_bytes : int
+        the number of bytes in one row of the image.
+    memory_budget : int
+        the most bytes for the copies of a tile that are in memory at once.
+    boundaries : set of int
+        the only rows a tile may start at, any row when None. A tile is made larger than the
+        budget when there is no allowed row inside it.
+    Return
+    ------
+    list of tuple
+        the (start, stop) rows of every tile.
+    """
+    # the tile is read, changed, then turned in to the bytes to save or an image to paste.
+    tile_rows = max(1, memory_budget // (3 * row_bytes))
+    if boundaries is None:
+        return [(start, min(start + tile_rows, rows)) for start in range(0, rows, tile_rows)]
+    allowed = sorted(boundary for boundary in boundaries if 0 < boundary < rows) + [rows]
+    tiles, start, index = [], 0, 0
+    while start < rows:
+        stop = allowed[index]
+        while index + 1 < len(allowed) and allowed[index + 1] - start <= tile_rows:
+            index += 1
+            stop = allowed[index]
+        tiles.append((start, stop))
+        start, index = stop, index + 1
+    return tiles
+
+
+def process_tiled(input_file, output_file, operations,  # pylint: disable=too-many-arguments
+                  memory_budget=TILE_BUDGET, *, scratch_file=None, stats=None, encoding=None,
+                  threads=1):
+    """
+    Run operations on an image a band of rows at a time to keep the memory used down.
+
+    Only the band being worked on is in memory when the image can be read and saved a band at a
+    time. It is read that way from PNG that is not interlaced, TIFF in strips that are not
+    compressed or are deflate or packbits compressed, and raw formats such as PPM and BMP, when
+    the image is gray, color or 16 bit gray. It is saved that way to PNG, and to TIFF with no
+    compression or deflate and no other settings. Any other image is decoded whole and the bands
+    cropped out of it, and any other output is put together whole before it is saved, each of
+    which keeps the whole image in memory once on top of the band. Per-pixel operations can use
+    any band, bands are lined up with block rows when there is a block_image.
+
+    Parameter
+    ---------
+    input_file : string
+        the file to read.
+    output_file : string
+        the file to save to, or None to not save when using scratch_file.
+    operations : list
+        the operations to run, the same as pipeline takes.
+    memory_budget : int
+        about the most bytes to use for a band.
+    scratch_file : string
+        put the result together in a memory-mapped .npy file at this path instead of in memory,
+        the result can be read back a band at a time from the returned array. An output that can
+        not be saved a band at a time is saved from the mapped file, which takes no copy for
+        gray, RGBA and 16 bit gray results but a whole one for any other.
+    stats : StageStats
+        stats to add the decode, transform and encode stages to.
+    encoding : dict
+        the encoder settings to save with, see ImageO.save.
+    threads : int
+        the number of threads to split every tile over, see ImageO.set_threads.
+    Return
+    ------
+    numpy memmap
+        the result in the scratch file if there is one, else None.
+    """
+    if stats is None:
+        stats = StageStats()
+    source = _BandSource(input_file, stats)
+    plan, tiles = _tiled_plan(operations, source, memory_budget)
+    bands = _transformed_bands(source, tiles, plan, stats, threads)
+    scratch = None
+    if scratch_file is not None:
+        scratch = _write_scratch(scratch_file, bands, source.size[1])
+        source.close()
+        if output_file is None:
+            return scratch
+        bands = _scratch_bands(scratch_file, scratch, tiles)
+    _save_bands(bands, output_file, source, stats, encoding)
+    return scratch
+
+
+class _BandSource:
+    """
+    An image read a band of rows at a time from the top down, for process_tiled.
+
+    The bands are read straight from the file when band_reader can, else the image is decoded
+    whole and the bands copied out of it.
+    """
+
+    def __init__(self, input_file, stats):
+        """
+        Initialize by reading the header, or decoding the image when it can not be read in bands.
+
+        Parameter
+        ---------
+        input_file : string
+            the file to read.
+        stats : StageStats
+            stats to add the decode stage to.
+        """
+        with stats.stage("decode") as stage:
+            image = Image.open(input_file)
+            self.size = image.size
+            self.mode = native_mode(image)
+            self._read = band_reader(input_file, image)
+            # the decoded image when the bands are copied out of it.
+            self.image = None
+            if self._read is None:
+                image.load()
+                self.image = native_image(image)
+                stage["pixels"] = self.size[0] * self.size[1]
+            else:
+                image.close()
+
+    def read(self, start, stop):
+        """
+        Read the next band of rows.
+
+        Parameter
+        ---------
+        start : int
+            the first row, where the band before stopped.
+        stop : int
+            the row after the last.
+        Return
+        ------
+        numpy array
+            the pixels of the band.
+        """
+        if self._read is not None:
+            return self._read(start, stop)
+        return np.array(self.image.crop((0, start, self.size[0], stop)))
+
+    def canvas(self, mode):
+        """
+        Get an image of the whole size to paste the changed bands in to.
+
+        Parameter
+        ---------
+        mode : string
+            the mode of the changed bands.
+        Return
+        ------
+        PIL Image
+            the decoded image when it is in that mode, as a band is always read before it is
+            pasted over, else a new one.
+        """
+        if self.image is not None and self.image.mode == mode:
+            return self.image
+        return Image.new(mode, self.size)
+
+    def close(self):
+        """Let go of the decoded image, if there is one."""
+        if self.image is not None:
+            self.image.close()
+            self.image = None
+
+
+def _tiled_plan(operations, source, memory_budget):
+    """
+    Group the operations of process_tiled and split the image in to tiles for them.
+
+    Parameter
+    ---------
+    operations : list
+        the operations, the same as pipeline takes.
+    source : _BandSource
+        the image.
+    memory_budget : int
+        about the most bytes to use for a tile.
+    Return
+    ------
+    tuple
+        the _Plan, with the (row runs, column runs) of every block_image group over the whole
+        image as its block layouts, and the (start, stop) rows of every tile.
+    """
+    columns, rows = source.size
+    groups = _fuse_operations(operations, source.mode in ("L", "LA", "I;16"))
+    if any(group[0] == "whole" and group[1] == "rs" for group in groups):
+        raise ValueError("resize needs the whole image, it can not be done a band at a time")
+    if any(group[0] == "whole" and "region" in group[2] for group in groups):
+        raise ValueError("regions are of the whole image, they can not be done a band at a time")
+    layouts = {}
+    boundaries = None
+    for index, group in enumerate(groups):
+        if group[0] == "whole" and group[1] == "bi":
+            layouts[index] = _block_layout(rows, columns, group[2].get("block_size"),
+                                           group[2].get("number_of_blocks"))
+            # blocks have to be wholly in one tile, so tiles can only start where block rows do.
+            starts = _block_starts(layouts[index][0])
+            boundaries = starts if boundaries is None else boundaries & starts
+    row_bytes = columns * Image.getmodebands(source.mode) * (2 if source.mode == "I;16" else 1)
+    return _Plan(operations, groups, layouts), _tile_rows(rows, row_bytes, memory_budget,
+                                                          boundaries)
+
+
+def _transformed_bands(source, tiles, plan, stats, threads):
+    """
+    Read and change the tiles of an image one at a time, for process_tiled.
+
+    Parameter
+    ---------
+    source : _BandSource
+        the image.
+    tiles : list of tuple
+        the (start, stop) rows of every tile.
+    plan : _Plan
+        the plan from _tiled_plan.
+    stats : StageStats
+        stats to add the decode and transform stages to.
+    threads : int
+        the number of threads to split every tile over.
+    Return
+    ------
+    generator of tuple
+        the start row, stop row and changed pixels of every tile.
+    """
+    for start, stop in tiles:
+        with stats.stage("decode") as stage:
+            tile = source.read(start, stop)
+            stage["pixels"] = _pixel_count(tile)
+        block_layouts = {index: (_runs_within(row_runs, start, stop), column_runs)
+                         for index, (row_runs, column_runs) in plan.block_layouts.items()}
+        tile_image = ImageO.from_array(tile, stats).set_threads(threads).pipeline(
+            _Plan(plan.operations, plan.groups, block_layouts))
+        yield start, stop, tile_image.infile
+
+
+def _save_bands(bands, output_file, source, stats, encoding):
+    """
+    Save the changed tiles of process_tiled, a band at a time when the output can be.
+
+    Parameter
+    ---------
+    bands : iterable of tuple
+        the start row, stop row and pixels of every band, from the top down.
+    output_file : string
+        the file to save to.
+    source : _BandSource
+        the image the bands are of.
+    stats : StageStats
+        stats to add the encode stage to.
+    encoding : dict
+        the encoder settings, see ImageO.save.
+    """
+    make_writer = band_writer(output_file, encoding)
+    if make_writer is None:
+        output = _paste_bands(bands, source, stats)
+        with stats.stage("encode"):
+            save_image(output, output_file, encoding)
+        return
+    with open(output_file, "wb") as output:
+        writer = None
+        for _, _, tile in bands:
+            with stats.stage("encode") as stage:
+                stage["pixels"] = _pixel_count(tile)
+                if writer is None:
+                    writer = make_writer(output, source.size[1], tile)
+                writer.write(tile)
+        with stats.stage("encode"):
+            writer.finish()
+
+
+def _paste_bands(bands, source, stats):
+    """
+    Put changed bands together in to one image to save whole.
+
+    Parameter
+    ---------
+    bands : iterable of tuple
+        the start row, stop row and pixels of every band, from the top down.
+    source : _BandSource
+        the image the bands are of, closed once they are all pasted.
+    stats : StageStats
+        stats to add the encode stage to.
+    Return
+    ------
+    PIL Image
+        the whole image.
+    """
+    output = None
+    for start, stop, tile in bands:
+        with stats.stage("encode") as stage:
+            stage["pixels"] = _pixel_count(tile)
+            tile_image = to_image(tile)
+            if output is None:
+                output = source.canvas(tile_image.mode)
+            output.paste(tile_image, (0, start, source.size[0], stop))
+    if output is not source.image:
+        source.close()
+    return output
+
+
+def _write_scratch(scratch_file, bands, rows):
+    """
+    Write bands of rows in to a .npy file.
+
+    The bands go through the file rather than a memory map of it, so the pages written are not
+    kept in the memory of the process.
+
+    Parameter
+    ---------
+    scratch_file : string
+        the .npy file to make.
+    bands : iterable of tuple
+        the start row, stop row and pixels of every band, from the top down.
+    rows : int
+        the height of the image.
+    Return
+    ------
+    numpy memmap
+        the whole of the file mapped.
+    """
+    scratch = output = None
+    with contextlib.ExitStack() as stack:
+        for start, _, tile in bands:
+            if scratch is None:
+                scratch = np.lib.format.open_memmap(scratch_file, mode="w+", dtype=tile.dtype,
+                                                    shape=(rows,) + tile.shape[1:])
+                output = stack.enter_context(open(scratch_file, "r+b"))
+            output.seek(scratch.offset + start * scratch[0].nbytes)
+            output.write(np.ascontiguousarray(tile))
+    return scratch
+
+
+def _scratch_bands(scratch_file, scratch, tiles):
+    """
+    Read bands of rows back from a .npy file, without going through a memory map of it.
+
+    Parameter
+    ---------
+    scratch_file : string
+        the .npy file.
+    scratch : numpy memmap
+        the file mapped, for the shape, type and where the pixels start.
+    tiles : list of tuple
+        the (start, stop) rows of every band.
+    Return
+    ------
+    generator of tuple
+        the start row, stop row and pixels of every band.
+    """
+    for start, stop in tiles:
+        band = np.fromfile(scratch_file, scratch.dtype, (stop - start) * scratch[0].size,
+                           offset=scratch.offset + start * scratch[0].nbytes)
+        yield start, stop, band.reshape((stop - start,) + scratch.shape[1:])
+
+
+# held while a stage measures memory, as tracemalloc keeps one peak for the whole process and a
+# stage in another thread would reset or stop it.
+_MEMORY_LOCK = threading.RLock()
+
+
+def _reset_peak():
+    """Start measuring the peak of the memory traced by tracemalloc from what is traced now."""
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    else:
+        # before python 3.9 the peak can only be started again by forgetting the traces.
+        tracemalloc.clear_traces()
+
+
+class StageStats:
+    """
+    Wall time, pixel count and peak array memory of the decode, transform and encode stages.
+
+    Every ImageO has one as its stats attribute. Each stage adds up over all the times it is run.
+    Peak memory is only measured when track_memory is on as it uses tracemalloc, which slows
+    down python while it runs. It counts what python and numpy allocate during a stage, not the
+    buffers PIL keeps for itself. tracemalloc is shared by every thread, so stages that measure
+    memory run one at a time even when jobs run side by side on threads.
+    """
+
+    def __init__(self, track_memory=False, callback=None):
+        """
+        Initialize the object with no stages yet.
+
+        Parameter
+        ---------
+        track_memory : bool
+            measure the peak memory of every stage.
+        callback : function
+            called as callback(stage name, dict of "seconds", "pixels" and "peak_bytes") every
+            time a stage finishes, to pass the numbers on to some other place.
+        """
+        self.track_memory = track_memory
+        self.callback = callback
+        self.stages = {}
+        self._running = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Measure a stage, the pixels it worked on are set in the dict it gives.
+
+        A stage started again inside itself, such as an operation run by pipeline, is only counted
+        once by the outer one.
+
+        Parameter
+        ---------
+        name : string
+            "decode", "transform" or "encode".
+        """
+        if name in self._running:
+            yield {}
+            return
+        self._running.append(name)
+        measure = {"pixels": 0}
+        with _MEMORY_LOCK if self.track_memory else contextlib.nullcontext():
+            started_tracing = self.track_memory and not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start()
+            if self.track_memory:
+                _reset_peak()
+                memory_before = tracemalloc.get_traced_memory()[0]
+            start = time.perf_counter()
+            try:
+                yield measure
+            finally:
+                seconds = time.perf_counter() - start
+                peak_bytes = None
+                if self.track_memory:
+                    # a stage inside this one may have started the peak again below where
+                    # this one started.
+                    peak_bytes = max(0, tracemalloc.get_traced_memory()[1] - memory_before)
+                if started_tracing:
+                    tracemalloc.stop()
+                self._running.remove(name)
+                self.record(name, seconds, measure["pixels"], peak_bytes)
+
+    def record(self, name, seconds, pixels, peak_bytes=None, calls=1):
+        """
+        Add a finished stage to the totals and pass it to the callback.
+
+        Parameter
+        ---------
+        name : string
+            the name of the stage.
+        seconds : float
+            the wall time the stage took.
+        pixels : int
+            the number of pixels the stage worked on.
+        peak_bytes : int
+            the most memory the stage allocated at once, None when not measured.
+        calls : int
+            the number of times the stage was run to get these numbers.
+        """
+        totals = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "pixels": 0,
+                                               "peak_bytes": None})
+        totals["calls"] += calls
+        totals["seconds"] += seconds
+        totals["pixels"] += pixels
+        if peak_bytes is not None:
+            totals["peak_bytes"] = max(totals["peak_bytes"] or 0, peak_bytes)
+        if self.callback is not None:
+            self.callback(name, {"seconds": seconds, "pixels": pixels, "peak_bytes": peak_bytes})
+
+    def merge(self, other):
+        """
+        Add the totals of another StageStats to these ones, without calling the callback again.
+
+        Parameter
+        ---------
+        other : StageStats or dict
+            the stats to add, or the dict from its as_dict.
+        """
+        stages = other.stages if isinstance(other, StageStats) else other
+        callback, self.callback = self.callback, None
+        try:
+            for name, totals in stages.items():
+                self.record(name, totals["seconds"], totals["pixels"], totals["peak_bytes"],
+                            totals["calls"])
+        finally:
+            self.callback = callback
+
+    def as_dict(self):
+        """
+        Get the totals of every stage.
+
+        Return
+        ------
+        dict
+            stage name: dict of "calls", "seconds", "pixels" and "peak_bytes".
+        """
+        return {name: dict(totals) for name, totals in self.stages.items()}
+
+    def to_json(self):
+        """
+        Get the totals of every stage as JSON.
+
+        Return
+        ------
+        string
+            the as_dict totals in JSON.
+        """
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+    def report(self):
+        """
+        Get the totals of every stage as a small table.
+
+        Return
+        ------
+        string
+            one line for each stage with its time, megapixels a second and peak memory.
+        """
+        lines = [f"{'stage':10} {'calls':>6} {'seconds':>10} {'MP/s':>10} {'peak MB':>12}"]
+        for name in ("decode", "transform", "encode"):
+            if name not in self.stages:
+                continue
+            totals = self.stages[name]
+            speed = totals["pixels"] / 1e6 / totals["seconds"] if totals["seconds"] else 0.0
+            peak = ("-" if totals["peak_bytes"] is None
+                    else f"{totals['peak_bytes'] / 1024 / 1024:.1f}")
+            lines.append(f"{name:10} {totals['calls']:>6} {totals['seconds']:>10.4f}"
+                         f" {speed:>10.1f} {peak:>12}")
+        return "\n".join(lines)
+
+
+def _pixel_count(pixels):
+    """
+    Count the pixels in a pixel array.
+
+    Parameter
+    ---------
+    pixels : numpy array
+        the (rows, columns, ...) array.
+    Return
+    ------
+    int
+        rows times columns.
+    """
+    return int(pixels.shape[0]) * int(pixels.shape[1])
+
+
+class BufferPool:
+    """
+    Pixel arrays kept for reuse.
+
+    A batch of images of the same size decodes in to the same memory over and over instead of
+    making a new array for every image. An ImageO given a pool decodes in to an array taken from
+    it and gives it back on release. The pool keeps up to max_buffers arrays of each shape and
+    type and up to max_bytes in all, dropping the arrays of the shapes used longest ago first, and
+    can be shared between threads.
+    """
+
+    def __init__(self, max_buffers=4, max_bytes=POOL_BYTES):
+        """
+        Initialize an empty pool.
+
+        Parameter
+        ---------
+        max_buffers : int
+            the most free arrays to keep for each shape and type, more given back are dropped.
+        max_bytes : int
+            the most bytes of free arrays to keep for all shapes and types together.
+        """
+        self.max_buffers = max_buffers
+        self.max_bytes = max_bytes
+        self.allocations = 0
+        self.reuses = 0
+        # shape and type: the free arrays, the shape and type used longest ago first.
+        self._free = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def take(self, shape, dtype):
+        """
+        Get an array to write in to, one given back before if there is one of the same kind.
+
+        Parameter
+        ---------
+        shape : tuple of int
+            the shape of the array.
+        dtype : numpy dtype
+            the type of the array.
+        Return
+        ------
+        numpy array
+            an array of that shape and type, what is in it is left over from its last use.
+        """
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self._lock:
+            if self._free.get(key):
+                self.reuses += 1
+                self._free.move_to_end(key)
+                pixels = self._free[key].pop()
+                self._bytes -= pixels.nbytes
+                return pixels
+            self.allocations += 1
+        return np.empty(shape, dtype)
+
+    def give(self, pixels):
+        """
+        Give an array back so that a later take can use it.
+
+        Parameter
+        ---------
+        pixels : numpy array
+            an array from take that nothing uses any more.
+        """
+        key = (pixels.shape, pixels.dtype.str)
+        with self._lock:
+            free = self._free.setdefault(key, [])
+            self._free.move_to_end(key)
+            if (len(free) >= self.max_buffers or pixels.nbytes > self.max_bytes
+                    or any(pixels is kept for kept in free)):
+                return
+            free.append(pixels)
+            self._bytes += pixels.nbytes
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._free))
+                self._bytes -= self._free[oldest].pop(0).nbytes
+                if not self._free[oldest]:
+                    del self._free[oldest]
+
+    def counters(self):
+        """
+        Get how often an array was made or reused.
+
+        Return
+        ------
+        dict
+            "allocations" and "reuses" since the pool was made.
+        """
+        return {"allocations": self.allocations, "reuses": self.reuses}
+
+
+class AsyncPool:
+    """
+    The threads and the limit on work in flight that the async methods of ImageO run with.
+
+    Decoding, the operations and encoding run on the threads so the event loop is never held up,
+    and PIL and numpy let go of the GIL for most of that so many images overlap. At most in_flight
+    calls hold a slot at once, the rest wait on the event loop without taking up a thread or any
+    memory for pixels. A pool is meant to be used from one event loop.
+    """
+
+    def __init__(self, workers=None, in_flight=None):
+        """
+        Initialize the pool, starting no threads until there is work.
+
+        Parameter
+        ---------
+        workers : int
+            the most threads to run at once, the number of cpus by default.
+        in_flight : int
+            the most calls that run or wait on a thread at once, twice workers by default.
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.in_flight = in_flight or 2 * self.workers
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._slots = None
+        # what has been handed to the threads and is not done, so close can drop what has not
+        # started.
+        self._pending = set()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Wait for and hold one of the in_flight slots."""
+        if self._slots is None:
+            # made here so that it belongs to the event loop the pool is used from.
+            self._slots = asyncio.Semaphore(self.in_flight)
+        async with self._slots:
+            yield
+
+    async def run(self, function, *args, **kwargs):
+        """
+        Run a function on one of the threads and wait for it without blocking the event loop.
+
+        When the waiting task is cancelled a function that has not started yet is never run, one
+        that has started runs to its end on the thread but its result is thrown away.
+
+        Parameter
+        ---------
+        function : function
+            the function to call with args and kwargs.
+        Return
+        ------
+        object
+            what the function returned.
+        """
+        future = self.executor.submit(function, *args, **kwargs)
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+        return await asyncio.wrap_future(future)
+
+    def close(self):
+        """Stop the threads once the work they started is done, dropping work not yet started."""
+        # cancel only stops futures that have not started, the rest run to their end.
+        for future in list(self._pending):
+            future.cancel()
+        self.executor.shutdown(wait=False)
+
+
+# the pool for each event loop when none is given, made the first time a loop needs one.
+_ASYNC_POOLS = weakref.WeakKeyDictionary()
+
+
+def _async_pool(pool=None):
+    """
+    Find the pool to use for an async call.
+
+    Parameter
+    ---------
+    pool : AsyncPool
+        the pool asked for, the default one of the running event loop when None.
+    Return
+    ------
+    AsyncPool
+        the pool to use.
+    """
+    if pool is not None:
+        return pool
+    loop = asyncio.get_running_loop()
+    if loop not in _ASYNC_POOLS:
+        _ASYNC_POOLS[loop] = AsyncPool()
+    return _ASYNC_POOLS[loop]
+
+
+class ImageO:  # pylint: disable=too-many-instance-attributes,too-many-public-methods
     """
     Object that handles images, allowing for a number of manipulations.
 
-    Image object that takes an input file as the input and reads that input file and turns that
-    image in to an array. From that array the object allows for a number of manipulations to be
-    done to the image. Every manipulation also by default outputs the file.
-    """
+    Image object that takes an input file as the input and reads that input file and turns that
+    image in to an array. From that array the object allows for a number of manipulations to be
+    done to the image. Every manipulation also by default outputs the file.
+
+    Only the header of the file is read when the object is made, the pixels are decoded the first
+    time they are needed. Until then size and mode can be looked at for free, and draft, preview
+    or a block_image with draft=True can have a JPEG decoded at 1/2, 1/4 or 1/8 of its size.
+    """
+
+    def __init__(self, input_file, profile=False, on_stage=None, buffers=None):
+        """
+        Initialize the object by taking an input_file and loading the image to an array.
+
+        Parameter
+        ---------
+        input_file : string
+            string of the file location to be read, relative or full path.
+        profile : bool
+            measure the peak memory of every stage in stats as well as the time.
+        on_stage : function
+            called every time a stage finishes, see StageStats.
+        buffers : BufferPool
+            decode in to an array from this pool, given back by release.
+        """
+        self._setup(StageStats(profile, on_stage), buffers)
+        try:
+            self._open(input_file)
+        except FileNotFoundError:
+            # if that file did not exist then we warn the user and close the program.
+            print("Check your infile parameter, I can't find the file you put in!")
+            sys.exit()
+
+    def _setup(self, stats, buffers=None):
+        """
+        Set up the settings every new object starts with, before it has any pixels.
+
+        Parameter
+        ---------
+        stats : StageStats
+            the stats to add to.
+        buffers : BufferPool
+            the pool to decode in to, if any.
+        """
+        self.stats = stats
+        self.encoding = {}
+        self.threads = 1
+        self.engine = "fast"
+        self.buffers = buffers
+        self._buffer = None
+        self._source = None
+        self._source_file = None
+        self._pixels = None
+
+    def _open(self, input_file):
+        """
+        Read the header of the file, leaving the pixels to be decoded when they are first needed.
+
+        A file named by its path is closed once the header is read and opened again to decode,
+        so an image that is never decoded or released does not keep a file open. A file object
+        stays open until the image is decoded or released, as it can not be opened again.
+
+        Parameter
+        ---------
+        input_file : string or file object
+            string of the file location to be read, relative or full path, or a file object.
+        """
+        self._source = Image.open(input_file)
+        self._pixels = None
+        if isinstance(input_file, (str, os.PathLike)):
+            self._source_file = input_file
+            self._source.close()
+
+    def _decode(self, scale=1):
+        """
+        Decode the pixels of the file and store them as a numpy array.
+
+        Parameter
+        ---------
+        scale : int
+            decode at 1/scale of the size. JPEG files are decoded straight at 1/2, 1/4 or 1/8 of
+            the size, anything else is decoded in full and then reduced by averaging.
+        """
+        with self.stats.stage("decode") as stage:
+            source = self._source if self._source_file is None else Image.open(self._source_file)
+            with contextlib.closing(source):
+                image = source
+                columns, rows = image.size
+                if scale > 1:
+                    image.draft(image.mode, (columns // scale, rows // scale))
+                image.load()
+                image = native_image(image)
+                if image.size != (-(-columns // scale), -(-rows // scale)):
+                    pixels = _resample(np.array(image), lambda image: image.reduce(scale))
+                elif self.buffers is not None:
+                    self._buffer = self.buffers.take(*_image_shape(image))
+                    _read_into(image, self._buffer)
+                    pixels = self._buffer
+                else:
+                    pixels = np.array(image)
+                self._pixels = pixels
+            self._source.close()
+            self._source = None
+            stage["pixels"] = _pixel_count(self._pixels)
+
+    @property
+    def infile(self):
+        """
+        Get the numpy array of the image, decoding the file first if it has not been yet.
+
+        Return
+        ------
+        numpy array
+            the (rows, columns, channels) array of the image.
+        """
+        if self._pixels is None and self._source is not None:
+            self._decode()
+        return self._pixels
+
+    @infile.setter
+    def infile(self, pixels):
+        """
+        Replace the numpy array of the image.
+
+        Parameter
+        ---------
+        pixels : numpy array
+            the (rows, columns, channels) array to use, it is not copied.
+        """
+        self._pixels = pixels
+
+    @property
+    def size(self):
+        """
+        Get the size of the image without decoding it.
+
+        Return
+        ------
+        tuple
+            the (width, height) of the image.
+        """
+        if self._pixels is None and self._source is not None:
+            return self._source.size
+        return self._pixels.shape[1], self._pixels.shape[0]
+
+    @property
+    def mode(self):
+        """
+        Get the PIL mode of the image, such as "RGB", without decoding it.
+
+        Return
+        ------
+        string
+            "L", "LA", "RGB", "RGBA" or "I;16", the mode the image is worked on in rather than
+            the mode of the file, such as "RGB" for a palette "P" file.
+        """
+        if self._pixels is None and self._source is not None:
+            return native_mode(self._source)
+        return to_image(self._pixels[:1, :1]).mode
+
+    def draft(self, scale):
+        """
+        Make the image 1/scale of its size, decoding it at that size if it has not been decoded.
+
+        Parameter
+        ---------
+        scale : int
+            how many times smaller to make the image, JPEGs decode straight at 2, 4 and 8.
+        Return
+        ------
+        ImageO
+            this object, so more can be chained on.
+        """
+        if scale <= 1:
+            return self
+        if self._pixels is None and self._source is not None:
+            self._decode(scale)
+        else:
+            with self._transform():
+                self.infile = _resample(self.infile, lambda image: image.reduce(scale))
+        return self
+
+    def preview(self, max_size):
+        """
+        Shrink the image to fit in a box, decoding a JPEG at the smallest size still big enough.
+
+        Parameter
+        ---------
+        max_size : tuple of int
+            the most (width, height) the image can be, the shape of the image is kept.
+        Return
+        ------
+        ImageO
+            this object, so more can be chained on.
+        """
+        width, height = self.size
+        scale = 1
+        while (scale < 8 and width // (scale * 2) >= max_size[0] and
+               height // (scale * 2) >= max_size[1]):
+            scale *= 2
+        self.draft(scale)
+        if self.size[0] > max_size[0] or self.size[1] > max_size[1]:
+            def thumbnail(image):
+                image.thumbnail(max_size, Image.Resampling.BOX)
+                return image
+
+            with self._transform():
+                self.infile = _resample(self.infile, thumbnail)
+        return self
+
+    def _draft_for(self, size=None, scale=None, **_):
+        """
+        Decode the image as small as it can be for a resize, if it has not been decoded yet.
+
+        Parameter
+        ---------
+        size : tuple
+            the size it will be resized to, as taken by resize.
+        scale : float
+            the scale it will be resized by, as taken by resize.
+        """
+        if self._pixels is None and self._source is not None:
+            columns, rows = self.size
+            self.draft(_draft_scale(columns, rows, *_target_size(columns, rows, size, scale)))
+
+    def release(self):
+        """
+        Give the decoded array back to the buffer pool, the image can not be used after.
+
+        Nothing happens when the image was not decoded in to a buffer from a pool. Any array
+        handed out by the operations with returnable=True is given back as well and should not be
+        used after either.
+        """
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+        if self._buffer is not None:
+            self.buffers.give(self._buffer)
+            self._buffer = None
+        self._pixels = None
+
+    @contextlib.contextmanager
+    def _transform(self, out=None):
+        """
+        Time a change to the image as the transform stage, decoding it first if needed.
+
+        Parameter
+        ---------
+        out : numpy array
+            write the result of the change in to this array and leave the image as it was. The
+            image is copied in to it first when they have the same shape, so that the change
+            runs on it in place.
+        """
+        source = self.infile
+        if out is not None and out.dtype != source.dtype:
+            raise ValueError(f"out has to be {source.dtype} like the image, not {out.dtype}")
+        with self.stats.stage("transform") as stage:
+            stage["pixels"] = _pixel_count(source)
+            if out is None:
+                yield
+                return
+            if out.shape == source.shape:
+                np.copyto(out, source)
+                self._pixels = out
+            try:
+                yield
+                if self._pixels is not out:
+                    if self._pixels.shape != out.shape:
+                        raise ValueError("out has to have the shape of the result"
+                                         f" {self._pixels.shape}, not {out.shape}")
+                    np.copyto(out, self._pixels)
+            finally:
+                self._pixels = source
+
+    @classmethod
+    def open(cls, input_file, profile=False, on_stage=None, buffers=None):
+        """
+        Make an ImageO from a file, raising the error rather than closing the program on failure.
+
+        Parameter
+        ---------
+        input_file : string
+            string of the file location to be read, relative or full path.
+        profile : bool
+            measure the peak memory of every stage in stats as well as the time.
+        on_stage : function
+            called every time a stage finishes, see StageStats.
+        buffers : BufferPool
+            decode in to an array from this pool, given back by release.
+        Return
+        ------
+        ImageO
+            the new object.
+        """
+        image = cls.__new__(cls)
+        image._setup(StageStats(profile, on_stage), buffers)
+        image._open(input_file)
+        return image
+
+    @classmethod
+    def from_array(cls, pixels, stats=None):
+        """
+        Make an ImageO around an array that is already in memory instead of reading a file.
+
+        Parameter
+        ---------
+        pixels : numpy array
+            the (rows, columns, channels) array to use, it is not copied.
+        stats : StageStats
+            the stats to add to, new ones by default.
+        Return
+        ------
+        ImageO
+            the new object.
+        """
+        image = cls.__new__(cls)
+        image._setup(StageStats() if stats is None else stats)
+        image._pixels = pixels
+        return image
+
+    def _output(self, output_file, returnable, out=None):
+        """
+        Hand back or save the image after a manipulation.
+
+        Parameter
+        ---------
+        output_file : string
+            the name of the file we want to output to.
+        returnable : bool
+            return the array instead of saving it when True.
+        out : numpy array
+            the array the manipulation wrote its result to instead of the image, if any.
+        Return
+        ------
+        numpy array
+            Return the numpy array of the image if returnable=True
+        """
+        result = self.infile if out is None else out
+        if returnable:
+            return result
+
+        if out is None:
+            self.save(output_file)
+        else:
+            ImageO.from_array(out, self.stats).save(output_file, **self.encoding)
+        return None
+
+    def set_threads(self, threads):
+        """
+        Set how many threads the operations split the image over, in bands of rows.
+
+        The result is the same to the byte as with one thread, block_image cuts its bands only
+        between rows of blocks.
+
+        Parameter
+        ---------
+        threads : int
+            the number of threads, 1 to do everything on the calling thread.
+        Return
+        ------
+        ImageO
+            this object, so that more can be chained on.
+        """
+        self.threads = max(1, int(threads))
+        return self
+
+    def set_engine(self, engine):
+        """
+        Pick the code the operations run with.
+
+        "fast" is the whole array code used by default. "reference" is plain per-pixel loops like
+        the ones the module started with, kept as the definition of what every operation gives,
+        with nothing fused or folded in to lookup tables. It is far too slow for real images and
+        is there to check the fast code against, both give the same pixels to the byte.
+
+        Parameter
+        ---------
+        engine : string
+            one of ENGINES.
+        Return
+        ------
+        ImageO
+            this object, so that more can be chained on.
+        """
+        if engine not in ENGINES:
+            raise ValueError(f"engine has to be one of {', '.join(ENGINES)}, not {engine!r}")
+        self.engine = engine
+        return self
+
+    def _kernel(self, fast, reference):
+        """
+        Pick the function for the engine of the image.
+
+        Parameter
+        ---------
+        fast : function
+            the function the fast engine uses.
+        reference : function
+            the per-pixel version the reference engine uses.
+        Return
+        ------
+        function
+            one of the two.
+        """
+        return reference if self.engine == "reference" else fast
+
+    def _regions(self, region):
+        """
+        Get views of the pixel array for the boxes of a region, split so that none overlap.
+
+        Parameter
+        ---------
+        region : tuple or list of tuple
+            the boxes, as the operations take, or None for the whole image.
+        Return
+        ------
+        list of numpy array
+            views in to the pixel array, writing to them changes the image.
+        """
+        pixels = self.infile
+        if region is None:
+            return [pixels]
+        boxes = _disjoint_boxes(_region_boxes(region, pixels.shape[1], pixels.shape[0]))
+        return [pixels[top:bottom, left:right] for left, top, right, bottom in boxes]
+
+    def _each_box(self, region, function):
+        """
+        Change every box of a region as if it was an image of its own.
+
+        Every box starts from the pixels the image had before any of them were changed, where
+        boxes overlap the last of them is kept. An operation on one pixel at a time gives the
+        same as on the boxes split apart, bi lays its blocks out over each whole box.
+
+        Parameter
+        ---------
+        region : tuple or list of tuple
+            the boxes, as the operations take.
+        function : function
+            called with the pixels of a box, changes them in place or returns the changed ones.
+        """
+        pixels = self.infile
+        boxes = _region_boxes(region, pixels.shape[1], pixels.shape[0])
+        views = [pixels[top:bottom, left:right] for left, top, right, bottom in boxes]
+        if _disjoint_boxes(boxes) != boxes:
+            # a box changed in place would change what a later box that overlaps it starts from.
+            results = [function(view.copy()) for view in views]
+        else:
+            results = [function(view) for view in views]
+        for view, result in zip(views, results):
+            if result is not view:
+                view[...] = result
+
+    def _in_bands(self, function, region=None):
+        """
+        Run an in place function that only looks at one pixel at a time over the image.
+
+        Parameter
+        ---------
+        function : function
+            called with a band of rows of the pixel array, on each of self.threads threads.
+        region : tuple or list of tuple
+            only run it on the pixels in these boxes, as the operations take.
+        """
+        for pixels in self._regions(region):
+            _run_bands(len(pixels), self.threads,
+                       lambda start, stop, pixels=pixels: function(pixels[start:stop]))
+
+    def _block_bands(self, row_runs, column_runs, pixels=None):
+        """
+        Average blocks of the image, cutting the bands for the threads only between block rows.
+
+        Parameter
+        ---------
+        row_runs : list of tuple
+            the runs of block rows, as returned by _block_runs.
+        column_runs : list of tuple
+            the runs of block columns, as returned by _block_runs.
+        pixels : numpy array
+            a view of the part of the image to average, the whole image when None.
+        """
+        if pixels is None:
+            pixels = self.infile
+        block_average = self._kernel(_block_average, _reference_block_average)
+
+        def band(start, stop):
+            block_average(pixels[start:stop], _runs_within(row_runs, start, stop), column_runs)
+
+        _run_bands(len(pixels), self.threads, band, _block_starts(row_runs))
+
+    def set_encoding(self, image_format=None, preset=None, **options):
+        """
+        Set the encoder settings every later save uses, including the ones the operations do.
+
+        Parameter
+        ---------
+        image_format : string
+            the format to save in such as "JPEG", "PNG" or "WEBP", from the file extension when
+            None.
+        preset : string
+            "fast" for quick low effort encoding or "small" for smaller files that take longer
+            to encode, see ENCODE_PRESETS.
+        options : keyword arguments
+            other settings for the encoder such as quality=90, subsampling="4:4:4",
+            optimize=True, progressive=True or compress_level=1, these win over the preset.
+        Return
+        ------
+        ImageO
+            this object, so that more can be chained on.
+        """
+        self.encoding = dict(options)
+        if image_format is not None:
+            self.encoding["format"] = image_format
+        if preset is not None:
+            self.encoding["preset"] = preset
+        return self
+
+    def save(self, output_file, **encoding):
+        """
+        Save the image as it is now.
+
+        Parameter
+        ---------
+        output_file : string or file object
+            the name of the file we want to output to, or a file object opened for writing in
+            binary, which is written as PNG unless a format is set.
+        encoding : keyword arguments
+            format, preset and encoder settings for just this save, on top of the ones from
+            set_encoding.
+        """
+        with self.stats.stage("encode") as stage:
+            stage["pixels"] = _pixel_count(self.infile)
+            save_image(to_image(self.infile), output_file, {**self.encoding, **encoding})
+
+    def to_bytes(self, **encoding):
+        """
+        Encode the image in memory instead of saving it to a file.
+
+        Parameter
+        ---------
+        encoding : keyword arguments
+            format, preset and encoder settings, as for save. PNG is used if no format is set.
+        Return
+        ------
+        bytes
+            the encoded image.
+        """
+        buffer = io.BytesIO()
+        self.save(buffer, **encoding)
+        return buffer.getvalue()
+
+    @classmethod
+    async def aopen(cls, input_file, profile=False, on_stage=None, pool=None, buffers=None):
+        """
+        Make an ImageO from a file like open does, without blocking the event loop.
+
+        Parameter
+        ---------
+        input_file : string
+            string of the file location to be read, relative or full path.
+        profile : bool
+            measure the peak memory of every stage in stats as well as the time.
+        on_stage : function
+            called every time a stage finishes, see StageStats.
+        pool : AsyncPool
+            the threads and limits to use, a default pool for the running event loop when None.
+        buffers : BufferPool
+            decode in to an array from this pool, given back by release.
+        Return
+        ------
+        ImageO
+            the new object, the pixels are decoded by the first aapply.
+        """
+        pool = _async_pool(pool)
+        async with pool.slot():
+            return await pool.run(cls.open, input_file, profile, on_stage, buffers)
+
+    async def aapply(self, operations, output_file=None, pool=None, **encoding):
+        """
+        Decode, run operations on and save the image without blocking the event loop.
+
+        The decode, the operations and the save are each run on the pool as one call, so a
+        cancelled task stops before the next of them. The image is left half done when that
+        happens and should not be used after.
+
+        Parameter
+        ---------
+        operations : list
+            the operations to run, the same as pipeline takes.
+        output_file : string or file object
+            where to save the result, it is not saved when None.
+        pool : AsyncPool
+            the threads and limits to use, a default pool for the running event loop when None.
+        encoding : keyword arguments
+            format, preset and encoder settings for the save, as for save.
+        Return
+        ------
+        ImageO
+            this object, so that more can be chained on.
+        """
+        pool = _async_pool(pool)
+        async with pool.slot():
+            if self._pixels is None and self._source is not None:
+                await pool.run(self._decode)
+            await pool.run(self.pipeline, operations)
+            if output_file is not None:
+                await pool.run(self.save, output_file, **encoding)
+        return self
+
+    async def ato_bytes(self, pool=None, **encoding):
+        """
+        Encode the image in memory like to_bytes does, without blocking the event loop.
+
+        Parameter
+        ---------
+        pool : AsyncPool
+            the threads and limits to use, a default pool for the running event loop when None.
+        encoding : keyword arguments
+            format, preset and encoder settings, as for save. PNG is used if no format is set.
+        Return
+        ------
+        bytes
+            the encoded image.
+        """
+        pool = _async_pool(pool)
+        async with pool.slot():
+            return await pool.run(self.to_bytes, **encoding)
+
+    def pipeline(self, operations, region=None, out=None):
+        """
+        Run a list of operations on the image one after the other without saving in between.
+
+        Runs of per-pixel operations are done together a strip of rows at a time rather than
+        going over the whole image once for each of them. Nothing is saved, call save after.
+
+        Parameter
+        ---------
+        operations : list
+            operation codes such as ["gs", "bi", "ic"], or (code, dict) pairs where the dict holds
+            keyword arguments for the matching method such as ("bi", {"block_size": 8}). Or what
+            plan gave back for them, to not group them again for every image.
+        region : tuple or list of tuple
+            only change the pixels inside this (left, top, right, bottom) box, or inside any of
+            these boxes. Each box is changed as if it was an image of its own, from the pixels
+            before any box was changed, and where boxes overlap the last one is kept, the same as
+            block_image does. Operations that change the size or channels of the whole image, rs
+            and a single channel gs, can not be used with it.
+        out : numpy array
+            an array of the shape and type of the result to write it in to, leaving this image
+            as it was. No new array is made for the result when the operations do not change the
+            shape of the image.
+        Return
+        ------
+        ImageO
+            this object, so that save can be chained on.
+        """
+        plan = operations if isinstance(operations, _Plan) else None
+        if plan is not None:
+            operations = plan.operations
+        if region is not None:
+            codes = [_parse_operation(operation) for operation in operations]
+            if any(code == "rs" or options.get("single_channel") for code, options in codes):
+                raise ValueError("rs and a single channel gs change the whole image, they can not"
+                                 " have a region")
+
+            def run(pixels):
+                return ImageO.from_array(pixels, self.stats).set_threads(
+                    self.threads).set_engine(self.engine).pipeline(operations).infile
+
+            with self._transform(out):
+                if (_is_gray(self.infile) and
+                        any(code in CHANNEL_OPERATIONS for code, _ in codes)):
+                    self.infile = _gray_to_color(self.infile)
+                self._each_box(region, run)
+            return self
+        if operations and self._pixels is None and self._source is not None:
+            code, options = _parse_operation(operations[0])
+            if code == "rs":
+                # a JPEG can be decoded smaller straight away when it is shrunk first.
+                self._draft_for(**options)
+        with self._transform(out):
+            if plan is None:
+                plan = self.plan(operations)
+            self._run_groups(plan.groups, plan.block_layouts)
+        return self
+
+    def plan(self, operations):
+        """
+        Group operations once to run them on many images with pipeline.
+
+        For running the same operations over many arrays, such as the frames of an animation or
+        the bands of a large image, without grouping them and making their lookup tables again
+        for every one. The plan holds for images that are gray or color like this one is, with
+        the engine this one has.
+
+        Parameter
+        ---------
+        operations : list
+            the operations, the same as pipeline takes.
+        Return
+        ------
+        object
+            the plan, to give to pipeline in place of the operations.
+        """
+        if self.engine == "reference":
+            return _Plan(operations, [("whole",) + _parse_operation(operation)
+                                      for operation in operations])
+        return _Plan(operations, _fuse_operations(operations, _is_gray(self.infile)))
+
+    def _run_groups(self, groups, block_layouts=None):
+        """
+        Run operations that have already been grouped on the image.
+
+        Parameter
+        ---------
+        groups : list of tuple
+            the groups of a _Plan.
+        block_layouts : dict
+            the index of a block_image group: the (row runs, column runs) to average its blocks
+            with, as from _block_runs, instead of laying the blocks out over this image.
+        """
+        for index, group in enumerate(groups):
+            if group[0] == "strips":
+                self._in_bands(functools.partial(_run_strips, functions=group[1]))
+            elif block_layouts and index in block_layouts:
+                self._block_bands(*block_layouts[index])
+            else:
+                getattr(self, _method_name(group[1]))(None, returnable=True, **group[2])
+
+    def fan_out(self, outputs, workers=None):
+        """
+        Make several outputs from this one decoded image, each with its own operations.
+
+        Every output starts from its own copy of the image as it is now, so the outputs do not
+        see each others changes and this image is left as it is. The copies, operations and saves
+        run on a pool of threads, the array operations and the encoders let go of the GIL so they
+        run side by side.
+
+        Parameter
+        ---------
+        outputs : dict
+            file name to save to: an operation or a list of operations to run for that file, the
+            same as pipeline takes.
+        workers : int
+            the most outputs to work on at the same time, the number of cpus by default.
+        """
+        # decode here, not in the first few threads to get to it all at once.
+        source = self.infile
+
+        def make_output(output_file, operations):
+            if isinstance(operations, (str, tuple, np.ndarray)):
+                operations = [operations]
+            # every branch has its own stats as a stage can not be timed from two threads at once.
+            branch = ImageO.from_array(None, StageStats(False, self.stats.callback))
+            branch.encoding = self.encoding
+            branch.threads = self.threads
+            branch.engine = self.engine
+            with branch.stats.stage("transform") as stage:
+                branch.infile = source.copy()
+                stage["pixels"] = _pixel_count(branch.infile)
+                branch.pipeline(operations)
+            branch.save(output_file)
+            return branch.stats
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(make_output, output_file, operations)
+                       for output_file, operations in outputs.items()]
+            for future in futures:
+                self.stats.merge(future.result())
+
+    def _clear(self, channels, region=None, out=None):
+        """
+        Zero out color channels of the image, making a gray image color first.
+
+        Parameter
+        ---------
+        channels : tuple of int
+            the indexes of the channels to set to zero.
+        region : tuple or list of tuple
+            the boxes to change, as the operations take.
+        out : numpy array
+            the array to write the result to, as the operations take.
+        """
+        with self._transform(out):
+            self.infile = _gray_to_color(self.infile)
+            self._in_bands(functools.partial(
+                self._kernel(_clear_channels, _reference_clear), channels), region)
+
+    def clear_red(self, output_file, returnable=False, region=None, out=None):
+        """
+        Clear all red in our image.
+
+        Parameter
+        ---------
+        output_file : string
+            the name of the file we want to output to.
+        region : tuple or list of tuple
+            only change the pixels inside this (left, top, right, bottom) box, or inside any of
+            these boxes, the rest of the image is not touched. The whole image when None.
+        out : numpy array
+            an array of the shape and type of the result to write it in to, leaving this image
+            as it was. No new array is made for the result when it is given.
+        Return
+        ------
+        numpy array
+            Return the numpy array of the image if returnable=True
+        """
+        self._clear((0,), region, out)
+        return self._output(output_file, returnable, out)
+
+    def clear_green(self, output_file, returnable=False, region=None, out=None):
+        """
+        Clear all green in our image.
+
+        Parameter
+        ---------
+        output_file : string
+            the name of the file we want to output to.
+        region : tuple or list of tuple
+            only change the pixels inside this (left, top, right, bottom) box, or inside any of
+            these boxes, the rest of the image is not touched. The whole image when None.
+        out : numpy array
+            an array of the shape and type of the result to write it in to, leaving this image
+            as it was. No new array is made for the result when it is given.
+        Return
+        ------
+        numpy array
+            Return the numpy array of the image if returnable=True
+        """
+        self._clear((1,), region, out)
+        return self._output(output_file, returnable, out)
+
+    def clear_blue(self, output_file, returnable=False, region=None, out=None):
+        """
+        Clear all blue in our image.
+
+        Parameter
+        ---------
+        output_file : string
+            the name of the file we want to output to.
+        region : tuple or list of tuple
+            only change the pixels inside this (left, top, right, bottom) box, or inside any of
+            these boxes, the rest of the image is not touched. The whole image when None.
+        out : numpy array
+            an array of the shape and type of the result to write it in to, leaving this image
+            as it was. No new array is made for the result when it is given.
+        Return
+        ------
+        numpy array
+            Return the numpy array of the image if returnable=True
+        """
+        self._clear((2,), region, out)
+        return self._output(output_file, returnable, out)
+
+    def red_only(self, output_file, returnable=False, region=None, out=None):
+        """
+        Clear all green and all blue of our image.
+
+        Parameter
+        ---------
+        output_file : string
+            the name of the file we want to output to.
+        region : tuple or list of tuple
+            only change the pixels inside this (left, top, right, bottom) box, or inside any of
+            these boxes, the rest of the image is not touched. The whole image when None.
+        out : numpy array
+            an array of the shape and type of the result to write it in to, leaving this image
+            as it was. No new array is made for the result when it is given.
+        Return
+        ------
+        numpy array
+            Return the numpy array of the image if returnable=True
+        """
+        self._clear((1, 2), region, out)
+        return self._output(output_file, returnable, out)
+
+    def green_only(self, output_file, returnable=False, region=None, out=None):
+        """
+        Clear all red and all blue of our image.
+
+        Parameter
+        ---------
+        output_file : string
+            the name of the file we want to output to.
+        region : tuple or list of tuple
+            only change the pixels inside this (left, top, right, bottom) box, or inside any of
+            these boxes, the rest of the image is not touched. The whole image when None.
+        out : numpy array
+            an array of the shape and type of the result to write it in to, leaving this image
+            as it was. No new array is made for the result when it is given.
+        Return
+        ------
+        numpy array
+            Return the numpy array of the image if returnable=True
+        """
+        self._clear((0, 2), region, out)
+        return self._output(output_file, returnable, out)
+
+    def blue_only(self, output_file, returnable=False, region=None, out=None):
+        """
+        Clear all red and all green of our image.
+
+        Parameter
+        ---------
+        output_file : string
+            the name of the file we want to output to.
+        region : tuple or list of tuple
+            only change the pixels inside this (left, top, right, bottom) box, or inside any of
+            these boxes, the rest of the image is not touched. The whole image when None.
+        out : numpy array
+            an array of the shape and type of the result to write it in to, leaving this image
+            as it was. No new array is made for the result when it is given.
+        Return
+        ------
+        numpy array
+            Return the numpy array of the image if returnable=True
+        """
+        self._clear((0, 1), region, out)
+        return self._output(output_file, returnable, out)
+
+    def lower_half(self, output_file, returnable=False, region=None, out=None):
+        """
+        Scale all shades to be only in the lower 127 of color ints.
+
+        Parameter
+        ---------
+        output_file : string
+            the name of the file we want to output to.
+        region : tuple or list of tuple
+            only change the pixels inside this (left, top, right, bottom) box, or inside any of
+            these boxes, the rest of the image is not touched. The whole image when None.
+        out : numpy array
+            an array of the shape and type of the result to write it in to, leaving this image
+            as it was. No new array is made for the result when it is given.
+        Return
+        ------
+        numpy array
+            Return the numpy array of the image if returnable=True
+        """
+        with self._transform(out):
+            self._in_bands(self._kernel(_lower_half, _reference_lower_half), region)
+        return self._output(output_file, returnable, out)
 
-    def __init__(self, input_file):
+    def upper_half(self, output_file, returnable=True, region=None, out=None):
         """
-        Initialize the object by taking an input_file and loading the image to an array.
+        Scale all shades to be only in the upper 127 of color ints.
 
         Parameter
         ---------
-        input_file : string
-            string of the file location to be read, relative or full path.
+        output_file : string
+            the name of the file we want to output to.
+        region : tuple or list of tuple
+            only change the pixels inside this (left, top, right, bottom) box, or inside any of
+            these boxes, the rest of the image is not touched. The whole image when None.
+        out : numpy array
+            an array of the shape and type of the result to write it in to, leaving this image
+            as it was. No new array is made for the result when it is given.
+        Return
+        ------
+        numpy array
+            Return the numpy array of the image if returnable=True
         """
-        try:
-            self.infile = np.array(Image.open(input_file))  # read in the file and store as a
-            # numpy array.
-        except FileNotFoundError:
-            # if that file did not exist then we warn the user and close the program.
-            print("Check your infile parameter, I can't find the file you put in!")
-            sys.exit()
+        with self._transform(out):
+            self._in_bands(self._kernel(_upper_half, _reference_upper_half), region)
+        return self._output(output_file, returnable, out)
 
-    def clear_red(self, output_file, returnable=False):
+    def gray_scale(self, output_file, returnable=False, *,  # pylint: disable=too-many-arguments
+                   weights="equal", single_channel=False, region=None, out=None):
         """
-        Clear all red in our image.
+        Convert the image to a grey-scale image.
+
+        Only integer math is used. With equal weights the grays are exactly the ones the average
+        of the three colors in floating point used to give.
+
+        Parameter
+        ---------
+        output_file : string
+            the name of the file we want to output to.
+        weights : string
+            "equal" to average the three colors, or "luma" to weigh them by how bright they look,
+            0.299 red, 0.587 green and 0.114 blue.
+        single_channel : bool
+            keep just the one gray channel, plus alpha if there is one, so the image is saved as
+            an "L" (or "LA") image a third of the size instead of three equal colors.
+        region : tuple or list of tuple
+            only change the pixels inside this (left, top, right, bottom) box, or inside any of
+            these boxes, the rest of the image is not touched. The whole image when None,
+            it can not be used with single_channel.
+        out : numpy array
+            an array of the shape and type of the result to write it in to, leaving this image
+            as it was. No new array is made for the result when it is given.
+        Return
+        ------
+        numpy array
+            Return the numpy array of the image if returnable=True
+        """
+        if single_channel and region is not None:
+            raise ValueError("single_channel changes the whole image, it can not have a region")
+        with self._transform(out):
+            if not single_channel:
+                self._in_bands(functools.partial(
+                    _run_strips, functions=[functools.partial(
+                        self._kernel(_gray_scale, _reference_gray_scale), weights=weights)]),
+                    region)
+            elif not _is_gray(self.infile):
+                pixels = self.infile
+                gray_values = self._kernel(_gray_values, _reference_gray_values)
+                gray = (out if out is not None and out.shape == pixels.shape[:2] else
+                        np.empty(pixels.shape[:2], pixels.dtype))
+
+                def band(start, stop):
+                    gray[start:stop] = gray_values(pixels[start:stop], weights)
+
+                _run_bands(len(pixels), self.threads, band)
+                self.infile = (np.dstack((gray, self.infile[..., 3])) if self.infile.shape[2] > 3
+                               else gray)
+        return self._output(output_file, returnable, out)
+
+    def invert_color(self, output_file, returnable=False, region=None, out=None):
+        """
+        Invert all rgb values of the image.
+
+        Parameter
+        ---------
+        output_file : string
+            the name of the file we want to output to.
+        region : tuple or list of tuple
+            only change the pixels inside this (left, top, right, bottom) box, or inside any of
+            these boxes, the rest of the image is not touched. The whole image when None.
+        out : numpy array
+            an array of the shape and type of the result to write it in to, leaving this image
+            as it was. No new array is made for the result when it is given.
+        Return
+        ------
+        numpy array
+            Return the numpy array of the image if returnable=True
+        """
+        with self._transform(out):
+            self._in_bands(self._kernel(_invert_color, _reference_invert_color), region)
+        return self._output(output_file, returnable, out)
+
+    def apply_lut(self, output_file, lut, returnable=False, region=None, out=None):
+        """
+        Look up every color value of the image in a table, such as one from gamma_lut.
+
+        Parameter
+        ---------
+        output_file : string
+            the name of the file we want to output to.
+        lut : array like
+            a table of 256 values used for every color, or a (3, 256) table for each color.
+        region : tuple or list of tuple
+            only change the pixels inside this (left, top, right, bottom) box, or inside any of
+            these boxes, the rest of the image is not touched. The whole image when None.
+        out : numpy array
+            an array of the shape and type of the result to write it in to, leaving this image
+            as it was. No new array is made for the result when it is given.
+        Return
+        ------
+        numpy array
+            Return the numpy array of the image if returnable=True
+        """
+        with self._transform(out):
+            lut_function = (functools.partial(_reference_lut, _as_lut(lut))
+                            if self.engine == "reference" else _lut_function(lut))
+            self._in_bands(functools.partial(_run_strips, functions=[lut_function]), region)
+        return self._output(output_file, returnable, out)
+
+    def block_image(self, output_file, returnable=False, *,  # pylint: disable=too-many-arguments
+                    block_size=None, number_of_blocks=None, draft=False, region=None, out=None):
+        """
+        Blurs or blocks an image, assigning a block size for an image making all pixels the same.
+
+        With no block_size or number_of_blocks this calls the common_denominator function to find
+        a common denominator within a range of two numbers for two numbers. This will be used to
+        determine the block width and height, and any pixels left over are not changed.
+
+        With a block_size or number_of_blocks the whole image is blocked, blocks at the edges that
+        do not divide evenly are averaged over just the pixels they have.
+
+        Parameter
+        ---------
+        output_file : string
+            the name of the file we want to output to.
+        block_size : int or tuple of int
+            the (height, width) of every block, or one int for square blocks.
+        number_of_blocks : int or tuple of int
+            the number of (rows, columns) of blocks, or one int for both.
+        draft : bool
+            when the image has not been decoded yet and every block lines up with a 2, 4 or 8
+            pixel grid, decode it that many times smaller, average the blocks there and scale it
+            back up. Much quicker on large JPEGs, but the averages are of the JPEG's own scaled
+            down pixels so they can be off by a little, and any pixels left over outside the
+            blocks come out blocky too. Not used with a region.
+        region : tuple or list of tuple
+            only block the pixels inside this (left, top, right, bottom) box, or inside each of
+            these boxes, the rest of the image is not touched. The blocks are laid out over each
+            box as they would be over an image of its size, from the pixels before any box was
+            blocked, and where boxes overlap the last one is kept. The whole image when None.
+        out : numpy array
+            an array of the shape and type of the result to write it in to, leaving this image
+            as it was. No new array is made for the result when it is given, and draft is not
+            used.
+        Return
+        ------
+        numpy array
+            Return the numpy array of the image if returnable=True
+        """
+        if region is not None:
+            def block(pixels):
+                self._block_bands(*_block_layout(pixels.shape[0], pixels.shape[1], block_size,
+                                                 number_of_blocks), pixels)
+                return pixels
+
+            with self._transform(out):
+                self._each_box(region, block)
+            return self._output(output_file, returnable, out)
+
+        columns, rows = self.size
+        row_runs, column_runs = _block_layout(rows, columns, block_size, number_of_blocks)
+        scale = 1
+        if draft and self._pixels is None and out is None:
+            scale = next((scale for scale in (8, 4, 2) if all(
+                start % scale == 0 and length % scale == 0
+                for start, length, _ in row_runs + column_runs)), 1)
+        if scale == 1:
+            with self._transform(out):
+                self._block_bands(row_runs, column_runs)
+            return self._output(output_file, returnable, out)
+
+        self._decode(scale)
+        with self._transform():
+            self._block_bands(_scale_runs(row_runs, scale), _scale_runs(column_runs, scale))
+            self.infile = np.repeat(np.repeat(self.infile, scale, axis=0), scale,
+                                    axis=1)[:rows, :columns]
+        return self._output(output_file, returnable)
+
+    def resize(self, output_file, returnable=False, size=None, scale=None, resample="lanczos"):
+        """
+        Resize the image.
+
+        A JPEG that has not been decoded yet and is shrunk to half its size or less is decoded
+        straight at 1/2, 1/4 or 1/8 of its size, still at least twice the new size.
 
         Parameter
         ---------
         output_file : string
             the name of the file we want to output to.
+        size : tuple of int
+            the (width, height) to make it, one of them None to keep the shape of the image.
+        scale : float
+            how many times the size to make it, used instead of size.
+        resample : string
+            the filter to use, one of RESAMPLING.
         Return
         ------
         numpy array
             Return the numpy array of the image if returnable=True
         """
-        for row in self.infile:
-            for column in row:
-                column[0] = 0
+        if resample not in RESAMPLING:
+            raise ValueError(f"resample has to be one of {', '.join(RESAMPLING)}, not"
+                             f" {resample!r}")
+        self._draft_for(size, scale)
+        columns, rows = self.size
+        target = _target_size(columns, rows, size, scale)
+        if target != (columns, rows):
+            with self._transform():
+                self.infile = _resample(self.infile,
+                                        lambda image: image.resize(target, RESAMPLING[resample]))
+        return self._output(output_file, returnable)
+
+    def pyramid(self, levels, operations=(), resample="lanczos"):
+        """
+        Save several sizes of the image from one decode, each size made from the next larger one.
+
+        The operations are run once on the image before it is resized, at the size it is decoded
+        at. That is the full size unless every level is half the size or less and the file is a
+        JPEG, then it is decoded smaller as for resize. This image is left as it was after the
+        operations.
+
+        Parameter
+        ---------
+        levels : list of tuple
+            (output file, size) or (output file, size, operations) for every size to save. The
+            size is a (width, height) as taken by resize, a float scale, or None for the full
+            size. The operations of a level are only run on that level, after the resize, and
+            not on the smaller levels made from it.
+        operations : list
+            the operations to run before resizing, the same as pipeline takes.
+        resample : string
+            the filter to use, one of RESAMPLING.
+        Return
+        ------
+        ImageO
+            this object, so that more can be chained on.
+        """
+        if resample not in RESAMPLING:
+            raise ValueError(f"resample has to be one of {', '.join(RESAMPLING)}, not"
+                             f" {resample!r}")
+        columns, rows = self.size
+        targets = []
+        for level in levels:
+            options = _resize_options(float(level[1]) if isinstance(level[1], (int, float))
+                                      else level[1])
+            targets.append((_target_size(columns, rows, **options), level[0],
+                            level[2] if len(level) > 2 else ()))
+        if not targets:
+            return self
+        # largest first, so every level is resized from the one just above it.
+        targets.sort(key=lambda target: target[0][0] * target[0][1], reverse=True)
+        self._draft_for(size=(max(target[0][0] for target in targets),
+                              max(target[0][1] for target in targets)))
+        self.pipeline(operations)
+
+        pixels = self.infile
+        for size, output_file, level_operations in targets:
+            if (pixels.shape[1], pixels.shape[0]) != size:
+                with self._transform():
+                    pixels = _resample(pixels,
+                                       lambda image, size=size: image.resize(
+                                           size, RESAMPLING[resample]))
+            level = ImageO.from_array(pixels.copy() if level_operations else pixels, self.stats)
+            level.encoding, level.threads = self.encoding, self.threads
+            level.engine = self.engine
+            if level_operations:
+                level.pipeline(level_operations)
+            level.save(output_file)
+        return self
+
+
+class ResultCache:
+    """
+    An on-disk cache of encoded results.
+
+    The same image with the same operations and encoder settings is only decoded, changed and
+    encoded once. Results are keyed by a hash of the input file's bytes, the operations and the
+    encoder settings, so a changed file or a changed setting is never served an old result. The
+    least recently used results are removed to keep the cache under max_bytes, and results not
+    used for max_age seconds are removed too, looked for at most once every AGE_CHECK_SECONDS by
+    put. Several processes can share a directory: results are written to a temporary file and
+    renamed in to place, so a reader sees a whole result or none, and a result removed by another
+    process is just a miss. The hits, misses, stores and evictions counters are for this object
+    only.
+    """
+
+    # bump when a change to the operations changes their results, so old results are not used.
+    VERSION = 1
+
+    # most seconds between put looking for results older than max_age, or max_age when shorter.
+    AGE_CHECK_SECONDS = 60
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024, max_age=None):
+        """
+        Initialize the cache, making the directory if it is not there.
+
+        Parameter
+        ---------
+        directory : string
+            the directory to keep the results in.
+        max_bytes : int
+            about the most bytes of results to keep.
+        max_age : float
+            remove results not used for this many seconds, kept however old when None.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._counts = dict.fromkeys(("hits", "misses", "stores", "evictions"), 0)
+        self._lock = threading.Lock()
+        # the bytes in the cache as last counted plus those stored since, None until counted.
+        self._size = None
+        # time.monotonic() of the last look for results older than max_age, None before any.
+        self._aged = None
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, input_file, operations, encoding):
+        """
+        Make the key of a result.
+
+        Parameter
+        ---------
+        input_file : string
+            the file the result is made from.
+        operations : list
+            the operations, the same as pipeline takes.
+        encoding : dict
+            the encoder settings, with the format worked out.
+        Return
+        ------
+        string
+            the hex sha256 of it all.
+        """
+        digest = hashlib.sha256()
+        with open(input_file, "rb") as source:
+            for chunk in iter(functools.partial(source.read, 1024 * 1024), b""):
+                digest.update(chunk)
+
+        def array_key(value):
+            # lookup tables are keyed by their bytes.
+            value = np.asarray(value)
+            return [str(value.dtype), value.shape, hashlib.sha256(value.tobytes()).hexdigest()]
+
+        settings = [self.VERSION, [_parse_operation(operation) for operation in operations],
+                    encoding]
+        digest.update(json.dumps(settings, sort_keys=True, default=array_key).encode())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        """Find the file a result is kept in."""
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """
+        Look up a result, marking it as just used.
+
+        Parameter
+        ---------
+        key : string
+            the key from key.
+        Return
+        ------
+        bytes
+            the encoded result, or None when it is not in the cache.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as cached:
+                data = cached.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._counts["misses"] += 1
+            return None
+        with self._lock:
+            self._counts["hits"] += 1
+        return data
+
+    def put(self, key, data):
+        """
+        Store a result, removing old ones if the cache is then too big.
+
+        Parameter
+        ---------
+        key : string
+            the key from key.
+        data : bytes
+            the encoded result.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as cached:
+                cached.write(data)
+            os.replace(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise
+        with self._lock:
+            self._counts["stores"] += 1
+            if self._size is not None:
+                self._size += len(data)
+            full = self._size is None or self._size > self.max_bytes
+            # every result has to be looked at to find old ones, so it is not done on every put.
+            aged = self.max_age is not None and (
+                self._aged is None
+                or time.monotonic() - self._aged >= min(self.max_age, self.AGE_CHECK_SECONDS))
+        if full or aged:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used results over max_bytes and any older than max_age."""
+        entries = []
+        for parent in os.scandir(self.directory):
+            if not parent.is_dir():
+                continue
+            for entry in os.scandir(parent.path):
+                if entry.name.startswith(".tmp"):
+                    continue
+                try:
+                    status = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((status.st_mtime, status.st_size, entry.path))
+        entries.sort()
+        size = sum(entry[1] for entry in entries)
+        oldest = None if self.max_age is None else time.time() - self.max_age
+        removed = 0
+        for used, entry_size, path in entries:
+            if size <= self.max_bytes and (oldest is None or used >= oldest):
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        with self._lock:
+            self._counts["evictions"] += removed
+            self._size = size
+            if self.max_age is not None:
+                self._aged = time.monotonic()
+
+    def process(self, input_file, output_file, operations, stats=None, threads=1, **encoding):
+        """
+        Save the result of running operations on an image, from the cache when it is there.
+
+        Parameter
+        ---------
+        input_file : string
+            the file to read.
+        output_file : string or file object
+            where to save the result.
+        operations : list
+            the operations to run, the same as pipeline takes.
+        stats : StageStats
+            stats to add the stages to when it is not in the cache.
+        threads : int
+            the number of threads to split the image over when it is not in the cache.
+        encoding : keyword arguments
+            format, preset and encoder settings, as for ImageO.save.
+        Return
+        ------
+        bool
+            True when the result came from the cache.
+        """
+        image_format = encode_format(output_file, encoding.get("format"))
+        if image_format is None:
+            raise ValueError(f"unknown file extension: {output_file}")
+        encoding = dict(encoding, format=image_format)
+        key = self.key(input_file, operations, encoding)
+        data = self.get(key)
+        hit = data is not None
+        if not hit:
+            image = ImageO.open(input_file).set_threads(threads)
+            if stats is not None:
+                image.stats = stats
+            data = image.pipeline(operations).to_bytes(**encoding)
+            self.put(key, data)
+        if isinstance(output_file, (str, os.PathLike)):
+            with open(output_file, "wb") as output:
+                output.write(data)
+        else:
+            output_file.write(data)
+        return hit
+
+    def counters(self):
+        """
+        Get the counters, for sizing the cache.
+
+        Return
+        ------
+        dict
+            "hits", "misses", "stores", "evictions" and "hit_rate" the share of lookups that
+            were hits.
+        """
+        with self._lock:
+            lookups = self._counts["hits"] + self._counts["misses"]
+            return dict(self._counts,
+                        hit_rate=self._counts["hits"] / lookups if lookups else 0.0)
+
+
+def _size_spec(text):
+    """
+    Read a size from the command line.
+
+    Parameter
+    ---------
+    text : string
+        "WIDTHxHEIGHT" with either left out to keep the shape such as "800x", a scale such as
+        "0.5", or "full" for the size of the image.
+    Return
+    ------
+    tuple, float or None
+        the (width, height) with None for a left out one, the scale, or None for full.
+    """
+    if text == "full":
+        return None
+    if "x" not in text:
+        return float(text)
+    width, height = text.split("x")
+    if not width and not height:
+        raise argparse.ArgumentTypeError("a size needs a width, a height or both")
+    return int(width) if width else None, int(height) if height else None
+
+
+def _resize_options(spec):
+    """
+    Turn a size from _size_spec in to the keyword arguments of resize.
+
+    Parameter
+    ---------
+    spec : tuple, float or None
+        the size.
+    Return
+    ------
+    dict
+        "size" or "scale".
+    """
+    if spec is None:
+        return {"scale": 1}
+    return {"scale": spec} if isinstance(spec, float) else {"size": spec}
+
+
+def iter_frames(input_file, operations, stats=None, threads=1):
+    """
+    Decode, change and give back the frames of an animated or multi-page image one at a time.
+
+    Only the frame being worked on is in memory, however many frames there are. The operations
+    are grouped and any lookup tables built once for all the frames.
+
+    Parameter
+    ---------
+    input_file : string
+        the file to read, any image works and one with a single frame gives one frame.
+    operations : list
+        the operations to run on every frame, the same as pipeline takes.
+    stats : StageStats
+        stats to add the decode and transform stages of every frame to.
+    threads : int
+        the number of threads to split every frame over, see ImageO.set_threads.
+    Return
+    ------
+    generator of tuple
+        (pixel array, dict of "duration" in milliseconds and on the first frame "loop", for the
+        ones the file has) for every frame.
+    """
+    if stats is None:
+        stats = StageStats()
+    # the plans for a gray and for a color frame, made when the first of each comes up.
+    plans = {}
+    with Image.open(input_file) as source:
+        for index in range(getattr(source, "n_frames", 1)):
+            with stats.stage("decode") as stage:
+                source.seek(index)
+                pixels = np.array(native_image(source))
+                stage["pixels"] = _pixel_count(pixels)
+            keys = ("duration", "loop") if index == 0 else ("duration",)
+            info = {key: source.info[key] for key in keys if key in source.info}
+            image = ImageO.from_array(pixels, stats).set_threads(threads)
+            gray = _is_gray(pixels)
+            if gray not in plans:
+                plans[gray] = image.plan(operations)
+            yield image.pipeline(plans[gray]).infile, info
+
+
+def _gif_frame(pixels):
+    """
+    Turn the pixels of a frame in to a palette image for GIF, with its own palette.
+
+    Parameter
+    ---------
+    pixels : numpy array
+        the pixel array of the frame.
+    Return
+    ------
+    tuple
+        (the "P" image, True when it has transparent pixels, which use index 255).
+    """
+    image = to_image(pixels if pixels.dtype == np.uint8 else (pixels >> 8).astype(np.uint8))
+    palette_image = image.convert("RGB").quantize(255)
+    if pixels.ndim == 2 or pixels.shape[2] not in (2, 4):
+        return palette_image, False
+    transparent = pixels[..., -1] < (int(np.iinfo(pixels.dtype).max) + 1) // 2
+    if not transparent.any():
+        return palette_image, False
+    indexes = np.array(palette_image)
+    indexes[transparent] = 255
+    palette = palette_image.getpalette()[:255 * 3]
+    frame = Image.fromarray(indexes, "P")
+    frame.putpalette(palette + [0] * (768 - len(palette)))
+    return frame, True
+
+
+def _write_gif(frames, output, encoding, stats):
+    """
+    Write frames to a GIF one at a time, every frame with its own palette.
+
+    Parameter
+    ---------
+    frames : iterable of tuple
+        (pixel array, info dict) for every frame, as from iter_frames.
+    output : file object
+        the file to write to.
+    encoding : dict
+        "loop" and "duration" to use instead of the ones of the frames.
+    stats : StageStats
+        stats to add the encode stage of every frame to.
+    """
+    for index, (pixels, info) in enumerate(frames):
+        with stats.stage("encode") as stage:
+            stage["pixels"] = _pixel_count(pixels)
+            frame, transparent = _gif_frame(pixels)
+            if index == 0:
+                loop = encoding.get("loop", info.get("loop"))
+                header, _ = GifImagePlugin.getheader(frame, info={} if loop is None
+                                                     else {"loop": loop})
+                output.write(b"".join(header))
+            options = {"include_color_table": True}
+            duration = encoding.get("duration", info.get("duration"))
+            if duration:
+                options["duration"] = duration
+            if transparent:
+                # clear the frame before the next so see-through parts do not show old frames.
+                options.update(transparency=255, disposal=2)
+            output.write(b"".join(GifImagePlugin.getdata(frame, **options)))
+    output.write(b";")
+
+
+def _write_tiff(frames, output, encoding, stats):
+    """
+    Write frames to a multi-page TIFF one page at a time.
+
+    Parameter
+    ---------
+    frames : iterable of tuple
+        (pixel array, info dict) for every frame, as from iter_frames.
+    output : file object
+        the file to write to, opened for reading and writing.
+    encoding : dict
+        the encoder settings for every page, such as "compression".
+    stats : StageStats
+        stats to add the encode stage of every frame to.
+    """
+    with TiffImagePlugin.AppendingTiffWriter(output) as pages:
+        for pixels, _ in frames:
+            with stats.stage("encode") as stage:
+                stage["pixels"] = _pixel_count(pixels)
+                save_image(to_image(pixels), pages, dict(encoding, format="TIFF"))
+                pages.newFrame()
+
+
+def process_frames(input_file, output_file, operations,  # pylint: disable=too-many-arguments
+                   *, stats=None, encoding=None, threads=1):
+    """
+    Run operations on every frame of an animated GIF or multi-page TIFF and save them all.
+
+    GIF and TIFF outputs are written a frame at a time as the frames come out of iter_frames, so
+    memory stays at about one frame. The frame durations and the loop count are kept. PNG and
+    WEBP can hold frames too but PIL only writes them all at once, so they are all kept in
+    memory.
+
+    Parameter
+    ---------
+    input_file : string
+        the file to read.
+    output_file : string or file object
+        where to save the result, a file object for TIFF has to be open for reading and writing.
+    operations : list
+        the operations to run on every frame, the same as pipeline takes.
+    stats : StageStats
+        stats to add the decode, transform and encode stages of every frame to.
+    encoding : dict
+        format and encoder settings, as for ImageO.save, "loop" and "duration" can be given to
+        use instead of the ones of the input.
+    threads : int
+        the number of threads to split every frame over, see ImageO.set_threads.
+    """
+    encoding = dict(encoding or {})
+    image_format = encode_format(output_file, encoding.pop("format", None))
+    if image_format not in FRAME_FORMATS:
+        raise ValueError(f"{image_format} can not hold several frames, use one of"
+                         f" {', '.join(FRAME_FORMATS)}")
+    if stats is None:
+        stats = StageStats()
+    frames = iter_frames(input_file, operations, stats, threads)
+    if image_format in ("PNG", "WEBP"):
+        frames = list(frames)
+        with stats.stage("encode") as stage:
+            stage["pixels"] = sum(_pixel_count(pixels) for pixels, _ in frames)
+            images = [to_image(pixels) for pixels, _ in frames]
+            durations = [info.get("duration", 0) for _, info in frames]
+            options = {"save_all": True, "append_images": images[1:],
+                       "duration": durations, "loop": frames[0][1].get("loop", 0)}
+            options.update(encoding, format=image_format)
+            save_image(images[0], output_file, options)
+        return
+    writer = _write_gif if image_format == "GIF" else _write_tiff
+    if isinstance(output_file, (str, os.PathLike)):
+        with open(output_file, "w+b") as output:
+            writer(frames, output, encoding, stats)
+    else:
+        writer(frames, output_file, encoding, stats)
+
+
+def _frame_count(input_file):
+    """
+    Count the frames of an image file without decoding it.
+
+    Parameter
+    ---------
+    input_file : string
+        the file to look at.
+    Return
+    ------
+    int
+        the number of frames or pages, 1 for a still image.
+    """
+    with Image.open(input_file) as image:
+        return getattr(image, "n_frames", 1)
+
+
+# the arrays every batch or worker process decodes in to, images of one size share memory.
+_BATCH_BUFFERS = BufferPool()
+
+
+def _process_file(job):
+    """
+    Read, change and save one image for process_batch, catching any error.
+
+    Parameter
+    ---------
+    job : tuple
+        the (input file, output file, operations, measure memory, encoder settings) to do.
+    Return
+    ------
+    tuple
+        (input file, output file, error message or None when it worked, seconds taken, dict of
+        the stage stats).
+    """
+    input_file, output_file, operations, profile, encoding = job
+    start = time.perf_counter()
+    stats = StageStats(profile)
+    try:
+        output_directory = os.path.dirname(output_file)
+        if output_directory:
+            os.makedirs(output_directory, exist_ok=True)
+        image = ImageO.open(input_file, profile=profile, buffers=_BATCH_BUFFERS)
+        stats = image.stats
+        try:
+            image.pipeline(operations).save(output_file, **encoding)
+        finally:
+            image.release()
+        error = None
+    except Exception as exception:  # pylint: disable=broad-except
+        # one bad file should not stop the rest of the batch, it is reported in the summary.
+        error = f"{type(exception).__name__}: {exception}"
+    return input_file, output_file, error, time.perf_counter() - start, stats.as_dict()
+
+
+def process_batch(jobs, operations, workers=None, profile=False, encoding=None):
+    """
+    Run the same operations on many images using a pool of processes.
+
+    Every process reads, changes and saves whole images, so a batch pays for starting python,
+    numpy and PIL once per process instead of once per image. A file that fails is reported in the
+    results and does not stop the others.
+
+    Parameter
+    ---------
+    jobs : list of tuple
+        (input file, output file) pairs.
+    operations : list
+        the operations to run on every image, the same as pipeline takes.
+    workers : int
+        the number of processes to use, the number of cpus by default.
+    profile : bool
+        measure the peak memory of every stage as well as the time.
+    encoding : dict
+        the encoder settings to save every image with, see ImageO.save.
+    Return
+    ------
+    list of tuple
+        (input file, output file, error message or None when it worked, seconds taken, dict of
+        the stage stats as from StageStats.as_dict) for every job, in the order given.
+    """
+    jobs = [(input_file, output_file, operations, profile, encoding or {})
+            for input_file, output_file in jobs]
+    if not jobs:
+        return []
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # larger chunks cut down on the pickling back and forth when there are many small files.
+        return list(executor.map(_process_file, jobs,
+                                 chunksize=max(1, min(16, len(jobs) // (workers * 4)))))
+
+
+def _batch_inputs(source, manifest=False):
+    """
+    Find the files a batch should run on.
+
+    Parameter
+    ---------
+    source : string
+        a directory to take every image in, a glob pattern, or with manifest a text file with one
+        input file per line, optionally followed by a tab and the output file to use for it.
+    manifest : bool
+        read source as a manifest file.
+    Return
+    ------
+    list of tuple
+        (input file, output file or None to use the output template) pairs.
+    """
+    if manifest:
+        with open(source, encoding="utf-8") as manifest_file:
+            lines = [line.rstrip("\n").split("\t") for line in manifest_file if line.strip()]
+        return [(line[0], line[1] if len(line) > 1 else None) for line in lines]
+    if os.path.isdir(source):
+        extensions = Image.registered_extensions()
+        return [(os.path.join(source, name), None) for name in sorted(os.listdir(source))
+                if os.path.splitext(name)[1].lower() in extensions and
+                os.path.isfile(os.path.join(source, name))]
+    return [(name, None) for name in sorted(glob.glob(source, recursive=True))]
+
+
+def _run_job(job, profile=False, cache=None):
+    """
+    Run one worker job and make the record of how it went.
+
+    Parameter
+    ---------
+    job : dict
+        "in" the file to read, "out" the file to save to, "ops" the operations as pipeline takes
+        them, with [code, options] lists for pairs, and optionally an "id" to send back and an
+        "encode" object of encoder settings as ImageO.save takes.
+    profile : bool
+        measure the peak memory of every stage as well as the time.
+    cache : ResultCache
+        the cache to look for and keep results in, if any.
+    Return
+    ------
+    dict
+        "id", "in", "out", "ok", "error" with the message when it failed, "seconds", "stages"
+        with the stage stats and with a cache "cached" if the result came from it.
+    """
+    record = {"id": job.get("id"), "in": job.get("in"), "out": job.get("out")}
+    start = time.perf_counter()
+    stats = StageStats(profile)
+    try:
+        if cache is not None:
+            record["cached"] = cache.process(job["in"], job["out"], job.get("ops", []), stats,
+                                             **job.get("encode", {}))
+        else:
+            image = ImageO.open(job["in"], profile=profile, buffers=_BATCH_BUFFERS)
+            stats = image.stats
+            try:
+                image.pipeline(job.get("ops", []))
+                image.save(job["out"], **job.get("encode", {}))
+            finally:
+                image.release()
+        record.update(ok=True, error=None)
+    except Exception as exception:  # pylint: disable=broad-except
+        # a job that fails is reported back and the worker carries on with the next one.
+        record.update(ok=False, error=f"{type(exception).__name__}: {exception}")
+    record.update(seconds=time.perf_counter() - start, stages=stats.as_dict())
+    return record
+
+
+def serve_jobs(lines, write, executor, *,  # pylint: disable=too-many-arguments
+               in_flight=16, profile=False, cache=None):
+    """
+    Run JSON-lines jobs, writing a JSON result line for each one as soon as it is done.
+
+    Results come back in the order the jobs finish, each job can give an "id" to match them up
+    with, the line number is used when it does not. A line that is not a JSON object gets an error
+    result like a job that failed.
+
+    Parameter
+    ---------
+    lines : iterable of string
+        the job lines, as described in _run_job.
+    write : function
+        called with each result line, from whichever thread finished the job.
+    executor : concurrent.futures.Executor
+        runs the jobs.
+    in_flight : int
+        the most jobs read in but not yet done, reading waits when there are this many.
+    profile : bool
+        measure the peak memory of every stage as well as the time.
+    cache : ResultCache
+        the cache to look for and keep results in, if any.
+    """
+    lock = threading.Lock()
+    slots = threading.Semaphore(in_flight)
+
+    def send(record):
+        with lock:
+            write(json.dumps(record) + "\n")
+
+    def finish(future):
+        try:
+            send(future.result())
+        finally:
+            slots.release()
+
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            job = json.loads(line)
+            if not isinstance(job, dict):
+                raise ValueError("a job has to be a JSON object")
+        except ValueError as exception:
+            send({"id": number, "ok": False, "error": f"bad job line: {exception}"})
+            continue
+        job.setdefault("id", number)
+        slots.acquire()  # pylint: disable=consider-using-with
+        executor.submit(_run_job, job, profile, cache).add_done_callback(finish)
+    # every slot is free again once the last result has been written.
+    for _ in range(in_flight):
+        slots.acquire()  # pylint: disable=consider-using-with
+
 
-        if returnable:
-            return self.infile
+class _JobHandler(socketserver.StreamRequestHandler):
+    """Run the jobs sent over one connection to the worker socket, sending the results back."""
 
-        Image.fromarray(self.infile, "RGB").save(output_file)
-        return None
+    def handle(self):
+        """Serve the jobs of this connection until it is closed."""
+        def write(text):
+            self.wfile.write(text.encode())
+            self.wfile.flush()
 
-    def clear_green(self, output_file, returnable=False):
-        """
-        Clear all green in our image.
+        serve_jobs((line.decode() for line in self.rfile), write, self.server.executor,
+                   in_flight=self.server.in_flight, profile=self.server.profile,
+                   cache=self.server.cache)
 
-        Parameter
-        ---------
-        output_file : string
-            the name of the file we want to output to.
-        Return
-        ------
-        numpy array
-            Return the numpy array of the image if returnable=True
-        """
-        for row in self.infile:
-            for column in row:
-                column[1] = 0
 
-        if returnable:
-            return self.infile
+def _free_socket(path):
+    """
+    Make sure a worker can listen on a unix socket, removing one left by a worker that stopped.
 
-        Image.fromarray(self.infile, "RGB").save(output_file)
+    Parameter
+    ---------
+    path : string
+        where the socket goes.
+    Return
+    ------
+    string or None
+        why the path can not be used, None when nothing is there any more.
+    """
+    if not os.path.lexists(path):
         return None
+    if not stat.S_ISSOCK(os.lstat(path).st_mode):
+        return f"{path} is already there and is not a socket, give --socket another path."
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(path)
+        except ConnectionRefusedError:
+            os.remove(path)
+            return None
+    return f"Another worker is listening on {path}."
 
-    def clear_blue(self, output_file, returnable=False):
-        """
-        Clear all blue in our image.
 
-        Parameter
-        ---------
-        output_file : string
-            the name of the file we want to output to.
-        Return
-        ------
-        numpy array
-            Return the numpy array of the image if returnable=True
-        """
-        for row in self.infile:
-            for column in row:
-                column[2] = 0
+def _worker_main(argv):
+    """
+    Run the worker command line, serving jobs until standard in is closed or it is stopped.
 
-        if returnable:
-            return self.infile
+    Parameter
+    ---------
+    argv : list of string
+        the arguments after the word worker.
+    Return
+    ------
+    int
+        the exit status.
+    """
+    parser = argparse.ArgumentParser(
+        prog="image_manipulation.py worker",
+        description="Stay running and take jobs as JSON lines such as"
+                    ' {"in": "a.jpg", "out": "b.jpg", "ops": ["gs", "bi"]},'
+                    " sending a JSON result line back for every job.")
+    parser.add_argument("--socket", type=str, metavar="PATH",
+                        help="Listen on a unix socket at PATH instead of reading standard in.")
+    parser.add_argument("--concurrency", type=int, default=None,
+                        help="The most jobs to run at the same time, the number of cpus by"
+                             " default.")
+    parser.add_argument("--profile", action="store_true",
+                        help="Measure peak memory in the stage stats of every result. Stages"
+                             " that measure memory run one at a time.")
+    _add_cache_arguments(parser)
+    args = parser.parse_args(argv)
 
-        Image.fromarray(self.infile, "RGB").save(output_file)
-        return None
+    problem = None if args.socket is None else _free_socket(args.socket)
+    if problem is not None:
+        print(problem)
+        return 1
+    cache = _cache(args)
+    concurrency = args.concurrency or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        if args.socket is None:
+            def write(text):
+                sys.stdout.write(text)
+                sys.stdout.flush()
 
-    def red_only(self, output_file, returnable=False):
-        """
-        Clear all green and all blue of our image.
+            serve_jobs(sys.stdin, write, executor, in_flight=2 * concurrency,
+                       profile=args.profile, cache=cache)
+            return 0
+        server = socketserver.ThreadingUnixStreamServer(args.socket, _JobHandler)
+        server.executor = executor
+        server.in_flight = 2 * concurrency
+        server.profile = args.profile
+        server.cache = cache
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(args.socket)
+    return 0
 
-        Parameter
-        ---------
-        output_file : string
-            the name of the file we want to output to.
-        Return
-        ------
-        numpy array
-            Return the numpy array of the image if returnable=True
-        """
-        for row in self.infile:
-            for column in row:
-                column[1] = 0
-                column[2] = 0
 
-        if returnable:
-            return self.infile
+def _add_profile_arguments(parser):
+    """
+    Add the --profile and --profile-json options to a command line parser.
 
-        Image.fromarray(self.infile, "RGB").save(output_file)
-        return None
+    Parameter
+    ---------
+    parser : argparse.ArgumentParser
+        the parser to add to.
+    """
+    parser.add_argument("--profile", action="store_true",
+                        help="Print the time, megapixels a second and peak memory of the decode,"
+                             " transform and encode stages.")
+    parser.add_argument("--profile-json", type=str, metavar="FILE",
+                        help="Write the stage stats as JSON to FILE, - for standard out.")
 
-    def green_only(self, output_file, returnable=False):
-        """
-        Clear all red and all blue of our image.
 
-        Parameter
-        ---------
-        output_file : string
-            the name of the file we want to output to.
-        Return
-        ------
-        numpy array
-            Return the numpy array of the image if returnable=True
-        """
-        for row in self.infile:
-            for column in row:
-                column[0] = 0
-                column[2] = 0
+def _add_resize_arguments(parser):
+    """
+    Add the options for the rs operation to a command line parser.
 
-        if returnable:
-            return self.infile
+    Parameter
+    ---------
+    parser : argparse.ArgumentParser
+        the parser to add to.
+    """
+    parser.add_argument("--resize", type=_size_spec, default=False, metavar="SIZE",
+                        help="The size rs makes the image: WIDTHxHEIGHT, 800x or x600 to keep"
+                             " the shape, or a scale such as 0.5.")
+    parser.add_argument("--resample", choices=list(RESAMPLING), default="lanczos",
+                        help="The filter rs and --pyramid resize with.")
 
-        Image.fromarray(self.infile, "RGB").save(output_file)
-        return None
 
-    def blue_only(self, output_file, returnable=False):
-        """
-        Clear all red and all green of our image.
+def _add_cache_arguments(parser):
+    """
+    Add the options for the result cache to a command line parser.
 
-        Parameter
-        ---------
-        output_file : string
-            the name of the file we want to output to.
-        Return
-        ------
-        numpy array
-            Return the numpy array of the image if returnable=True
-        """
-        for row in self.infile:
-            for column in row:
-                column[0] = 0
-                column[1] = 0
+    Parameter
+    ---------
+    parser : argparse.ArgumentParser
+        the parser to add to.
+    """
+    parser.add_argument("--cache-dir", type=str, metavar="DIR",
+                        help="Keep results in DIR and reuse them when the same file is run with"
+                             " the same operations and encoder settings again. Not used with"
+                             " --fan-out, --memory-budget or --preview.")
+    parser.add_argument("--cache-size", type=float, default=1024, metavar="MB",
+                        help="About the most megabytes of results to keep in the cache.")
+    parser.add_argument("--cache-age", type=float, metavar="HOURS",
+                        help="Remove results from the cache that have not been used for this"
+                             " many hours.")
 
-        if returnable:
-            return self.infile
 
-        Image.fromarray(self.infile, "RGB").save(output_file)
+def _cache(args):
+    """
+    Make the result cache asked for on the command line.
+
+    Parameter
+    ---------
+    args : argparse.Namespace
+        the parsed arguments.
+    Return
+    ------
+    ResultCache
+        the cache, or None when no --cache-dir was given.
+    """
+    if args.cache_dir is None:
         return None
+    return ResultCache(args.cache_dir, int(args.cache_size * 1024 * 1024),
+                       None if args.cache_age is None else args.cache_age * 3600)
 
-    def lower_half(self, output_file, returnable=False):
-        """
-        Scale all shades to be only in the lower 127 of color ints.
 
-        Parameter
-        ---------
-        output_file : string
-            the name of the file we want to output to.
-        Return
-        ------
-        numpy array
-            Return the numpy array of the image if returnable=True
-        """
-        for row in self.infile:
-            for column in row:
-                column[0] = column[0]/2
-                column[1] = column[1]/2
-                column[2] = column[2]/2
+def _add_encode_arguments(parser):
+    """
+    Add the options for the encoder settings to a command line parser.
 
-        if returnable:
-            return self.infile
+    Parameter
+    ---------
+    parser : argparse.ArgumentParser
+        the parser to add to.
+    """
+    parser.add_argument("--format", type=str, metavar="FORMAT",
+                        help="The format to save in such as JPEG, PNG or WEBP, by default from"
+                             " the outfile extension.")
+    parser.add_argument("--encode-preset", choices=sorted(ENCODE_PRESETS),
+                        help="fast for quick low effort encoding, small for smaller files that"
+                             " take longer to encode.")
+    parser.add_argument("--quality", type=int, metavar="Q",
+                        help="The quality to save JPEG or WEBP files at, 1 to 100.")
+    parser.add_argument("--subsampling", choices=["4:4:4", "4:2:2", "4:2:0"],
+                        help="The JPEG chroma subsampling.")
+    parser.add_argument("--optimize", action="store_true",
+                        help="Spend longer encoding to make the file smaller.")
+    parser.add_argument("--progressive", action="store_true",
+                        help="Save a progressive JPEG.")
+    parser.add_argument("--compress-level", type=int, choices=range(10), metavar="0-9",
+                        help="The PNG zlib level, 1 is fastest and 9 smallest.")
 
-        Image.fromarray(self.infile, "RGB").save(output_file)
-        return None
 
-    def upper_half(self, output_file, returnable=True):
-        """
-        Scale all shades to be only in the upper 127 of color ints.
+def _encoding(args):
+    """
+    Make the encoder settings asked for on the command line.
 
-        Parameter
-        ---------
-        output_file : string
-            the name of the file we want to output to.
-        Return
-        ------
-        numpy array
-            Return the numpy array of the image if returnable=True
-        """
-        for row in self.infile:
-            for column in row:
-                column[0] = column[0]/2 + 128
-                column[1] = column[1]/2 + 128
-                column[2] = column[2]/2 + 128
+    Parameter
+    ---------
+    args : argparse.Namespace
+        the parsed arguments.
+    Return
+    ------
+    dict
+        the settings given, as ImageO.save takes them.
+    """
+    encoding = {"format": args.format, "preset": args.encode_preset, "quality": args.quality,
+                "subsampling": args.subsampling, "compress_level": args.compress_level,
+                "optimize": args.optimize or None, "progressive": args.progressive or None}
+    return {name: value for name, value in encoding.items() if value is not None}
 
-        if returnable:
-            return self.infile
 
-        Image.fromarray(self.infile, "RGB").save(output_file)
-        return None
+def _profiling(args):
+    """
+    Check if a profile was asked for on the command line.
 
-    def gray_scale(self, output_file, returnable=False):
-        """
-        Convert the image to a grey-scale image.
+    Parameter
+    ---------
+    args : argparse.Namespace
+        the parsed arguments.
+    Return
+    ------
+    bool
+        True when --profile or --profile-json was given.
+    """
+    return args.profile or args.profile_json is not None
 
-        Parameter
-        ---------
-        output_file : string
-            the name of the file we want to output to.
-        Return
-        ------
-        numpy array
-            Return the numpy array of the image if returnable=True
-        """
-        for row in self.infile:
-            for column in row:
-                # to transform a pixel to its gray-scale form we find the average of the three
-                # colors.
-                new_value = (column[0]*(1/3)) + (column[1]*(1/3)) +\
-                                                  (column[2]*(1/3))
-                column[0] = new_value
-                column[1] = new_value
-                column[2] = new_value
 
-        if returnable:
-            return self.infile
+def _show_profile(args, stats):
+    """
+    Print or write out the stage stats as asked for on the command line.
 
-        Image.fromarray(self.infile, "RGB").save(output_file)
-        return None
+    Parameter
+    ---------
+    args : argparse.Namespace
+        the parsed arguments.
+    stats : StageStats
+        the stats to show.
+    """
+    if args.profile:
+        print(stats.report())
+    if args.profile_json == "-":
+        print(stats.to_json())
+    elif args.profile_json is not None:
+        with open(args.profile_json, "w", encoding="utf-8") as json_file:
+            json_file.write(stats.to_json())
 
-    def invert_color(self, output_file, returnable=False):
-        """
-        Invert all rgb values of the image.
 
-        Parameter
-        ---------
-        output_file : string
-            the name of the file we want to output to.
-        Return
-        ------
-        numpy array
-            Return the numpy array of the image if returnable=True
-        """
-        for row in self.infile:
-            for column in row:
-                column[0] = 255 - column[0]
-                column[1] = 255 - column[1]
-                column[2] = 255 - column[2]
+def _batch_parser():
+    """
+    Make the parser for the batch command line.
 
-        if returnable:
-            return self.infile
+    Return
+    ------
+    argparse.ArgumentParser
+        the parser.
+    """
+    parser = argparse.ArgumentParser(prog="image_manipulation.py batch",
+                                     description="Manipulate many images at once.")
+    parser.add_argument("Source", type=str,
+                        help="A directory, a glob pattern such as 'scans/**/*.jpg' or, with"
+                             " --manifest, a file listing one input per line.")
+    parser.add_argument("Outfile", type=str,
+                        help="Template for the output files, {stem} is the input name without"
+                             " its extension, {name} the full input name, {suffix} the"
+                             " extension and {parent} the input directory,"
+                             " e.g. out/{stem}_gray{suffix}")
+    parser.add_argument("Operation", type=str, nargs="+",
+                        help="The operations to run on every image, the same codes as for a"
+                             " single image.")
+    parser.add_argument("--manifest", action="store_true",
+                        help="Read Source as a manifest file, a line may give an output after a"
+                             " tab.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="The number of processes to use, the number of cpus by default.")
+    _add_resize_arguments(parser)
+    _add_encode_arguments(parser)
+    _add_profile_arguments(parser)
+    return parser
+
+
+def _batch_jobs(args):
+    """
+    Pair every input of a batch with the file it is saved to.
 
-        Image.fromarray(self.infile, "RGB").save(output_file)
+    Parameter
+    ---------
+    args : argparse.Namespace
+        the parsed batch arguments.
+    Return
+    ------
+    list of tuple
+        the (input file, output file) jobs, None when the batch can not be run.
+    """
+    jobs = []
+    for input_file, output_file in _batch_inputs(args.Source, args.manifest):
+        stem, suffix = os.path.splitext(os.path.basename(input_file))
+        jobs.append((input_file, output_file or args.Outfile.format(
+            stem=stem, suffix=suffix, name=os.path.basename(input_file),
+            parent=os.path.dirname(input_file))))
+    if not jobs:
+        print(f"No input files found for {args.Source}")
         return None
+    # two inputs saved to one file would leave only the last one there with both reported ok.
+    inputs = {}
+    for input_file, output_file in jobs:
+        other = inputs.setdefault(os.path.normcase(os.path.abspath(output_file)), input_file)
+        if other != input_file:
+            print(f"{other} and {input_file} would both be saved to {output_file}, use {{parent}}"
+                  " or {name} in the Outfile to keep them apart.")
+            return None
+    return jobs
 
-    def block_image(self, output_file, returnable=False):
-        """
-        Blurs or blocks an image, assigning a block size for an image making all pixels the same.
 
-        Calls the common_denominator function to find a common denominator within a range of two
-        numbers for two numbers. This will be used to determine the block width and height.
+def _batch_main(argv):
+    """
+    Run the batch command line, printing a summary line for every file.
 
-        Parameter
-        ---------
-        output_file : string
-            the name of the file we want to output to.
-        Return
-        ------
-        numpy array
-            Return the numpy array of the image if returnable=True
-        """
-        number_of_blocks = common_denominator(len(self.infile), len(self.infile[0]), 2, 100)
-        block_dimensions = (len(self.infile)//number_of_blocks,
-                            len(self.infile[0])//number_of_blocks)
-        for block_row in range(number_of_blocks):
-            for block in range(number_of_blocks):
-                block_rgb = [[], [], []]
-                for row in range((block_row * block_dimensions[0]),
-                                 (block_row * block_dimensions[0]) + block_dimensions[0]):
-                    for column in range((block * block_dimensions[1]),
-                                        (block * block_dimensions[1]) + block_dimensions[1]):
-                        # go through every pixel in the block and store the rgb values in their
-                        # respective lists.
-                        block_rgb[0].append(self.infile[row][column][0])
-                        block_rgb[1].append(self.infile[row][column][1])
-                        block_rgb[2].append(self.infile[row][column][2])
-                # find the average of the values in our rgb lists
-                avg_of_red = sum(block_rgb[0]) // len(block_rgb[0])
-                avg_of_green = sum(block_rgb[1]) // len(block_rgb[1])
-                avg_of_blue = sum(block_rgb[2]) // len(block_rgb[2])
-                for row in range((block_row * block_dimensions[0]),
-                                 (block_row * block_dimensions[0]) + block_dimensions[0]):
-                    for column in range((block * block_dimensions[1]),
-                                        (block * block_dimensions[1]) + block_dimensions[1]):
-                        # go through every pixel in the block and change its rgb values
-                        self.infile[row][column][0] = avg_of_red
-                        self.infile[row][column][1] = avg_of_green
-                        self.infile[row][column][2] = avg_of_blue
+    Parameter
+    ---------
+    argv : list of string
+        the arguments after the word batch.
+    Return
+    ------
+    int
+        the exit status, 1 if any file failed.
+    """
+    args = _batch_parser().parse_args(argv)
+    if any(operation not in OPERATIONS for operation in args.Operation):
+        print("Not a valid operation, please use the argument -h for extra help.")
+        return 1
+    operations = args.Operation
+    if "rs" in operations:
+        if args.resize is False:
+            print("rs needs a --resize size.")
+            return 1
+        options = dict(_resize_options(args.resize), resample=args.resample)
+        operations = [("rs", options) if operation == "rs" else operation
+                      for operation in operations]
+    jobs = _batch_jobs(args)
+    if jobs is None:
+        return 1
 
-        if returnable:
-            return self.infile
-        Image.fromarray(self.infile, "RGB").save(output_file)
-        return None
+    results = process_batch(jobs, operations, args.workers, _profiling(args), _encoding(args))
+    failures = 0
+    stats = StageStats()
+    for input_file, output_file, error, seconds, file_stats in results:
+        stats.merge(file_stats)
+        if error is None:
+            print(f"ok     {input_file} -> {output_file} ({seconds:.3f}s)")
+        else:
+            failures += 1
+            print(f"FAILED {input_file}: {error}")
+    print(f"{len(results) - failures} succeeded, {failures} failed")
+    _show_profile(args, stats)
+    return 1 if failures else 0
 
 
-if __name__ == "__main__":
-    PARSER = argparse.ArgumentParser(description='Manipulate an Image.')
-    PARSER.add_argument('Infile', metavar='I', type=str,
+def _parser():
+    """
+    Make the parser for the command line of a single image.
+
+    Return
+    ------
+    argparse.ArgumentParser
+        the parser.
+    """
+    parser = argparse.ArgumentParser(description='Manipulate an Image.')
+    parser.add_argument('Infile', metavar='I', type=str,
                         help='The file to have the operation performed on it.')
-    PARSER.add_argument('Outfile', metavar='O', type=str,
+    parser.add_argument('Outfile', metavar='O', type=str,
                         help="The name of the outfile from the script.")
-    PARSER.add_argument("Operation", metavar="o", type=str,
-                        help='Which operation would you like performed? Options:'
+    parser.add_argument("Operation", metavar="o", type=str, nargs="*",
+                        help='Which operations would you like performed? Several are run in'
+                             ' the order given and the image is saved once at the end, none is'
+                             ' only allowed with --pyramid. Options:'
                              ' cr - clear all red;'
                              ' cg - clear all green;'
                              ' cb - clear all blue;'
@@ -401,33 +4332,352 @@ if __name__ == "__main__":
                              ' uh - make colors all be in upper half;'
                              ' gs - make the image gray-scale;'
                              ' ic - invert the colors of the image;'
-                             ' bi - block the image in to same color cubes of pixels')
+                             ' bi - block the image in to same color cubes of pixels;'
+                             ' rs - resize the image to the --resize size')
+    parser.add_argument("--fan-out", action="store_true",
+                        help="Run each operation on its own copy of the image and save each one,"
+                             " Outfile must have {} in it to be replaced by the operation code.")
+    _add_resize_arguments(parser)
+    parser.add_argument("--pyramid", type=str, nargs="+", metavar="SIZE",
+                        help="Save the image at each SIZE, as for --resize or full, from one"
+                             " decode after the operations. Outfile must have {} in it to be"
+                             " replaced by the SIZE.")
+    parser.add_argument("--preview", type=int, nargs=2, metavar=("WIDTH", "HEIGHT"),
+                        help="Shrink the image to fit in WIDTH by HEIGHT before the operations,"
+                             " a JPEG is decoded straight at 1/2, 1/4 or 1/8 size when it can.")
+    parser.add_argument("--threads", type=int, default=1, metavar="N",
+                        help="Split the image in to N bands of rows worked on side by side, the"
+                             " result is the same as with one thread.")
+    parser.add_argument("--engine", choices=ENGINES, default="fast",
+                        help="Run the operations with the fast code or the per-pixel reference"
+                             " code, which gives the same result very slowly. The reference code"
+                             " can not be used with --memory-budget, --cache-dir or an image of"
+                             " several frames without --first-frame.")
+    parser.add_argument("--region", type=int, nargs=4, action="append",
+                        metavar=("LEFT", "TOP", "RIGHT", "BOTTOM"),
+                        help="Only change the pixels in this box, right and bottom not included."
+                             " Can be given more than once for several boxes.")
+    parser.add_argument("--first-frame", action="store_true",
+                        help="Only use the first frame of an animated or multi-page image, by"
+                             " default every frame is changed when the outfile can hold them.")
+    parser.add_argument("--memory-budget", type=float, metavar="MB",
+                        help="Work on the image in bands of rows using about this many megabytes"
+                             " for a band. PNG, TIFF in strips that are not LZW compressed, PPM"
+                             " and BMP are read a band at a time and PNG and TIFF that is not"
+                             " compressed or deflate compressed are saved a band at a time, any"
+                             " other input or output keeps the whole image in memory as well.")
+    parser.add_argument("--scratch", type=str, metavar="FILE",
+                        help="With --memory-budget, put the result together in a .npy file"
+                             " instead of in memory. An output that can not be saved a band at a"
+                             " time still needs the whole image in memory to save.")
+    parser.add_argument("--gray-weights", choices=["equal", "luma"], default="equal",
+                        help="How gs weighs the colors: equal for the average, luma for 0.299"
+                             " red, 0.587 green and 0.114 blue.")
+    parser.add_argument("--gray-single-channel", action="store_true",
+                        help="Make gs save a single channel gray image instead of three equal"
+                             " colors.")
+    parser.add_argument("--block-size", type=int, nargs="+", metavar="N",
+                        help="Height and width of the blocks for bi, one value for square blocks.")
+    parser.add_argument("--blocks", type=int, nargs="+", metavar="N",
+                        help="Number of block rows and columns for bi, one value for both.")
+    _add_encode_arguments(parser)
+    _add_cache_arguments(parser)
+    _add_profile_arguments(parser)
+    return parser
 
-    ARGS = PARSER.parse_args()
 
-    if ARGS.Operation not in ["cr", "cg", "cb", "ro", "go", "bo", "lh", "uh", "gs", "ic", "bi"]:
+def _operations(args):
+    """
+    Make the operations asked for on the command line, closing the program if they can not be run.
+
+    Parameter
+    ---------
+    args : argparse.Namespace
+        the parsed arguments.
+    Return
+    ------
+    list
+        the operations as pipeline takes them.
+    """
+    if any(operation not in OPERATIONS for operation in args.Operation):
         print("Not a valid operation, please use the argument -h for extra help.")
         sys.exit()
+    if any(values is not None and (len(values) > 2 or min(values) < 1)
+           for values in (args.block_size, args.blocks)):
+        print("--block-size and --blocks take one or two numbers of 1 or more.")
+        sys.exit()
+
+    options = {"bi": {"block_size": args.block_size, "number_of_blocks": args.blocks},
+               "gs": {"weights": args.gray_weights}}
+    if "rs" in args.Operation:
+        if args.resize is False:
+            print("rs needs a --resize size.")
+            sys.exit()
+        options["rs"] = dict(_resize_options(args.resize), resample=args.resample)
+    if args.gray_single_channel:
+        options["gs"]["single_channel"] = True
+    if args.region is not None:
+        if "rs" in args.Operation or args.gray_single_channel:
+            print("rs and --gray-single-channel change the whole image, they can not have a"
+                  " --region.")
+            sys.exit()
+        if args.memory_budget is not None:
+            print("--region can not be used with --memory-budget, the boxes are of the whole"
+                  " image.")
+            sys.exit()
+        for operation in args.Operation:
+            options.setdefault(operation, {})["region"] = [tuple(box) for box in args.region]
+    return [(operation, options[operation]) if operation in options else operation
+            for operation in args.Operation]
+
+
+def _open_image(args):
+    """
+    Open the input file with the settings asked for on the command line.
+
+    Parameter
+    ---------
+    args : argparse.Namespace
+        the parsed arguments.
+    Return
+    ------
+    ImageO
+        the image, its pixels not decoded yet.
+    """
+    return ImageO(args.Infile, profile=_profiling(args)).set_encoding(
+        **_encoding(args)).set_threads(args.threads).set_engine(args.engine)
+
+
+def _check_infile(args):
+    """
+    Close the program when the input file is not there.
+
+    Parameter
+    ---------
+    args : argparse.Namespace
+        the parsed arguments.
+    """
+    if not os.path.exists(args.Infile):
+        print("Check your infile parameter, I can't find the file you put in!")
+        sys.exit()
+
+
+def _check_engine(args, used_with):
+    """
+    Close the program when the reference engine is asked for with a mode only the fast one runs.
+
+    Parameter
+    ---------
+    args : argparse.Namespace
+        the parsed arguments.
+    used_with : string
+        the option or input that picked the mode, for the message.
+    """
+    if args.engine != "fast":
+        print(f"--engine {args.engine} can not be used with {used_with}, only the fast engine"
+              " runs it.")
+        sys.exit()
+
+
+def _run_pyramid(args, operations):
+    """
+    Save the image at every --pyramid size after the operations.
+
+    Parameter
+    ---------
+    args : argparse.Namespace
+        the parsed arguments.
+    operations : list
+        the operations to run first.
+    Return
+    ------
+    StageStats
+        the stats of the run.
+    """
+    if "{}" not in args.Outfile:
+        print("With --pyramid the outfile needs {} in it for the size.")
+        sys.exit()
+    try:
+        levels = [(args.Outfile.format(spec), _size_spec(spec)) for spec in args.pyramid]
+    except ValueError:
+        print("Not a valid --pyramid size, use WIDTHxHEIGHT, a scale or full.")
+        sys.exit()
+    image = _open_image(args)
+    image.pyramid(levels, operations, args.resample)
+    return image.stats
+
+
+def _run_fan_out(args, operations):
+    """
+    Run every operation on its own copy of the image and save each one.
+
+    Parameter
+    ---------
+    args : argparse.Namespace
+        the parsed arguments.
+    operations : list
+        the operations to run.
+    Return
+    ------
+    StageStats
+        the stats of the run.
+    """
+    if "{}" not in args.Outfile:
+        print("With --fan-out the outfile needs {} in it for the operation code.")
+        sys.exit()
+    image = _open_image(args)
+    image.fan_out({args.Outfile.format(code): operation for code, operation
+                   in zip(args.Operation, operations)})
+    return image.stats
+
+
+def _run_tiled(args, operations):
+    """
+    Run the operations a band of rows at a time within the --memory-budget.
+
+    Parameter
+    ---------
+    args : argparse.Namespace
+        the parsed arguments.
+    operations : list
+        the operations to run.
+    Return
+    ------
+    StageStats
+        the stats of the run.
+    """
+    _check_engine(args, "--memory-budget")
+    _check_infile(args)
+    stats = StageStats(_profiling(args))
+    process_tiled(args.Infile, args.Outfile, operations,
+                  int(args.memory_budget * 1024 * 1024), scratch_file=args.scratch,
+                  stats=stats, encoding=_encoding(args), threads=args.threads)
+    return stats
 
-    if ARGS.Operation == "cr":
-        ImageO(ARGS.Infile).clear_red(ARGS.Outfile)
-    elif ARGS.Operation == "cg":
-        ImageO(ARGS.Infile).clear_green(ARGS.Outfile)
-    elif ARGS.Operation == "cb":
-        ImageO(ARGS.Infile).clear_blue(ARGS.Outfile)
-    elif ARGS.Operation == "ro":
-        ImageO(ARGS.Infile).red_only(ARGS.Outfile)
-    elif ARGS.Operation == "go":
-        ImageO(ARGS.Infile).green_only(ARGS.Outfile)
-    elif ARGS.Operation == "bo":
-        ImageO(ARGS.Infile).blue_only(ARGS.Outfile)
-    elif ARGS.Operation == "lh":
-        ImageO(ARGS.Infile).lower_half(ARGS.Outfile)
-    elif ARGS.Operation == "uh":
-        ImageO(ARGS.Infile).upper_half(ARGS.Outfile)
-    elif ARGS.Operation == "gs":
-        ImageO(ARGS.Infile).gray_scale(ARGS.Outfile)
-    elif ARGS.Operation == "ic":
-        ImageO(ARGS.Infile).invert_color(ARGS.Outfile)
-    elif ARGS.Operation == "bi":
-        ImageO(ARGS.Infile).block_image(ARGS.Outfile)
+
+def _run_frames(args, operations):
+    """
+    Run the operations on every frame of an animated or multi-page image.
+
+    Parameter
+    ---------
+    args : argparse.Namespace
+        the parsed arguments.
+    operations : list
+        the operations to run.
+    Return
+    ------
+    StageStats
+        the stats of the run.
+    """
+    _check_engine(args, "an image of several frames, add --first-frame to use the first")
+    stats = StageStats(_profiling(args))
+    process_frames(args.Infile, args.Outfile, operations, stats=stats, encoding=_encoding(args),
+                   threads=args.threads)
+    return stats
+
+
+def _run_cached(args, operations):
+    """
+    Run the operations through the --cache-dir result cache.
+
+    Parameter
+    ---------
+    args : argparse.Namespace
+        the parsed arguments.
+    operations : list
+        the operations to run.
+    Return
+    ------
+    StageStats
+        the stats of the run.
+    """
+    _check_engine(args, "--cache-dir")
+    _check_infile(args)
+    stats = StageStats(_profiling(args))
+    cache = _cache(args)
+    cache.process(args.Infile, args.Outfile, operations, stats, args.threads,
+                  **_encoding(args))
+    if args.profile:
+        counters = cache.counters()
+        print(f"cache: {counters['hits']} hits, {counters['misses']} misses,"
+              f" {counters['evictions']} evictions")
+    return stats
+
+
+def _run_single(args, operations):
+    """
+    Run the operations on the whole image and save it once.
+
+    Parameter
+    ---------
+    args : argparse.Namespace
+        the parsed arguments.
+    operations : list
+        the operations to run.
+    Return
+    ------
+    StageStats
+        the stats of the run.
+    """
+    image = _open_image(args)
+    if args.preview is not None:
+        image.preview(tuple(args.preview))
+    image.pipeline(operations).save(args.Outfile)
+    return image.stats
+
+
+def _run_mode(args):
+    """
+    Pick the way to run the image from the command line options.
+
+    Parameter
+    ---------
+    args : argparse.Namespace
+        the parsed arguments.
+    Return
+    ------
+    function
+        called as function(args, operations) to run the image, giving back the stats.
+    """
+    if args.pyramid is not None:
+        return _run_pyramid
+    if args.fan_out:
+        return _run_fan_out
+    if args.memory_budget is not None:
+        return _run_tiled
+    if (args.preview is None and not args.first_frame and os.path.exists(args.Infile) and
+            encode_format(args.Outfile, args.format) in FRAME_FORMATS and
+            _frame_count(args.Infile) > 1):
+        return _run_frames
+    if args.cache_dir is not None and args.preview is None:
+        return _run_cached
+    return _run_single
+
+
+def main(argv=None):
+    """
+    Run the command line.
+
+    Parameter
+    ---------
+    argv : list of string
+        the arguments to use, the ones the program was called with by default.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] == "batch":
+        sys.exit(_batch_main(argv[1:]))
+    if argv and argv[0] == "worker":
+        sys.exit(_worker_main(argv[1:]))
+
+    parser = _parser()
+    args = parser.parse_args(argv)
+    if not args.Operation and args.pyramid is None:
+        parser.error("the following arguments are required: o")
+    operations = _operations(args)
+    _show_profile(args, _run_mode(args)(args, operations))
+
+
+if __name__ == "__main__":
+    main()
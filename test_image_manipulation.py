@@ -4,8 +4,22 @@ Pytest the ImageStuff module.
 Joshua Shequin
 """
 
-from image_manipulation import ImageO
+import asyncio
+import json
+import os
+import socket
+import threading
+import tracemalloc
+import time
+from io import BytesIO as io_bytes
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import image_manipulation
+from image_manipulation import (AsyncPool, BufferPool, ImageO, LUTS, OPERATIONS, ResultCache,
+                                compose_luts, gamma_lut, iter_frames, levels_lut, main,
+                                process_batch, process_frames, process_tiled, serve_jobs)
 import numpy as np
+from PIL import Image
 
 
 """
@@ -125,3 +139,920 @@ def test_block():
                           [[247, 248, 255, 255], [255, 255, 255, 255], [0, 0, 0, 255], [0, 0, 0, 255]]])
 
     assert (io.block_image("", returnable=True) == test_case).all()
+
+
+def test_block_averages(tmp_path):
+    # 4x6 picture so the image is split in to two by two blocks of 2x3 pixels.
+    base = np.zeros((4, 6, 3), dtype=np.uint8)
+    base[:2, :3] = [[[10, 20, 30], [11, 21, 31], [12, 22, 32]],
+                    [[13, 23, 33], [14, 24, 34], [15, 25, 36]]]
+    base[2:, 3:] = 255
+    Image.fromarray(base).save(str(tmp_path / "blocks.png"))
+    io = ImageO(str(tmp_path / "blocks.png"))
+    test_case = np.zeros((4, 6, 3), dtype=np.uint8)
+    test_case[:2, :3] = [12, 22, 32]
+    test_case[2:, 3:] = 255
+
+    assert (io.block_image("", returnable=True) == test_case).all()
+
+
+def test_block_size_uneven_edges(tmp_path):
+    base = np.arange(5 * 7 * 3, dtype=np.uint8).reshape(5, 7, 3)
+    Image.fromarray(base).save(str(tmp_path / "uneven.png"))
+    io = ImageO(str(tmp_path / "uneven.png"))
+    result = io.block_image("", returnable=True, block_size=(2, 3))
+    for row_start in range(0, 5, 2):
+        for column_start in range(0, 7, 3):
+            block = base[row_start:row_start + 2, column_start:column_start + 3].astype(int)
+            average = block.sum(axis=(0, 1)) // (block.shape[0] * block.shape[1])
+            assert (result[row_start:row_start + 2, column_start:column_start + 3] ==
+                    average).all()
+
+
+def test_number_of_blocks(tmp_path):
+    base = np.zeros((5, 4, 3), dtype=np.uint8)
+    base[:, 2:] = 90
+    base[3:] = 30
+    Image.fromarray(base).save(str(tmp_path / "count.png"))
+    io = ImageO(str(tmp_path / "count.png"))
+    # 5 rows in to 2 blocks gives a 3 row block then a 2 row block.
+    test_case = np.zeros((5, 4, 3), dtype=np.uint8)
+    test_case[:3, 2:] = 90
+    test_case[3:] = 30
+
+    assert (io.block_image("", returnable=True, number_of_blocks=2) == test_case).all()
+    for options in ({"block_size": 0}, {"number_of_blocks": -1}, {"block_size": (1, 2, 3)}):
+        with pytest.raises(ValueError):
+            ImageO(str(tmp_path / "count.png")).block_image("", returnable=True, **options)
+    with pytest.raises(SystemExit):
+        main([str(tmp_path / "count.png"), str(tmp_path / "out.png"), "bi", "--block-size", "1",
+              "2", "3"])
+
+
+def test_pipeline_matches_single_operations():
+    expected = ImageO("images/oregon_river.jpg")
+    expected.gray_scale("", returnable=True)
+    expected.lower_half("", returnable=True)
+    expected.block_image("", returnable=True, block_size=16)
+    expected.invert_color("", returnable=True)
+    expected.clear_red("", returnable=True)
+    io = ImageO("images/oregon_river.jpg").pipeline(["gs", "lh", ("bi", {"block_size": 16}),
+                                                     "ic", "cr"])
+
+    assert (io.infile == expected.infile).all()
+
+
+def test_pipeline_saves_once(tmp_path):
+    ImageO("images/test_picture.jpg").pipeline(["ic", "ic"]).save(str(tmp_path / "out.png"))
+
+    assert (np.array(Image.open(str(tmp_path / "out.png"))) ==
+            np.array(Image.open("images/test_picture.jpg"))).all()
+
+
+def test_fan_out(tmp_path):
+    io = ImageO("images/oregon_river.jpg")
+    source = io.infile.copy()
+    io.fan_out({str(tmp_path / "ic.png"): "ic", str(tmp_path / "gs_bi.png"): ["gs", "bi"]})
+
+    assert (io.infile == source).all()
+    assert (np.array(Image.open(str(tmp_path / "ic.png"))) ==
+            ImageO("images/oregon_river.jpg").invert_color("", returnable=True)).all()
+    assert (np.array(Image.open(str(tmp_path / "gs_bi.png"))) ==
+            ImageO("images/oregon_river.jpg").pipeline(["gs", "bi"]).infile).all()
+
+
+def test_process_batch_reports_failures(tmp_path):
+    results = process_batch([("images/test_picture.jpg", str(tmp_path / "out" / "ic.png")),
+                             ("images/missing.jpg", str(tmp_path / "out" / "missing.png"))],
+                            ["ic"], workers=2)
+
+    assert results[0][2] is None
+    assert "FileNotFoundError" in results[1][2]
+    assert (np.array(Image.open(str(tmp_path / "out" / "ic.png"))) ==
+            255 - np.array(Image.open("images/test_picture.jpg"))).all()
+
+
+def test_batch_command_line(tmp_path, capsys):
+    with pytest.raises(SystemExit) as exit_info:
+        main(["batch", "images/oregon_river_altered_c*.jpg", str(tmp_path / "{stem}_gs.png"), "gs",
+              "--workers", "2"])
+
+    assert exit_info.value.code == 0
+    assert "3 succeeded, 0 failed" in capsys.readouterr().out
+    assert (tmp_path / "oregon_river_altered_cr_gs.png").exists()
+
+
+def test_batch_command_line_resize(tmp_path, capsys):
+    with pytest.raises(SystemExit) as exit_info:
+        main(["batch", "images/test_picture.jpg", str(tmp_path / "{stem}_rs.png"), "rs",
+              "--resize", "0.5", "--resample", "nearest", "--workers", "1"])
+
+    assert exit_info.value.code == 0
+    assert "1 succeeded, 0 failed" in capsys.readouterr().out
+    width, height = Image.open("images/test_picture.jpg").size
+    size = (round(width * 0.5), round(height * 0.5))
+    assert Image.open(str(tmp_path / "test_picture_rs.png")).size == size
+    with pytest.raises(SystemExit) as exit_info:
+        main(["batch", "images/test_picture.jpg", str(tmp_path / "{stem}_rs.png"), "rs"])
+
+    assert exit_info.value.code == 1
+    assert "rs needs a --resize size." in capsys.readouterr().out
+
+
+def test_batch_outputs_collide(tmp_path, capsys):
+    for folder in ("a", "b"):
+        (tmp_path / "scans" / folder).mkdir(parents=True)
+        Image.open("images/test_picture.jpg").save(str(tmp_path / "scans" / folder / "x.jpg"))
+    source = str(tmp_path / "scans" / "**" / "*.jpg")
+    with pytest.raises(SystemExit) as exit_info:
+        main(["batch", source, str(tmp_path / "out" / "{stem}.png"), "ic"])
+
+    assert exit_info.value.code == 1
+    assert "would both be saved to" in capsys.readouterr().out
+    assert not (tmp_path / "out").exists()
+    with pytest.raises(SystemExit) as exit_info:
+        main(["batch", source, str(tmp_path / "out" / "{parent}" / "{stem}.png"), "ic",
+              "--workers", "1"])
+
+    assert exit_info.value.code == 0
+    assert "2 succeeded, 0 failed" in capsys.readouterr().out
+
+
+def test_process_tiled_matches_pipeline(tmp_path):
+    operations = ["gs", ("bi", {"block_size": (7, 5)}), "ic", "bi", "uh"]
+    expected = ImageO("images/oregon_river.jpg").pipeline(operations).infile
+    # a budget of a few rows makes many tiles that have to line up with both block layouts.
+    process_tiled("images/oregon_river.jpg", str(tmp_path / "tiled.png"), operations,
+                  memory_budget=1024 * 3 * 3 * 20)
+
+    assert (np.array(Image.open(str(tmp_path / "tiled.png"))) == expected).all()
+
+
+def test_process_tiled_bands(tmp_path):
+    pixels = np.array(Image.open("images/oregon_river.jpg"))[:200, :150]
+    sources = {"L.png": pixels[..., 0], "RGBA.png": np.dstack([pixels, pixels[..., 0]]),
+               "16.png": pixels[..., 0].astype(np.uint16) * 257, "RGB.tif": pixels,
+               "LA.tif": pixels[..., :2], "RGB.bmp": pixels, "RGB.ppm": pixels}
+    outputs = [("out.png", None), ("out.tif", None), ("out.tif", {"compression": "tiff_deflate"})]
+    operations = ["ic", ("bi", {"block_size": (7, 5)}), "lh"]
+    for name, source in sources.items():
+        path = str(tmp_path / name)
+        Image.fromarray(source).save(path, **({"compression": "tiff_deflate"}
+                                              if name == "LA.tif" else {}))
+        expected = ImageO(path).pipeline(operations).infile
+        for output, encoding in outputs:
+            for scratch in (None, str(tmp_path / "scratch.npy")):
+                process_tiled(path, str(tmp_path / output), operations,
+                              memory_budget=150 * 4 * 3 * 13, scratch_file=scratch,
+                              encoding=encoding)
+                assert (np.array(Image.open(str(tmp_path / output))) == expected).all()
+
+
+def test_process_tiled_scratch_file(tmp_path):
+    result = process_tiled("images/oregon_river.jpg", None, ["cr", "lh"],
+                           memory_budget=100000, scratch_file=str(tmp_path / "scratch.npy"))
+
+    assert (result == ImageO("images/oregon_river.jpg").pipeline(["cr", "lh"]).infile).all()
+    assert (np.load(str(tmp_path / "scratch.npy"), mmap_mode="r") == result).all()
+
+
+def test_luts_match_operations():
+    every_value = np.repeat(np.arange(256, dtype=np.uint8), 3).reshape(16, 16, 3)
+    for code, lut in LUTS.items():
+        expected = every_value.copy()
+        OPERATIONS[code][1](expected)
+
+        assert (compose_luts(lut)[:, every_value[..., 0]].transpose(1, 2, 0) == expected).all()
+
+
+def test_folded_lut_chain(monkeypatch):
+    monkeypatch.setattr(image_manipulation, "LUT_FOLD_LENGTH", 2)
+    # the same table for every color is looked up differently from a table for each.
+    for chain in (["lh", "ic", "uh", "cr", "ic", "lh", "go", "ic", "uh"], ["lh", "ic", "uh"]):
+        for path in ("images/oregon_river.jpg", "images/test_picture.png"):
+            expected = ImageO(path)
+            for code in chain:
+                getattr(expected, OPERATIONS[code][0])("", returnable=True)
+            io = ImageO(path).pipeline(chain)
+
+            assert (io.infile == expected.infile).all()
+
+
+def test_custom_curves():
+    io = ImageO("images/test_picture.png")
+    source = io.infile.copy()
+    io.pipeline([gamma_lut(2.0), "ic", levels_lut(64, 192)])
+    gamma = np.rint(255 * (source[..., :3] / 255) ** 0.5)
+    expected = np.clip(np.rint((255 - gamma - 64) * 255 / 128), 0, 255)
+
+    assert (io.infile[..., :3] == expected).all()
+    assert (io.infile[..., 3] == source[..., 3]).all()
+
+
+def test_gray_scale_integer_matches_float():
+    # every red and green pair, with blues spread over them, against the float average.
+    values = np.arange(256 * 256 * 3, dtype=np.int64)
+    pixels = np.stack([values // 256 % 256, values % 256, values * 7 % 256],
+                      axis=-1).astype(np.uint8).reshape(768, 256, 3)
+    expected = ((pixels[..., 0] * (1 / 3)) + (pixels[..., 1] * (1 / 3)) +
+                (pixels[..., 2] * (1 / 3))).astype(np.uint8)
+    result = ImageO.from_array(pixels).gray_scale("", returnable=True)
+
+    assert (result == expected[..., np.newaxis]).all()
+
+
+def test_gray_scale_luma_single_channel(tmp_path):
+    io = ImageO("images/test_picture.png")
+    result = io.gray_scale(str(tmp_path / "gray.png"), weights="luma", single_channel=True)
+    test_case = np.array([[[76, 255], [150, 255], [29, 255], [255, 255]],
+                          [[0, 255], [0, 255], [255, 255], [255, 255]],
+                          [[255, 255], [29, 255], [150, 255], [76, 255]],
+                          [[248, 255], [255, 255], [0, 255], [0, 255]]])
+
+    assert result is None
+    assert Image.open(str(tmp_path / "gray.png")).mode == "LA"
+    assert (np.array(Image.open(str(tmp_path / "gray.png"))) == test_case).all()
+
+
+def test_stage_stats(tmp_path):
+    finished = []
+    io = ImageO("images/oregon_river.jpg", profile=True,
+                on_stage=lambda name, numbers: finished.append((name, numbers["pixels"])))
+    io.pipeline(["gs", "bi", "ic"]).save(str(tmp_path / "out.jpg"))
+    stats = io.stats.as_dict()
+
+    assert finished == [("decode", 1024 * 680), ("transform", 1024 * 680),
+                        ("encode", 1024 * 680)]
+    assert all(stats[stage]["calls"] == 1 for stage in ("decode", "transform", "encode"))
+    assert stats["transform"]["seconds"] > 0
+    # the decoded array alone is 1024 * 680 * 3 bytes.
+    assert stats["decode"]["peak_bytes"] >= 1024 * 680 * 3
+    assert json.loads(io.stats.to_json()) == stats
+
+
+def test_stage_memory_across_threads():
+    def measure(size):
+        stats = image_manipulation.StageStats(track_memory=True)
+        with stats.stage("transform"):
+            pixels = np.ones(size, np.uint8)
+            time.sleep(0.02)
+            del pixels
+        return stats.stages["transform"]["peak_bytes"]
+
+    sizes = [1024 * 1024, 8 * 1024 * 1024] * 4
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        peaks = list(executor.map(measure, sizes))
+
+    # a stage in another thread does not reset or stop the peak of this one.
+    assert all(size <= peak < size + 1024 * 1024 for size, peak in zip(sizes, peaks))
+
+
+def test_stage_memory_without_reset_peak(monkeypatch):
+    # python before 3.9 has no tracemalloc.reset_peak.
+    monkeypatch.delattr(tracemalloc, "reset_peak")
+    stats = image_manipulation.StageStats(track_memory=True)
+    with stats.stage("transform"):
+        pixels = np.ones(1024 * 1024, np.uint8)
+        del pixels
+
+    assert 1024 * 1024 <= stats.stages["transform"]["peak_bytes"] < 2 * 1024 * 1024
+
+
+def test_worker_socket_path(tmp_path):
+    taken = tmp_path / "notes.txt"
+    taken.write_text("keep me")
+    listening = str(tmp_path / "listening.sock")
+    stale = str(tmp_path / "stale.sock")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(listening)
+        server.listen(1)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stopped:
+            stopped.bind(stale)
+
+        for path in (str(taken), listening):
+            with pytest.raises(SystemExit) as exit_info:
+                main(["worker", "--socket", path])
+            assert exit_info.value.code == 1
+        assert image_manipulation._free_socket(stale) is None
+
+    assert taken.read_text() == "keep me"
+    assert os.path.exists(listening) and not os.path.exists(stale)
+
+
+def test_serve_jobs_keeps_going_after_failures(tmp_path):
+    lines = [json.dumps({"id": "good", "in": "images/test_picture.jpg",
+                         "out": str(tmp_path / "ic.png"),
+                         "ops": ["ic", ["bi", {"block_size": 2}]]}),
+             "not json",
+             json.dumps({"id": "missing", "in": "images/missing.jpg",
+                         "out": str(tmp_path / "missing.png"), "ops": ["ic"]})]
+    written = []
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        serve_jobs(lines, written.append, executor, in_flight=2)
+    records = {record["id"]: record for record in map(json.loads, written)}
+
+    assert records["good"]["ok"] and records["good"]["stages"]["decode"]["pixels"] == 16
+    assert not records[2]["ok"] and "bad job line" in records[2]["error"]
+    assert not records["missing"]["ok"] and "FileNotFoundError" in records["missing"]["error"]
+    assert (tmp_path / "ic.png").exists()
+
+
+def test_lazy_decode():
+    io = ImageO("images/oregon_river.jpg")
+
+    assert io.size == (1024, 680) and io.mode == "RGB"
+    assert "decode" not in io.stats.stages
+    assert io.infile.shape == (680, 1024, 3)
+    assert io.stats.stages["decode"]["calls"] == 1
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="needs /proc to count files")
+def test_lazy_decode_closes_file():
+    open_files = len(os.listdir("/proc/self/fd"))
+    images = [ImageO("images/oregon_river.jpg") for _ in range(20)]
+
+    # only the header is read until the pixels are needed, the file is not kept open.
+    assert len(os.listdir("/proc/self/fd")) == open_files
+    assert images[0].draft(2).infile.shape == (340, 512, 3)
+    assert len(os.listdir("/proc/self/fd")) == open_files
+
+
+def test_draft_decodes_smaller():
+    io = ImageO("images/oregon_river.jpg").draft(4)
+
+    assert io.infile.shape == (170, 256, 3)
+    assert ImageO("images/test_picture.png").draft(2).infile.shape == (2, 2, 4)
+    assert ImageO("images/oregon_river.jpg").preview((300, 300)).size == (300, 199)
+
+
+def test_block_image_draft():
+    exact = ImageO("images/oregon_river.jpg").block_image("", returnable=True, block_size=16)
+    io = ImageO("images/oregon_river.jpg")
+    result = io.block_image("", returnable=True, block_size=16, draft=True)
+
+    assert io.stats.stages["decode"]["pixels"] == 1024 * 680 // 64
+    assert result.shape == exact.shape
+    assert np.abs(result.astype(int) - exact).max() <= 8
+
+
+def test_encode_settings(tmp_path):
+    io = ImageO("images/oregon_river.jpg")
+    png = io.to_bytes()
+    fast = io.to_bytes(format="JPEG", preset="fast")
+    small = io.to_bytes(format="JPEG", preset="small")
+
+    assert png.startswith(b"\x89PNG")
+    assert Image.open(io_bytes(fast)).format == "JPEG"
+    assert len(small) < len(fast)
+    assert len(io.to_bytes(format="JPEG", quality=30)) < len(fast)
+
+    io.set_encoding(preset="small").save(str(tmp_path / "out.png"))
+    assert (tmp_path / "out.png").stat().st_size < len(png)
+    with pytest.raises(ValueError):
+        io.to_bytes(preset="tiny")
+
+
+def test_encode_alpha_to_jpeg():
+    io = ImageO("images/test_picture.png")
+
+    assert Image.open(io_bytes(io.to_bytes(format="JPEG"))).mode == "RGB"
+
+
+def test_main_encode_options(tmp_path):
+    main(["images/oregon_river.jpg", str(tmp_path / "out"), "ic", "--format", "jpeg",
+          "--quality", "50", "--progressive"])
+
+    with Image.open(str(tmp_path / "out")) as image:
+        assert image.format == "JPEG" and image.info.get("progressive")
+
+
+def test_async_apply(tmp_path):
+    async def run():
+        io = await ImageO.aopen("images/oregon_river.jpg")
+        await io.aapply(["gs", "ic"], str(tmp_path / "out.png"))
+        return io, await io.ato_bytes(format="JPEG")
+
+    io, data = asyncio.run(run())
+    expected = ImageO("images/oregon_river.jpg").pipeline(["gs", "ic"]).infile
+
+    assert np.array_equal(io.infile, expected)
+    assert np.array_equal(np.array(Image.open(str(tmp_path / "out.png"))), expected)
+    assert data.startswith(b"\xff\xd8")
+
+
+def test_async_pool_limits_and_cancels():
+    pool = AsyncPool(workers=4, in_flight=2)
+    running, most, ran = [0], [0], []
+    lock = threading.Lock()
+
+    def work(number):
+        with lock:
+            running[0] += 1
+            most[0] = max(most[0], running[0])
+            ran.append(number)
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+
+    async def limited(number):
+        async with pool.slot():
+            await pool.run(work, number)
+
+    async def run():
+        tasks = [asyncio.ensure_future(limited(number)) for number in range(6)]
+        await asyncio.sleep(0.01)
+        tasks[-1].cancel()
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    results = asyncio.run(run())
+    pool.close()
+
+    assert most[0] == 2
+    assert isinstance(results[-1], asyncio.CancelledError)
+    assert sorted(ran) == [0, 1, 2, 3, 4]
+
+
+def test_async_pool_close_drops_waiting_work():
+    pool = AsyncPool(workers=1)
+    started = threading.Event()
+    ran = []
+
+    def work(number):
+        started.set()
+        time.sleep(0.05)
+        ran.append(number)
+
+    async def run():
+        tasks = [asyncio.ensure_future(pool.run(work, number)) for number in range(4)]
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        pool.close()
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    results = asyncio.run(run())
+
+    # the first call had started so it finishes, the three waiting for the thread never run.
+    assert ran == [0] and results[0] is None
+    assert all(isinstance(result, asyncio.CancelledError) for result in results[1:])
+
+
+def test_threads_same_result():
+    operations = ["gs", "ic", ("bi", {"block_size": 7}), "uh", ("gs", {"single_channel": True})]
+    expected = ImageO("images/oregon_river.jpg").pipeline(operations).infile
+
+    for threads in (2, 3, 8):
+        io = ImageO("images/oregon_river.jpg").set_threads(threads)
+        assert np.array_equal(io.pipeline(operations).infile, expected)
+    assert np.array_equal(
+        ImageO("images/oregon_river.jpg").set_threads(4).block_image("", returnable=True),
+        ImageO("images/oregon_river.jpg").block_image("", returnable=True))
+
+
+def test_main_threads(tmp_path):
+    main(["images/oregon_river.jpg", str(tmp_path / "one.png"), "bi", "lh"])
+    main(["images/oregon_river.jpg", str(tmp_path / "four.png"), "bi", "lh", "--threads", "4"])
+    main(["images/oregon_river.jpg", str(tmp_path / "tiled.png"), "bi", "lh",
+          "--memory-budget", "0.5"])
+    main(["images/oregon_river.jpg", str(tmp_path / "tiled_four.png"), "bi", "lh",
+          "--threads", "4", "--memory-budget", "0.5"])
+
+    assert (tmp_path / "four.png").read_bytes() == (tmp_path / "one.png").read_bytes()
+    assert (tmp_path / "tiled_four.png").read_bytes() == (tmp_path / "tiled.png").read_bytes()
+
+
+def test_result_cache(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    first, second = tmp_path / "first.png", tmp_path / "second.png"
+
+    assert not cache.process("images/oregon_river.jpg", str(first), ["gs", "ic"])
+    assert cache.process("images/oregon_river.jpg", str(second), ["gs", ("ic", {})])
+    assert first.read_bytes() == second.read_bytes()
+    assert first.read_bytes() == ImageO("images/oregon_river.jpg").pipeline(
+        ["gs", "ic"]).to_bytes()
+    assert not cache.process("images/oregon_river.jpg", str(second), ["gs", "ic"],
+                             compress_level=1)
+    assert not cache.process("images/oregon_river.jpg", str(second), [gamma_lut(2)])
+    assert not cache.process("images/oregon_river_resized.jpg", str(second), ["gs", "ic"])
+    assert cache.counters()["hits"] == 1 and cache.counters()["misses"] == 4
+
+
+def test_result_cache_evicts(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), max_bytes=1)
+    cache.put("aa01", b"old")
+    cache.put("bb02", b"new")
+
+    assert cache.get("aa01") is None and cache.get("bb02") is None
+    assert cache.counters()["evictions"] == 2
+
+    cache = ResultCache(str(tmp_path / "cache"), max_age=60)
+    cache.put("cc03", b"used")
+    cache.put("dd04", b"unused")
+    os.utime(cache._path("dd04"), (time.time() - 120,) * 2)
+    cache.evict()
+
+    assert cache.get("cc03") == b"used" and cache.get("dd04") is None
+
+    # room for two results, the one read most recently stays when a third is stored.
+    cache = ResultCache(str(tmp_path / "lru"), max_bytes=8)
+    cache.put("ee05", b"read")
+    cache.put("ff06", b"left")
+    os.utime(cache._path("ee05"), (time.time() - 30,) * 2)
+    os.utime(cache._path("ff06"), (time.time() - 20,) * 2)
+    assert cache.get("ee05") == b"read"
+    cache.put("gg07", b"next")
+
+    assert cache.get("ff06") is None
+    assert cache.get("ee05") == b"read" and cache.get("gg07") == b"next"
+
+
+def test_result_cache_age_check(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path / "cache"), max_age=60)
+    scans = []
+    monkeypatch.setattr(cache, "evict", lambda: scans.append(1) or ResultCache.evict(cache))
+    for number in range(5):
+        cache.put("{:04}".format(number), b"data")
+
+    # only the first store looks for old results, the rest are inside AGE_CHECK_SECONDS.
+    assert len(scans) == 1
+
+
+def test_main_cache(tmp_path, capsys):
+    arguments = ["images/oregon_river.jpg", str(tmp_path / "out.jpg"), "bi", "--cache-dir",
+                 str(tmp_path / "cache"), "--profile"]
+    main(arguments)
+    main(arguments)
+
+    assert "cache: 1 hits, 0 misses" in capsys.readouterr().out
+
+
+def test_alpha_kept(tmp_path):
+    alpha = np.array(Image.open("images/test_picture.png"))[..., 3]
+    io = ImageO("images/test_picture.png")
+    io.pipeline(["ic", "gs", "bi", "cr"]).save(str(tmp_path / "out.png"))
+
+    with Image.open(str(tmp_path / "out.png")) as image:
+        assert image.mode == "RGBA"
+        assert (np.array(image)[..., 3] == alpha).all()
+
+
+def test_gray_native(tmp_path):
+    Image.open("images/oregon_river.jpg").convert("L").save(str(tmp_path / "gray.png"))
+    gray = np.array(Image.open(str(tmp_path / "gray.png")))
+
+    io = ImageO(str(tmp_path / "gray.png"))
+    assert io.mode == "L"
+    assert (io.pipeline(["ic", "gs"]).infile == 255 - gray).all()
+    io = ImageO(str(tmp_path / "gray.png")).pipeline(["uh", "ro", "ic"])
+    assert io.mode == "RGB"
+    assert (io.infile[..., 0] == 255 - ((gray >> 1) + 128)).all()
+    assert (io.infile[..., 1:] == 255).all()
+
+    with_alpha = np.dstack((gray, 255 - gray))
+    io = ImageO.from_array(with_alpha.copy()).apply_lut("", 255 - np.arange(256),
+                                                        returnable=True)
+    assert (io[..., 0] == 255 - gray).all() and (io[..., 1] == 255 - gray).all()
+    assert (ImageO.from_array(gray.copy()).apply_lut("", 255 - np.arange(256), returnable=True)
+            == 255 - gray).all()
+    assert (ImageO.from_array(with_alpha.copy()).gray_scale(
+        "", returnable=True, single_channel=True) == with_alpha).all()
+
+
+def test_palette_decoded_as_color(tmp_path):
+    Image.open("images/test_picture.jpg").convert("P").save(str(tmp_path / "palette.png"))
+    io = ImageO(str(tmp_path / "palette.png"))
+
+    assert io.mode == "RGB" and io.infile.shape == (4, 4, 3)
+
+
+def test_sixteen_bit(tmp_path, monkeypatch):
+    values = (np.arange(64 * 48, dtype=np.uint32).reshape(48, 64) * 21).astype(np.uint16)
+    Image.fromarray(values).save(str(tmp_path / "deep.png"))
+
+    io = ImageO(str(tmp_path / "deep.png"))
+    assert io.mode == "I;16"
+    io.pipeline(["uh", "ic"]).save(str(tmp_path / "out.png"))
+    with Image.open(str(tmp_path / "out.png")) as image:
+        assert (np.array(image) == 65535 - ((values >> 1) + 32768)).all()
+    with pytest.raises(ValueError):
+        ImageO(str(tmp_path / "deep.png")).pipeline([gamma_lut(2)])
+
+    color = np.dstack((values, values // 2, values // 3))
+    blocks = ImageO.from_array(color.copy()).block_image("", returnable=True, block_size=16)
+    assert blocks.dtype == np.uint16 and blocks[0, 0, 0] == values[:16, :16].mean() // 1
+    monkeypatch.setattr(image_manipulation, "LUT_FOLD_LENGTH", 2)
+    folded = ImageO.from_array(color.copy()).pipeline(["ic", "lh", "cg"]).infile
+    assert (folded[..., 0] == (65535 - values) >> 1).all() and (folded[..., 1] == 0).all()
+
+
+def make_animation(path, frames=6):
+    images = []
+    for frame in range(frames):
+        pixels = np.zeros((40, 60, 4), np.uint8)
+        pixels[..., 0] = frame * 40
+        pixels[..., 1] = np.arange(60) * 4
+        pixels[..., 3] = 255
+        pixels[frame * 5:frame * 5 + 10, :, 3] = 0
+        images.append(Image.fromarray(pixels))
+    images[0].save(path, save_all=True, append_images=images[1:], loop=2,
+                   duration=[100 * (frame + 1) for frame in range(frames)])
+    decoded = []
+    with Image.open(path) as image:
+        for frame in range(frames):
+            image.seek(frame)
+            decoded.append(np.array(image.convert("RGBA")))
+    return decoded
+
+
+def test_plan():
+    pixels = ImageO("images/test_picture.jpg").infile
+    operations = ["gs", ("bi", {"block_size": 3}), "ic", ("lut", {"lut": gamma_lut(2.2)})]
+    expected = ImageO.from_array(pixels.copy()).pipeline(operations).infile
+    plan = ImageO.from_array(pixels).plan(operations)
+
+    for _ in range(2):
+        assert np.array_equal(ImageO.from_array(pixels.copy()).pipeline(plan).infile, expected)
+    assert np.array_equal(ImageO.from_array(pixels.copy()).pipeline(
+        plan, region=(0, 0, 6, 6)).infile[:6, :6], expected[:6, :6])
+
+
+def test_process_frames_gif(tmp_path):
+    frames = make_animation(str(tmp_path / "in.gif"))
+    process_frames(str(tmp_path / "in.gif"), str(tmp_path / "out.gif"), ["ic"])
+
+    with Image.open(str(tmp_path / "out.gif")) as image:
+        assert image.n_frames == len(frames) and image.info["loop"] == 2
+        for index, pixels in enumerate(frames):
+            image.seek(index)
+            out = np.array(image.convert("RGBA"))
+            assert image.info["duration"] == 100 * (index + 1)
+            assert (out[..., 3] == pixels[..., 3]).all()
+            shown = pixels[..., 3] > 0
+            assert (out[shown][:, :3] == 255 - pixels[shown][:, :3]).all()
+
+
+def test_process_frames_tiff(tmp_path):
+    pages = [np.full((20, 30, 3), value, np.uint8) for value in (10, 100, 200)]
+    images = [Image.fromarray(page) for page in pages]
+    images[0].save(str(tmp_path / "in.tif"), save_all=True, append_images=images[1:])
+    main([str(tmp_path / "in.tif"), str(tmp_path / "out.tif"), "lh"])
+
+    with Image.open(str(tmp_path / "out.tif")) as image:
+        assert image.n_frames == 3
+        for index, page in enumerate(pages):
+            image.seek(index)
+            assert (np.array(image) == page >> 1).all()
+
+
+def test_iter_frames_streams(tmp_path):
+    make_animation(str(tmp_path / "in.gif"))
+    stats = image_manipulation.StageStats()
+    frames = iter_frames(str(tmp_path / "in.gif"), ["gs"], stats)
+    pixels, info = next(frames)
+
+    assert stats.stages["decode"]["calls"] == 1
+    assert info == {"duration": 100, "loop": 2} and pixels.shape == (40, 60, 4)
+    assert len(list(frames)) == 5
+
+
+def test_resize():
+    io = ImageO("images/oregon_river.jpg")
+    result = io.resize("", returnable=True, size=(200, None))
+
+    assert result.shape == (133, 200, 3)
+    assert io.stats.stages["decode"]["pixels"] == 1024 * 680 // 4
+    assert ImageO("images/test_picture.png").pipeline(
+        [("rs", {"scale": 2, "resample": "nearest"})]).infile.shape == (8, 8, 4)
+    with pytest.raises(ValueError):
+        ImageO("images/oregon_river.jpg").pipeline(["rs"])
+
+
+def test_pyramid(tmp_path):
+    io = ImageO("images/oregon_river.jpg")
+    io.pyramid([(str(tmp_path / "small.png"), (64, None)),
+                (str(tmp_path / "full.png"), None, ["bi"]),
+                (str(tmp_path / "half.png"), 0.5)], ["ic"])
+
+    assert io.stats.stages["decode"]["calls"] == 1
+    full = ImageO("images/oregon_river.jpg").pipeline(["ic", "bi"]).infile
+    assert (np.array(Image.open(str(tmp_path / "full.png"))) == full).all()
+    assert Image.open(str(tmp_path / "half.png")).size == (512, 340)
+    assert Image.open(str(tmp_path / "small.png")).size == (64, 42)
+
+
+def test_main_pyramid(tmp_path):
+    main(["images/oregon_river.jpg", str(tmp_path / "out_{}.png"), "--pyramid", "256x", "x32"])
+
+    assert Image.open(str(tmp_path / "out_256x.png")).size == (256, 170)
+    assert Image.open(str(tmp_path / "out_x32.png")).size == (48, 32)
+
+
+def test_region():
+    original = ImageO("images/oregon_river.jpg").infile
+    io = ImageO("images/oregon_river.jpg")
+    io.invert_color("", returnable=True, region=[(10, 20, 110, 220), (60, 120, 300, 400)])
+
+    inside = np.zeros(original.shape[:2], bool)
+    inside[20:220, 10:110] = True
+    inside[120:400, 60:300] = True
+    assert np.array_equal(io.infile[inside], 255 - original[inside])
+    assert np.array_equal(io.infile[~inside], original[~inside])
+
+    blocked = ImageO("images/oregon_river.jpg").block_image(
+        "", returnable=True, block_size=8, region=(100, 100, 300, 200))
+    expected = ImageO.from_array(original[100:200, 100:300].copy()).block_image(
+        "", returnable=True, block_size=8)
+    assert np.array_equal(blocked[100:200, 100:300], expected)
+    assert np.array_equal(blocked[:100], original[:100])
+
+    with pytest.raises(ValueError):
+        ImageO("images/oregon_river.jpg").gray_scale("", single_channel=True, region=(0, 0, 9, 9))
+
+    floats = ImageO("images/oregon_river.jpg").invert_color(
+        "", returnable=True, region=(10.0, 20.5, np.float32(110.9), 220))
+    assert np.array_equal(floats, ImageO("images/oregon_river.jpg").invert_color(
+        "", returnable=True, region=(10, 20, 110, 220)))
+    for region in [(0, 0, 9), [(0, 0, "9", 9)], 5]:
+        with pytest.raises(ValueError):
+            ImageO("images/oregon_river.jpg").invert_color("", returnable=True, region=region)
+
+
+def test_pipeline_region(tmp_path):
+    box = (50, 40, 500, 300)
+    original = ImageO("images/oregon_river.jpg").infile
+    result = ImageO("images/oregon_river.jpg").pipeline(["gs", "ic", "bi"], region=box).infile
+    expected = ImageO.from_array(original[40:300, 50:500].copy()).pipeline(
+        ["gs", "ic", "bi"]).infile
+
+    assert np.array_equal(result[40:300, 50:500], expected)
+    assert np.array_equal(result[300:], original[300:])
+    with pytest.raises(ValueError):
+        ImageO("images/oregon_river.jpg").pipeline(["rs"], region=box)
+
+    main(["images/oregon_river.jpg", str(tmp_path / "out.png"), "ic", "--region", "50", "40",
+          "500", "300"])
+    saved = np.array(Image.open(str(tmp_path / "out.png")))
+    assert np.array_equal(saved[40:300, 50:500], 255 - original[40:300, 50:500])
+    assert np.array_equal(saved[:40], original[:40])
+
+    with pytest.raises(SystemExit):
+        main(["images/oregon_river.jpg", str(tmp_path / "tiled.png"), "ic", "--region", "50", "40",
+              "500", "300", "--memory-budget", "1"])
+    assert not (tmp_path / "tiled.png").exists()
+
+
+def test_overlapping_regions_match():
+    boxes = [(0, 0, 12, 12), (6, 6, 18, 18)]
+    original = ImageO("images/oregon_river.jpg").infile
+    blocked = ImageO("images/oregon_river.jpg").block_image(
+        "", returnable=True, block_size=4, region=boxes)
+    piped = ImageO("images/oregon_river.jpg").pipeline(
+        [("bi", {"block_size": 4})], region=boxes).infile
+
+    assert np.array_equal(blocked, piped)
+    # each box is blocked from the pixels it started with and the last box is kept.
+    expected = original.copy()
+    for left, top, right, bottom in boxes:
+        expected[top:bottom, left:right] = ImageO.from_array(
+            original[top:bottom, left:right].copy()).block_image("", True, block_size=4)
+    assert np.array_equal(blocked, expected)
+    inverted = ImageO("images/oregon_river.jpg").pipeline(["ic"], region=boxes).infile
+    assert np.array_equal(inverted[6:12, 6:12], 255 - original[6:12, 6:12])
+
+
+def test_buffer_pool(tmp_path):
+    pool = BufferPool()
+    expected = ImageO("images/oregon_river.jpg").pipeline(["gs", "bi"]).infile
+    buffers = []
+    for _ in range(3):
+        io = ImageO.open("images/oregon_river.jpg", buffers=pool)
+        assert np.array_equal(io.pipeline(["gs", "bi"]).infile, expected)
+        buffers.append(io.infile)
+        io.release()
+
+    assert buffers[0] is buffers[1] is buffers[2]
+    assert pool.counters() == {"allocations": 1, "reuses": 2}
+    for mode in ("L", "LA", "RGBA", "I;16"):
+        Image.open("images/test_picture.png").convert(mode).save(str(tmp_path / "in.png"))
+        io = ImageO.open(str(tmp_path / "in.png"), buffers=pool)
+        assert np.array_equal(io.infile, ImageO(str(tmp_path / "in.png")).infile)
+        io.release()
+
+    io = asyncio.run(ImageO.aopen("images/oregon_river.jpg", buffers=pool))
+    assert io.infile is buffers[0]
+
+
+def test_buffer_pool_bytes():
+    pool = BufferPool(max_bytes=3000)
+    arrays = [pool.take(shape, np.uint8) for shape in ((10, 100), (20, 50), (50, 20), (100, 10))]
+    for pixels in arrays[:3]:
+        pool.give(pixels)
+    assert pool.take((20, 50), np.uint8) is arrays[1]
+    pool.give(arrays[1])
+    pool.give(arrays[3])
+
+    # the first shape was used longest ago, so it is dropped to stay under max_bytes.
+    assert pool.take((10, 100), np.uint8) is not arrays[0]
+    assert [pool.take(pixels.shape, np.uint8) is pixels for pixels in arrays[1:]] == [True] * 3
+    large = np.empty(4000, np.uint8)
+    pool.give(large)
+    assert pool.take(large.shape, np.uint8) is not large
+    assert pool.counters() == {"allocations": 6, "reuses": 4}
+
+
+def test_out(tmp_path):
+    io = ImageO("images/oregon_river.jpg")
+    original = io.infile.copy()
+    out = np.empty_like(original)
+
+    assert io.invert_color("", returnable=True, out=out) is out
+    assert np.array_equal(out, 255 - original)
+    assert io.block_image("", returnable=True, block_size=8, out=out) is out
+    assert np.array_equal(out, ImageO.from_array(original.copy()).block_image(
+        "", returnable=True, block_size=8))
+    io.pipeline(["gs", "ic", "lh"], region=(0, 0, 100, 100), out=out)
+    assert np.array_equal(out, ImageO.from_array(original.copy()).pipeline(
+        ["gs", "ic", "lh"], region=(0, 0, 100, 100)).infile)
+    gray = np.empty(original.shape[:2], np.uint8)
+    assert io.gray_scale("", returnable=True, single_channel=True, out=gray) is gray
+    io.set_encoding("png").invert_color(str(tmp_path / "out.img"), out=out)
+    assert np.array_equal(np.array(Image.open(str(tmp_path / "out.img"))), 255 - original)
+    assert np.array_equal(io.infile, original)
+
+    with pytest.raises(ValueError):
+        io.invert_color("", returnable=True, out=out.astype(np.uint16))
+    with pytest.raises(ValueError):
+        io.gray_scale("", returnable=True, single_channel=True, out=out)
+
+
+def random_image(rng):
+    """Make a small random image of a random shape, mode and depth."""
+    rows, columns = rng.integers(1, 20, size=2)
+    channels = rng.choice([0, 2, 3, 4])
+    dtype = rng.choice([np.uint8, np.uint16])
+    shape = (rows, columns) if channels == 0 else (rows, columns, channels)
+    return rng.integers(0, np.iinfo(dtype).max, size=shape, dtype=dtype, endpoint=True)
+
+
+def random_operation(rng, pixels):
+    """Pick a random operation, with random options, that works on the image."""
+    rows, columns = pixels.shape[:2]
+    choices = list(OPERATIONS) + ["luma", "single", "size", "count", "region"]
+    choices.remove("rs")
+    if pixels.dtype == np.uint8:
+        choices.append("lut")
+    choice = choices[rng.integers(len(choices))]
+    if choice == "luma":
+        return ("gs", {"weights": "luma"})
+    if choice == "single":
+        return ("gs", {"single_channel": True})
+    if choice == "size":
+        return ("bi", {"block_size": tuple(int(size) for size in rng.integers(1, 8, size=2))})
+    if choice == "count":
+        return ("bi", {"number_of_blocks": int(rng.integers(1, 6))})
+    if choice == "region":
+        left, top = int(rng.integers(columns)), int(rng.integers(rows))
+        return (str(rng.choice(["ic", "uh", "bi", "cg"])),
+                {"region": [(left, top, left + 5, top + 5), (0, 0, 4, 3)]})
+    if choice == "lut":
+        return rng.integers(0, 255, size=(3, 256), endpoint=True).astype(np.uint8)
+    return choice
+
+
+def test_engines_match():
+    rng = np.random.default_rng(2022)
+    for _ in range(150):
+        pixels = random_image(rng)
+        operations = [random_operation(rng, pixels) for _ in range(rng.integers(1, 5))]
+        fast = ImageO.from_array(pixels.copy()).set_threads(int(rng.integers(1, 4)))
+        reference = ImageO.from_array(pixels.copy()).set_engine("reference")
+
+        expected = reference.pipeline(operations).infile
+        assert np.array_equal(fast.pipeline(operations).infile, expected), (
+            pixels.shape, pixels.dtype, operations)
+        assert fast.infile.dtype == expected.dtype
+
+    crop = ImageO("images/oregon_river.jpg").infile[:60, :90]
+    for code in OPERATIONS:
+        if code != "rs":
+            assert np.array_equal(
+                ImageO.from_array(crop.copy()).pipeline([code] * 30).infile,
+                ImageO.from_array(crop.copy()).set_engine("reference").pipeline(
+                    [code] * 30).infile)
+    with pytest.raises(ValueError):
+        ImageO.from_array(crop).set_engine("slow")
+
+
+def test_engine_command_line(tmp_path, capsys):
+    make_animation(str(tmp_path / "in.gif"))
+    for extra in (["--memory-budget", "1"], ["--cache-dir", str(tmp_path / "cache")]):
+        with pytest.raises(SystemExit):
+            main(["images/test_picture.jpg", str(tmp_path / "out.png"), "ic", "--engine",
+                  "reference"] + extra)
+        assert "can not be used with" in capsys.readouterr().out
+    with pytest.raises(SystemExit):
+        main([str(tmp_path / "in.gif"), str(tmp_path / "out.gif"), "ic", "--engine", "reference"])
+    assert "several frames" in capsys.readouterr().out
+    assert not (tmp_path / "out.png").exists() and not (tmp_path / "out.gif").exists()
+
+    main([str(tmp_path / "in.gif"), str(tmp_path / "out.png"), "ic", "--engine", "reference",
+          "--first-frame"])
+    assert (tmp_path / "out.png").exists()